@@ -0,0 +1,73 @@
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from message import clientConnection
+from loadGenerator import findFreePort, startServer, stopServer
+
+##Measures how long a local server takes to admit N connections that arrive at once, as in a reconnect storm
+##--> The connections are all started without waiting for each other, and the server's connections gauge is polled
+##    (with Server-Stats) until it has accepted every one of them
+##--> The accept behaviour from before batching can be compared with --server-args="--accept-batch 1 --backlog 128"
+##NOTE: Connections that do not fit in the backlog have their SYNs dropped, and are only retried by the client a second later
+##Usage:
+##  python benchAccept.py --connections 10000
+##  python benchAccept.py --connections 10000 --server-args="--engine asyncio"
+
+def requestStats(monitor: clientConnection) -> dict:
+    monitor.sendRequest(user="bench-monitor", messageType="Server-Stats")
+    while True:
+        message = monitor.receiveRequest()
+        if message is None: raise RuntimeError("The server closed the connection")
+        if message["Headers"]["Message-Type"] == "Server-Stats": break
+    ## Histograms that have not recorded anything yet have no mean
+    return {name: float(value) for name, value in (line.split(" ") for line in message["Body"].splitlines()) if value != "None"}
+
+def measureAdmission(port: int, count: int, timeout: float) -> None:
+    monitor = clientConnection(socket.create_connection(("127.0.0.1", port)))
+    monitor.sock.setblocking(True)
+    monitor.sendRequest(user="bench-monitor", messageType="User-Creation")
+    monitor.receiveRequest()
+    baseline = requestStats(monitor)["connections"]
+
+    sockets, start = [], time.perf_counter()
+    for _ in range(count):
+        sock = socket.socket()
+        sock.setblocking(False)
+        sock.connect_ex(("127.0.0.1", port))
+        sockets.append(sock)
+    started = time.perf_counter() - start
+    while True:
+        stats = requestStats(monitor)
+        admitted, rejected = stats["connections"] - baseline, stats.get("connections.rejected", 0)
+        elapsed = time.perf_counter() - start
+        if admitted + rejected >= count or elapsed > timeout: break
+        time.sleep(0.005)
+    print(f"admitted {admitted:.0f} of {count} connections in {elapsed * 1e3:.1f} ms ({admitted / elapsed:.0f}/s), "
+          f"the connects were started in {started * 1e3:.1f} ms, {rejected:.0f} rejected")
+    for sock in sockets: sock.close()
+    monitor.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the admission of many simultaneous connections")
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--server-args", default="", help="Arguments passed to the server that is started")
+    parser.add_argument("--timeout", type=float, default=30.0, help="The seconds to wait for every connection to be admitted")
+    args = parser.parse_args()
+
+    ## The connections never register, so the handshake timeout is disabled for the duration of the measurement
+    serverArgs = ["--metrics", "--handshake-timeout", "0", *args.server_args.split()]
+    port, logDirectory = findFreePort(), tempfile.TemporaryDirectory()
+    process = startServer(port, serverArgs, logDirectory.name)
+    try:
+        measureAdmission(port, args.connections, args.timeout)
+    finally:
+        stopServer(process)
+        logDirectory.cleanup()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import argparse
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from message import PROTOCOL_ENCODERS, PROTOCOL_DECODERS, frameCompressor, inflatingDecoder
+
+##Compares the bytes per message sent to a client with and without compression, and the CPU time that the server spends
+##compressing (and the client inflating) each message, for a stream of Chat-Update frames sent to a single connection
+
+def benchCompression(protocol, frames, threshold):
+    compressor, decoder = frameCompressor(threshold), inflatingDecoder(PROTOCOL_DECODERS[protocol]())
+    start = time.perf_counter()
+    chunks = [chunk for frame in frames for chunk in compressor.pack(frame)]
+    compressed = time.perf_counter()
+    stream = b"".join(chunks)
+    decoded = 0
+    for i in range(0, len(stream), 65536):
+        decoder.feed(stream[i:i + 65536])
+        for _ in decoder.frames(): decoded += 1
+    end = time.perf_counter()
+    assert decoded == len(frames)
+    return len(stream) / len(frames), (compressed - start) * 1e6 / len(frames), (end - compressed) * 1e6 / len(frames)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bandwidth saved and the CPU time spent by compression")
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--threshold", type=int, default=256, help="The threshold below which frames are sent uncompressed")
+    args = parser.parse_args()
+
+    workloads = {
+        "chat": lambda i: f"user{i % 50}: Are we still meeting at {i % 24}:00 to go over the release notes?",
+        "long ascii": lambda i: f"user{i % 50}: " + "The quick brown fox jumps over the lazy dog. " * 20 + str(i),
+        "unicode": lambda i: f"user{i % 50}: " + "Café 世界 \U0001F600 " * 10 + str(i),
+        "query page": lambda i: "\n".join(f"[2024-01-31 14:{j:02d}:00] user{j}: Message {i * 20 + j}" for j in range(20)),
+    }
+    for name, workload in workloads.items():
+        messages = [workload(i) for i in range(args.messages)]
+        for protocol in PROTOCOL_ENCODERS:
+            encoder = PROTOCOL_ENCODERS[protocol]()
+            frames = [encoder.createRawRequest("Server", message, "Chat-Update", "Text") for message in messages]
+            raw = sum(len(frame) for frame in frames) / len(frames)
+            size, compress, inflate = benchCompression(protocol, frames, args.threshold)
+            print(f"{name:<12}v{protocol}: {raw:>7.1f} -> {size:>7.1f} B/msg ({(1 - size / raw) * 100:>5.1f}% saved)  "
+                  f"compress {compress:>5.2f} us  inflate {inflate:>5.2f} us")
+
+if __name__ == "__main__":
+    main()
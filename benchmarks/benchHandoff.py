@@ -0,0 +1,101 @@
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from message import clientConnection
+from server import messengingServer
+from loadGenerator import findFreePort, startServer, stopServer
+
+##Measures how long a server takes to hand N live sessions over to a newly started server process (with --takeover)
+##--> The old server runs in a forked process, where the sessions are registered directly rather than with User-Creation,
+##    as N clients joining one at a time would broadcast N^2 announcements before the measurement could even start
+##--> The old server reports how long its clients went unserviced (from the start of the handoff until the new server has
+##    acknowledged every session), and the new server how long it took to restore them, both in server.log
+##--> A message is then sent through the new server, and every client checks that it is delivered on its old connection
+##NOTE: The three processes (this one, the old and the new server) each hold one socket per session, so the benchmark stays
+##      within a per-process file descriptor limit
+##Usage:
+##  python benchHandoff.py --sessions 10000
+
+def runOldServer(port: int, handoffPath: str, sessions: int, logDirectory: str, ready) -> None:
+    os.chdir(logDirectory)
+    server = messengingServer()
+    server.handoffPath, server.handshakeTimeout = handoffPath, 0
+    server._setup(port)
+    while len(server.connections.filenoToConnection) < sessions:
+        server.serviceEvents(server.selector.select(0.1))
+    for i, conn in enumerate(list(server.connections.filenoToConnection.values())):
+        user = f"bench{i}"
+        server.connections.registerUser(user, conn)
+        server.joinRoom(user, server.chat)
+        server.startLivenessTimer(conn)
+    server.chat.broadcastSequence = server.chat.nextSequence
+    server.updatedRooms.clear()
+    ready.set()
+    server._executeEventLoop()
+
+def readHandoffEvents(logPath: str) -> dict:
+    events = {}
+    with open(logPath) as file:
+        for line in file:
+            record = json.loads(line)
+            if record["event"] in ("Server-Handoff", "Server-Takeover"): events[record["event"]] = record["description"]
+    return events
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the handoff of live sessions to a new server process")
+    parser.add_argument("--sessions", type=int, default=10000)
+    parser.add_argument("--server-args", default="", help="Arguments passed to the new server")
+    args = parser.parse_args()
+
+    port, logDirectory = findFreePort(), tempfile.TemporaryDirectory()
+    handoffPath = os.path.join(logDirectory.name, "handoff.sock")
+    context = multiprocessing.get_context("fork")
+    ready = context.Event()
+    old = context.Process(target=runOldServer, args=(port, handoffPath, args.sessions, logDirectory.name, ready))
+    old.start()
+    for _ in range(200):
+        if os.path.exists(handoffPath): break
+        time.sleep(0.05)
+    clients = []
+    for _ in range(args.sessions):
+        sock = socket.create_connection(("127.0.0.1", port))
+        clients.append(clientConnection(sock, peername=("127.0.0.1", port)))
+    ready.wait(60)
+
+    start = time.perf_counter()
+    new = startServer(port, ["--takeover", handoffPath, *args.server_args.split()], logDirectory.name)
+    old.join(60)
+    elapsed = time.perf_counter() - start
+    try:
+        ##The new server broadcasts a message from the first session to every other session, on their original connections
+        clients[0].sock.setblocking(True)
+        clients[0].sendRequest(user="bench0", message="After the handoff")
+        delivered = 0
+        for client in clients[1:]:
+            client.sock.setblocking(True)
+            client.sock.settimeout(10.0)
+            while True:
+                message = client.receiveRequest()
+                if message is None: break
+                if message["Body"] == "bench0: After the handoff":
+                    delivered += 1
+                    break
+    finally:
+        for client in clients: client.close()
+        stopServer(new)
+    events = readHandoffEvents(os.path.join(logDirectory.name, "server.log"))
+    logDirectory.cleanup()
+    print(f"{args.sessions} sessions   handoff (clients unserviced): {events.get('Server-Handoff')}   "
+          f"takeover (restore): {events.get('Server-Takeover')}")
+    print(f"{elapsed * 1e3:.0f} ms from starting the new process until the old one exited (including interpreter startup), "
+          f"{delivered} of {args.sessions - 1} sessions received a message through the new server")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import argparse
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from message import request, response, frameDecoder
+
+##Compares the frameDecoder against the previous receive path, in which clientConnection.receiveMessage grew a bytes
+##buffer in 1024 byte steps until it found the terminator, and then decoded it with response.setRawRequest
+##NOTE: Both paths are fed from memory, so this measures the parsing cost and not the socket
+
+def legacyReceive(chunks):
+    buffer = b""
+    for chunk in chunks:
+        buffer += chunk
+        if b"\r\n\r\n" in buffer: break
+    resp = response()
+    resp.setRawRequest(buffer)
+    return resp.stringRequest
+
+def benchLegacy(frames, chunkSize):
+    ##The legacy path can only decode one frame per receive, so each frame is received separately
+    start = time.perf_counter()
+    for frame in frames:
+        legacyReceive([frame[i:i + chunkSize] for i in range(0, len(frame), chunkSize)])
+    return time.perf_counter() - start
+
+def benchDecoder(frames, chunkSize):
+    stream = b"".join(frames)
+    decoder = frameDecoder()
+    start = time.perf_counter()
+    decoded = 0
+    for i in range(0, len(stream), chunkSize):
+        decoder.feed(stream[i:i + chunkSize])
+        for _ in decoder.frames(): decoded += 1
+    assert decoded == len(frames)
+    return time.perf_counter() - start
+
+def report(name, frames, legacy, decoder):
+    print(f"{name:<24}{len(frames):>8} frames   legacy {legacy * 1e6 / len(frames):>10.2f} us/frame   "
+          f"decoder {decoder * 1e6 / len(frames):>10.2f} us/frame   speedup {legacy / decoder:>6.2f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the frame decoder against the legacy receive path")
+    parser.add_argument("--small", type=int, default=50000, help="The number of pipelined small messages")
+    parser.add_argument("--large", type=int, default=5, help="The number of 1 MB messages")
+    args = parser.parse_args()
+
+    req = request()
+    small = [req.createRawRequest("user5423", f"Message number {i}", "User-Message", "Text") for i in range(args.small)]
+    report("pipelined small", small, benchLegacy(small, 1024), benchDecoder(small, 65536))
+
+    large = [req.createRawRequest("user5423", "x" * 1000000, "User-Message", "Text") for _ in range(args.large)]
+    report("1 MB bodies", large, benchLegacy(large, 1024), benchDecoder(large, 65536))
+
+if __name__ == "__main__":
+    main()
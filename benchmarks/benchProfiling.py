@@ -0,0 +1,46 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from benchRooms import createServer
+from profiling import profilingWindow
+
+##Measures how much each profiler slows the server down while a profiling window is open, on the room broadcast path
+##--> "none" is the server with no window open, which has no profiling hooks installed at all
+##Usage:
+##  python benchProfiling.py --profilers none cprofile sampling memory
+
+def bench(profiler, users, rooms, messages, directory):
+    server, conns = createServer(users, rooms)
+    rng = random.Random(5423)
+    senders = [(f"user{i}", server.rooms[f"room{i % rooms}"]) for i in (rng.randrange(users) for _ in range(messages))]
+    window = None if profiler == "none" else profilingWindow([profiler], directory)
+    if window is not None: window.open()
+    start = time.perf_counter()
+    for user, room in senders:
+        server.logMessage(user, "User-Message", "Hello room", room=room)
+        server.broadcastNewChats()
+    elapsed = time.perf_counter() - start
+    if window is not None: window.close()
+    return elapsed * 1e6 / messages
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the overhead of each profiler while a profiling window is open")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--profilers", nargs="+", default=["none", "cprofile", "sampling", "memory"])
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        baseline = None
+        for profiler in args.profilers:
+            cost = bench(profiler, args.users, args.rooms, args.messages, directory)
+            baseline = cost if baseline is None else baseline
+            print(f"{profiler:>10}   {cost:>8.1f} us/message   {cost / baseline:>5.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import argparse
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from message import PROTOCOL_ENCODERS, PROTOCOL_DECODERS
+
+##Compares the bytes and CPU time per message of each protocol version, encoding and then decoding a pipelined stream
+
+def benchProtocol(protocol, messages):
+    encoder, decoder = PROTOCOL_ENCODERS[protocol](), PROTOCOL_DECODERS[protocol]()
+    start = time.perf_counter()
+    frames = [encoder.createRawRequest("user5423", message, "Chat-Update", "Text") for message in messages]
+    encoded = time.perf_counter()
+    stream = b"".join(frames)
+    decoded = 0
+    for i in range(0, len(stream), 65536):
+        decoder.feed(stream[i:i + 65536])
+        for _ in decoder.frames(): decoded += 1
+    end = time.perf_counter()
+    assert decoded == len(messages)
+    return len(stream) / len(messages), (encoded - start) * 1e6 / len(messages), (end - encoded) * 1e6 / len(messages)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bytes and CPU time per message of each protocol version")
+    parser.add_argument("--messages", type=int, default=50000)
+    args = parser.parse_args()
+
+    workloads = {
+        "short ascii": "Hello there!",
+        "long ascii": "The quick brown fox jumps over the lazy dog. " * 20,
+        "multiline": "line one\r\nline two\r\nline three\r\n" * 5,
+        "unicode": "Café 世界 \U0001F600 " * 10,
+    }
+    for name, message in workloads.items():
+        messages = [f"{message} {i}" for i in range(args.messages)]
+        results = {protocol: benchProtocol(protocol, messages) for protocol in PROTOCOL_ENCODERS}
+        print(f"{name:<14}" + "   ".join(f"v{protocol}: {size:>7.1f} B/msg  encode {encode:>5.2f} us  decode {decode:>5.2f} us"
+                                         for protocol, (size, encode, decode) in results.items()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import argparse
+import os
+import random
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from message import connections
+from server import messengingServer
+
+##Measures the broadcast cost of room messages, with the users spread over more and more (and so smaller) rooms
+##--> If delivery only visits the members of a room, the cost per message falls in proportion to the room size,
+##    and the cost per delivery stays flat
+##NOTE: The connections only collect their frames, so this measures the server's fan-out and not the sockets
+
+class benchConnection:
+    def __init__(self) -> None:
+        self.protocol: int = 1
+        self.closing: bool = False
+        self.congested: bool = False
+        self.outbound: list = []
+        self.outboundBytes: int = 0
+
+    def queueFrame(self, frame: bytes) -> bool:
+        self.outbound.append(frame)
+        return False ## The write interest is never armed, as there is no selector
+
+def createServer(users, rooms):
+    server = messengingServer()
+    server.connections = connections()
+    conns = []
+    for i in range(users):
+        user, conn = f"user{i}", benchConnection()
+        server.connections.registerUser(user, conn)
+        ## The members are added without their join announcements, which would otherwise be broadcast to every user
+        for room in (server.chat, server.getRoom(f"room{i % rooms}")):
+            room.userPointers[user] = room.nextSequence
+            server.userRooms.setdefault(user, set()).add(room.name)
+        conns.append(conn)
+    return server, conns
+
+def bench(users, rooms, messages):
+    server, conns = createServer(users, rooms)
+    for conn in conns: conn.outbound.clear()
+    rng = random.Random(5423)
+    senders = [(f"user{i}", server.rooms[f"room{i % rooms}"]) for i in (rng.randrange(users) for _ in range(messages))]
+    start = time.perf_counter()
+    for user, room in senders:
+        server.logMessage(user, "User-Message", "Hello room", room=room)
+        server.broadcastNewChats()
+    elapsed = time.perf_counter() - start
+    deliveries = sum(len(conn.outbound) for conn in conns)
+    print(f"{rooms:>6} rooms of {users // rooms:>6} users   {elapsed * 1e6 / messages:>10.1f} us/message   "
+          f"{elapsed * 1e9 / max(deliveries, 1):>8.1f} ns/delivery   {deliveries / messages:>8.1f} deliveries/message")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the fan-out of room messages")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--rooms", type=int, nargs="+", default=[1, 10, 100, 1000])
+    args = parser.parse_args()
+    for rooms in args.rooms:
+        bench(args.users, rooms, args.messages if rooms > 1 else max(1, args.messages // 20))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import argparse
+import os
+import random
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from search import chatIndex
+from server import ChatAction
+
+##Measures the query latency of the chat index on a large chat, and compares a search with a scan of the chat
+##NOTE: The chat is generated from a small vocabulary with a few rare words, so that common and rare terms are both measured
+
+WORDS = [f"word{i}" for i in range(2000)] + ["hello", "the", "a", "chat", "server"] * 200
+
+def buildIndex(count, users):
+    index, chats, timestamp = chatIndex(), [], time.time() - count
+    rng = random.Random(5423)
+    start = time.perf_counter()
+    for sequence in range(count):
+        chat = ChatAction(sequence, timestamp + sequence, f"user{rng.randrange(users)}", " ".join(rng.choices(WORDS, k=8)), "public")
+        index.add(chat)
+        chats.append(chat)
+    print(f"indexed {count} messages in {time.perf_counter() - start:.2f} s ({(time.perf_counter() - start) * 1e6 / count:.2f} us/message)")
+    return index, chats
+
+def timeQuery(name, query, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat): results = query()
+    print(f"{name:<36}{(time.perf_counter() - start) * 1e6 / repeat:>10.1f} us/query   {len(results):>4} results")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chat index queries")
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    index, chats = buildIndex(args.messages, args.users)
+    timeQuery("/history 50", lambda: index.history(50), args.repeat)
+    timeQuery("/from user42", lambda: index.fromUser("user42", 50), args.repeat)
+    timeQuery("/since (one hour ago)", lambda: index.since(chats[-1].timestamp - 3600, 50), args.repeat)
+    timeQuery("/search hello (common)", lambda: index.search(["hello"], 50), args.repeat)
+    timeQuery("/search word7 (rare)", lambda: index.search(["word7"], 50), args.repeat)
+    timeQuery("/search hello word7", lambda: index.search(["hello", "word7"], 50), args.repeat)
+    timeQuery("scan for word7 (for comparison)", lambda: [chat.sequence for chat in chats if "word7 " in chat.message + " "][-50:], 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import argparse
+import gc
+import os
+import random
+import selectors
+import socket
+import sys
+import time
+import tracemalloc
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from message import connections
+from server import messengingServer
+
+##Measures the memory held per connection, and the cost of dispatching a read event to its connection, with many idle
+##sessions registered on the server
+##--> Each event is a spurious wakeup (recv_into() would block), so this measures the dispatch and not the decoding
+##NOTE: The sockets only stand in for accepted sockets, so that tens of thousands of connections can be created without
+##      running out of file descriptors
+
+class benchSocket:
+    def __init__(self, fd: int) -> None:
+        self.fd: int = fd
+        self.family: int = socket.AF_INET
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def setblocking(self, flag: bool) -> None:
+        pass
+
+    def setsockopt(self, level: int, option: int, value: int) -> None:
+        pass
+
+    def getpeername(self) -> tuple:
+        return ("127.0.0.1", 1024 + self.fd % 60000)
+
+    def recv_into(self, view: memoryview) -> int:
+        raise BlockingIOError
+
+def createSessions(server, count):
+    keys = []
+    for fd in range(100, 100 + count):
+        sock = benchSocket(fd)
+        conn = server.createConnection(sock)
+        server.connections.registerConnection(conn)
+        server.connections.registerUser(f"user{fd}", conn)
+        keys.append((selectors.SelectorKey(sock, fd, selectors.EVENT_READ, conn), selectors.EVENT_READ))
+    return keys
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the per-connection memory and event dispatch of idle sessions")
+    parser.add_argument("--connections", type=int, default=50000)
+    parser.add_argument("--events", type=int, default=200000)
+    args = parser.parse_args()
+
+    server = messengingServer()
+    server.connections = connections()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    keys = createSessions(server, args.connections)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    rng = random.Random(5423)
+    events = [keys[rng.randrange(len(keys))] for _ in range(args.events)]
+    start = time.perf_counter()
+    for offset in range(0, len(events), 256):
+        server.serviceEvents(events[offset:offset + 256])
+    elapsed = time.perf_counter() - start
+    print(f"{args.connections} connections   {used / args.connections:>8.0f} bytes/connection   {used / 1048576:>8.1f} MiB   "
+          f"{elapsed * 1e9 / len(events):>6.0f} ns/event")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import argparse
+import heapq
+import os
+import random
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from timerWheel import timerWheel
+
+##Simulates the liveness timers of N connections over a period of simulated time, advancing the timers once per pass of
+##the event loop, and reports the CPU time spent on them. As in the server, a timer that fires is re-armed from the
+##connection's last activity if it has been active since, and otherwise from now (as it has just been sent a Ping)
+##The same workload is run against a binary heap (heapq) for comparison
+
+class connection:
+    __slots__ = ("lastActivity", "timer")
+
+    def __init__(self) -> None:
+        self.lastActivity, self.timer = 0.0, None
+
+def simulateWheel(conns, interval, seconds, passesPerSecond, activity):
+    wheel, fired, now = timerWheel(0.0), 0, 0.0
+    def check(conn):
+        nonlocal fired
+        fired += 1
+        conn.timer = wheel.schedule(max(conn.lastActivity, now) + interval, check, conn)
+    for conn in conns: conn.timer = wheel.schedule(interval, check, conn)
+    start = time.perf_counter()
+    for step in range(1, int(seconds * passesPerSecond) + 1):
+        now = step / passesPerSecond
+        for conn in random.sample(conns, activity): conn.lastActivity = now
+        wheel.advance(now)
+        wheel.nextDeadline()
+    return time.perf_counter() - start, fired
+
+def simulateHeap(conns, interval, seconds, passesPerSecond, activity):
+    heap, fired = [(interval, i) for i in range(len(conns))], 0
+    heapq.heapify(heap)
+    start = time.perf_counter()
+    for step in range(1, int(seconds * passesPerSecond) + 1):
+        now = step / passesPerSecond
+        for conn in random.sample(conns, activity): conn.lastActivity = now
+        while heap and heap[0][0] <= now:
+            _, i = heapq.heappop(heap)
+            fired += 1
+            heapq.heappush(heap, (max(conns[i].lastActivity, now) + interval, i))
+    return time.perf_counter() - start, fired
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the cost of the per-connection liveness timers")
+    parser.add_argument("--connections", type=int, default=50000)
+    parser.add_argument("--interval", type=float, default=30.0, help="The heartbeat interval in seconds")
+    parser.add_argument("--seconds", type=float, default=120.0, help="The simulated time")
+    parser.add_argument("--passes", type=int, default=100, help="The passes of the event loop per simulated second")
+    parser.add_argument("--activity", type=int, default=50, help="The connections that receive a frame in each pass")
+    args = parser.parse_args()
+
+    for name, simulate in (("timer wheel", simulateWheel), ("binary heap", simulateHeap)):
+        random.seed(1)
+        conns = [connection() for _ in range(args.connections)]
+        elapsed, fired = simulate(conns, args.interval, args.seconds, args.passes, args.activity)
+        passes = int(args.seconds * args.passes)
+        print(f"{name:<12} {elapsed * 1e6 / passes:>7.2f} us per pass  {elapsed * 1e6 / max(fired, 1):>6.2f} us per timer fired  "
+              f"({fired} fired, {args.connections} connections)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from chatClient import chatClient
+from metrics import histogram
+
+##A headless load generator, which simulates N concurrent users speaking the chat protocol to a local server
+##--> A subset of the users send messages at a fixed rate, and every user receives the resulting Chat-Updates
+##--> Each message body starts with its send timestamp, so the end-to-end delivery latency is measured by its receivers
+##--> The server's metrics are sampled before and after the measured period, to report its send syscalls per delivery
+##--> The results are written as JSON, and two result files can be compared to spot regressions
+##Usage:
+##  python loadGenerator.py run --users 200 --senders 20 --rate 10 --duration 20 --output before.json
+##  python loadGenerator.py run --server-args="--engine asyncio" --output after.json
+##  python loadGenerator.py run --compression deflate --size 1024 --output compressed.json
+##  python loadGenerator.py run --frozen 0.05 --size 4096 --output frozen.json
+##  python loadGenerator.py run --server-args="--flush-interval 0.005" --output ticked.json
+##  python loadGenerator.py run --users 1000 --senders 50 --rate 2 --flooders 1 --output flooded.json
+##  python loadGenerator.py compare before.json after.json
+
+SERVER_PATH = os.path.join(os.path.dirname(__file__), "..", "src", "server.py")
+
+
+class loadClient(chatClient):
+    def __init__(self, name: str, protocol: int, compression: bool, stats: "loadStatistics") -> None:
+        super().__init__(name, protocol, compression)
+        self.stats = stats
+        self.serverStats: Optional[asyncio.Future] = None
+
+    async def receiveLoop(self) -> None:
+        while True:
+            data = await self.reader.read(65536)
+            if not data: return None
+            self.stats.bytesReceived += len(data)
+            self.decoder.feed(data)
+            now = time.perf_counter()
+            for frame in self.bufferedRequests():
+                if frame["Headers"]["Message-Type"] == "Server-Stats" and self.serverStats is not None:
+                    self.serverStats.set_result(frame["Body"])
+                else:
+                    self.stats.recordDelivery(frame["Body"], now)
+
+    async def requestStats(self) -> Dict[str, float]:
+        ## Returns the server's metrics, which are empty if the server was not started with --metrics
+        self.serverStats = asyncio.get_running_loop().create_future()
+        self.write("", "Server-Stats")
+        try:
+            body = await asyncio.wait_for(self.serverStats, 5.0)
+        except asyncio.TimeoutError: return {}
+        finally: self.serverStats = None
+        if body.startswith("Server:"): return {}
+        return {name: float(value) for name, value in (line.split(" ") for line in body.splitlines()) if value != "None"}
+
+    async def sendLoop(self, rate: float, size: int, until: float) -> None:
+        ## Messages are scheduled against absolute times, so that the send rate does not drift
+        interval, nextSend = 1.0 / rate, time.perf_counter()
+        padding = "x" * max(0, size - 20)
+        while nextSend < until:
+            await asyncio.sleep(max(0.0, nextSend - time.perf_counter()))
+            self.write(f"{time.perf_counter():.9f}|{padding}", "User-Message")
+            self.stats.sent += 1
+            nextSend += interval
+            if self.writer.transport.get_write_buffer_size() > 1048576:
+                await self.writer.drain()
+
+    async def floodLoop(self, size: int, until: float) -> None:
+        ## Sends messages as fast as the server reads them, without timestamps, so they are not measured as deliveries
+        body = "f" * size
+        while time.perf_counter() < until:
+            for _ in range(100): self.write(body, "User-Message")
+            self.stats.sent += 100
+            await self.writer.drain()
+            await asyncio.sleep(0) ## The other clients of this event loop are not starved
+
+
+class loadStatistics:
+    def __init__(self) -> None:
+        self.sent: int = 0
+        self.delivered: int = 0
+        self.bytesReceived: int = 0
+        self.measuring: bool = False
+        self.latency: histogram = histogram(0.01) ## ~1% resolution, so that millions of samples are recorded in constant memory
+
+    def recordDelivery(self, body: str, now: float) -> None:
+        ## Chat-Update bodies are "user: message", where load generated messages start with their send timestamp
+        _, _, message = body.partition(": ")
+        timestamp, separator, _ = message.partition("|")
+        if separator == "": return None
+        self.delivered += 1
+        if self.measuring:
+            try:
+                self.latency.record(now - float(timestamp))
+            except ValueError: pass
+
+
+def findFreePort() -> int:
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+def startServer(port: int, serverArgs: List[str], logDirectory: str) -> subprocess.Popen:
+    process = subprocess.Popen([sys.executable, SERVER_PATH, str(port), *serverArgs], cwd=logDirectory, stdout=subprocess.DEVNULL)
+    for _ in range(200):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return process
+        except ConnectionRefusedError: time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("The server did not start listening")
+
+def stopServer(process: subprocess.Popen) -> Optional[float]:
+    ## Returns the CPU time used by the server, if the platform reports it
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    try:
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
+    except ImportError: return None
+
+
+async def runLoad(args, host: str, port: int) -> Dict:
+    stats = loadStatistics()
+    clients = [loadClient(f"load{i}", args.protocol, args.compression is not None, stats) for i in range(args.users)]
+    ## Flooders have their own statistics, so that neither what they send nor what they receive is measured
+    flooders = [loadClient(f"flood{i}", args.protocol, args.compression is not None, loadStatistics()) for i in range(args.flooders)]
+    for i in range(0, len(clients), 100):
+        await asyncio.gather(*(client.connect(host, port) for client in clients[i:i + 100]))
+    await asyncio.gather(*(flooder.connect(host, port) for flooder in flooders))
+    ## Frozen users never read, as if their client had hung, and are excluded from the delivery statistics
+    frozen = int(args.users * args.frozen)
+    receivers = [asyncio.ensure_future(client.receiveLoop()) for client in clients[:len(clients) - frozen] + flooders]
+
+    start = time.perf_counter()
+    until = start + args.warmup + args.duration
+    senders = [asyncio.ensure_future(client.sendLoop(args.rate, args.size, until)) for client in clients[:args.senders]]
+    senders += [asyncio.ensure_future(flooder.floodLoop(args.size, until)) for flooder in flooders]
+    await asyncio.sleep(args.warmup)
+    metricsBefore = await clients[0].requestStats()
+    stats.measuring, sentBefore, deliveredBefore, bytesBefore = True, stats.sent, stats.delivered, stats.bytesReceived
+    measureStart = time.perf_counter()
+    await asyncio.gather(*senders)
+    measureEnd = time.perf_counter()
+    stats.measuring, sentDuring, deliveredDuring = False, stats.sent - sentBefore, stats.delivered - deliveredBefore
+    bytesDuring = stats.bytesReceived - bytesBefore
+    metricsAfter = await clients[0].requestStats()
+    await asyncio.sleep(args.drain) ## Lets the messages in flight be delivered
+    await asyncio.gather(*(client.close() for client in clients + flooders))
+    for receiver in receivers: receiver.cancel()
+    await asyncio.gather(*receivers, return_exceptions=True)
+
+    elapsed = measureEnd - measureStart
+    expected = sentDuring * (args.users - frozen - 1)
+    metricDelta = lambda name: metricsAfter[name] - metricsBefore[name] if name in metricsBefore and name in metricsAfter else None
+    sendCalls, interestChanges = metricDelta("send.calls"), metricDelta("loop.interest.changes")
+    return {
+        "sent": sentDuring,
+        "delivered": deliveredDuring,
+        "messagesPerSecond": sentDuring / elapsed,
+        "deliveriesPerSecond": deliveredDuring / elapsed,
+        "deliveryRatio": deliveredDuring / expected if expected else None,
+        "bytesReceived": bytesDuring,
+        "bytesPerDelivery": bytesDuring / deliveredDuring if deliveredDuring else None,
+        "sendCallsPerDelivery": sendCalls / deliveredDuring if sendCalls is not None and deliveredDuring else None,
+        "writeSyscallsPerDelivery": (sendCalls + (interestChanges or 0)) / deliveredDuring if sendCalls is not None and deliveredDuring else None,
+        "latency": {name: stats.latency.percentile(percent) for name, percent in (("p50", 50), ("p99", 99), ("p999", 99.9))},
+        "latencyMax": stats.latency.maximum,
+    }
+
+
+def run(args) -> None:
+    serverArgs = args.server_args.split()
+    if "--metrics" not in serverArgs: serverArgs.append("--metrics") ## The metrics report the server's syscalls
+    process, logDirectory = None, tempfile.TemporaryDirectory()
+    if args.port is None:
+        port = findFreePort()
+        process = startServer(port, serverArgs, logDirectory.name)
+    else:
+        port = args.port
+    try:
+        results = asyncio.run(runLoad(args, args.host, port))
+    finally:
+        serverCpu = stopServer(process) if process is not None else None
+        logDirectory.cleanup()
+
+    results["serverCpuSeconds"] = serverCpu
+    if serverCpu is not None and results["delivered"]:
+        results["serverCpuMicrosecondsPerDelivery"] = serverCpu * 1e6 / results["delivered"]
+    results["config"] = {key: value for key, value in vars(args).items() if key not in ("func", "output")}
+    printResults(results)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+def printResults(results: Dict) -> None:
+    latency = results["latency"]
+    formatLatency = lambda value: "n/a" if value is None else f"{value * 1e3:.3f} ms"
+    print(f"sent {results['sent']} messages ({results['messagesPerSecond']:.0f}/s), "
+          f"delivered {results['delivered']} ({results['deliveriesPerSecond']:.0f}/s)")
+    print(f"latency p50 {formatLatency(latency['p50'])}  p99 {formatLatency(latency['p99'])}  "
+          f"p999 {formatLatency(latency['p999'])}  max {formatLatency(results['latencyMax'])}")
+    if results.get("bytesPerDelivery") is not None:
+        print(f"received {results['bytesReceived']} bytes ({results['bytesPerDelivery']:.1f} bytes per delivery)")
+    if results.get("sendCallsPerDelivery") is not None:
+        print(f"server sends {results['sendCallsPerDelivery']:.3f} per delivery "
+              f"({results['writeSyscallsPerDelivery']:.3f} write path syscalls, including EVENT_WRITE changes)")
+    if results.get("serverCpuMicrosecondsPerDelivery") is not None:
+        print(f"server cpu {results['serverCpuSeconds']:.2f} s ({results['serverCpuMicrosecondsPerDelivery']:.2f} us per delivery)")
+
+
+def flatten(results: Dict, prefix: str = "") -> Dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict) and key != "config":
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(args) -> None:
+    ## Higher is better for throughput, and lower is better for latency and CPU time
+    higherIsBetter = {"messagesPerSecond", "deliveriesPerSecond", "deliveryRatio"}
+    with open(args.baseline) as file: baseline = flatten(json.load(file))
+    with open(args.candidate) as file: candidate = flatten(json.load(file))
+    regressions = 0
+    for key in sorted(baseline.keys() & candidate.keys()):
+        before, after = baseline[key], candidate[key]
+        change = (after - before) / before * 100 if before else 0.0
+        worse = change < -args.threshold if key in higherIsBetter else change > args.threshold
+        if key in ("sent", "delivered", "bytesReceived"): worse = False
+        regressions += worse
+        print(f"{key:<36}{before:>16.6g}{after:>16.6g}{change:>+10.1f}%{'   REGRESSION' if worse else ''}")
+    sys.exit(1 if regressions else 0)
+
+
+def parseArguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load generation and latency benchmark for the chat server")
+    subparsers = parser.add_subparsers(required=True)
+
+    runParser = subparsers.add_parser("run", help="Run a load test against a local server")
+    runParser.add_argument("--host", default="127.0.0.1")
+    runParser.add_argument("--port", type=int, default=None, help="Use an already running server rather than starting one")
+    runParser.add_argument("--server-args", default="", help="Arguments passed to the server that is started")
+    runParser.add_argument("--users", type=int, default=100, help="The number of concurrent users")
+    runParser.add_argument("--senders", type=int, default=10, help="The number of users that send messages")
+    runParser.add_argument("--rate", type=float, default=10.0, help="The messages per second sent by each sender")
+    runParser.add_argument("--size", type=int, default=64, help="The size of each message body")
+    runParser.add_argument("--protocol", type=int, choices=[1, 2], default=1, help="The protocol version offered by each user")
+    runParser.add_argument("--frozen", type=float, default=0.0, help="The fraction of users that never read their updates")
+    runParser.add_argument("--flooders", type=int, default=0, help="The number of additional users that send messages as fast as they can")
+    runParser.add_argument("--compression", choices=["deflate"], default=None, help="The compression offered by each user")
+    runParser.add_argument("--duration", type=float, default=10.0, help="The length of the measured period in seconds")
+    runParser.add_argument("--warmup", type=float, default=2.0, help="The seconds of load before measuring starts")
+    runParser.add_argument("--drain", type=float, default=1.0, help="The seconds to wait for in-flight messages afterwards")
+    runParser.add_argument("--output", default=None, help="The file to write the JSON results to")
+    runParser.set_defaults(func=run)
+
+    compareParser = subparsers.add_parser("compare", help="Compare two result files")
+    compareParser.add_argument("baseline")
+    compareParser.add_argument("candidate")
+    compareParser.add_argument("--threshold", type=float, default=10.0, help="The percentage change reported as a regression")
+    compareParser.set_defaults(func=compare)
+    return parser.parse_args()
+
+def main():
+    args = parseArguments()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
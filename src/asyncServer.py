@@ -0,0 +1,318 @@
+import asyncio
+import time
+from typing import Callable, Optional
+from message import frameConnection
+from rateLimit import createBucket
+from server import messengingServer
+from timerWheel import timer
+
+##An alternative engine for the messengingServer, built on asyncio Protocols/transports rather than the selectors loop
+##NOTE: The application layer (sessions, the chatObject and the userServices dispatch table) is shared with the selectors
+##      engine, and only the way that connections are accepted, read from and written to differs
+##NOTE: Transports buffer writes themselves, so there is no EVENT_WRITE interest to manage. The frames queued to each
+##      connection are handed to its transport together, once per pass of the event loop (or tick of flushInterval), and
+##      are held in the connection's outbound queue (where the slow consumer policy can drop or coalesce them) while the
+##      transport's buffer is above its high watermark
+##NOTE: The connections' timers are kept in the same timer wheel as the selectors engine, which a single loop.call_later()
+##      handle advances whenever its earliest occupied slot is due
+##NOTE: A connection's reads are deferred by pausing its transport, both while it has frames left buffered after
+##      maxFramesPerPass and while it is over its byte rate limit
+
+class transportConnection(frameConnection):
+    __slots__ = ("transport", "sock", "peername", "eof", "closing", "closed", "paused")
+
+    def __init__(self, transport: asyncio.Transport) -> None:
+        super().__init__(bufferSize=0) ## Transports receive into their own buffers
+        self.transport = transport
+        self.sock = transport.get_extra_info("socket")
+        self.fileno = self.sock.fileno()
+        self.peername = transport.get_extra_info("peername")[:2]
+        self.eof: bool = False ## Set once the transport has been lost, while frames may still be buffered
+        self.closing: bool = False
+        self.closed: bool = False
+        self.paused: bool = False ## Set while the transport's buffer is above its high watermark
+
+    def queueFrame(self, frame: bytes) -> bool:
+        ## Returns whether the queue was previously empty, i.e. whether a flush needs to be scheduled
+        wasEmpty = len(self.outbound) == 0
+        self.outbound.append(frame)
+        self.outboundBytes += len(frame)
+        return wasEmpty
+
+    def flushFrames(self) -> bool:
+        ## Hands every queued frame to the transport with a single writelines(), unless the transport is paused
+        if self.paused: return False
+        if self.eof: self.clearOutbound() ## The transport is gone, so the replies to its buffered frames are discarded
+        if not self.outbound: return True
+        if self.compressor is None:
+            chunks = list(self.outbound)
+        else:
+            chunks = [chunk for frame in self.outbound for chunk in self.compressor.pack(frame)]
+        self.clearOutbound()
+        self.transport.writelines(chunks)
+        return True
+
+    def unsentBytes(self) -> int:
+        return self.outboundBytes + self.transport.get_write_buffer_size()
+
+    def setCompression(self, threshold: int = 256, level: int = 6) -> None:
+        ## The frames already queued (such as the negotiating reply) are written uncompressed
+        self.transport.writelines(list(self.outbound))
+        self.clearOutbound()
+        super().setCompression(threshold, level)
+
+    def close(self) -> None:
+        ## Any queued and buffered frames are still flushed before the transport is closed
+        self.flushFrames()
+        self.closed = True
+        self.transport.close()
+
+
+class chatProtocol(asyncio.Protocol):
+    def __init__(self, server: "asyncMessengingServer") -> None:
+        self.server = server
+        self.conn: Optional[transportConnection] = None
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.conn = transportConnection(transport)
+        if self.server.atConnectionLimit(): return self.server.rejectTransport(self.conn)
+        transport.set_write_buffer_limits(self.server.outboundHighWatermark, self.server.outboundLowWatermark)
+        self.server.acceptConnection(self.conn)
+
+    def pause_writing(self) -> None:
+        self.conn.paused = True
+
+    def resume_writing(self) -> None:
+        self.server.resumeWriting(self.conn)
+
+    def data_received(self, data: bytes) -> None:
+        if self.conn.closing: return None
+        if self.server.metrics is not None: self.server.bytesIn.inc(len(data))
+        self.conn.lastActivity = time.monotonic()
+        if self.conn.byteBucket is not None: self.conn.byteBucket.charge(self.conn.lastActivity, len(data))
+        self.conn.decoder.feed(data)
+        self.server.serviceConnection(self.conn)
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        if self.conn.closed is False: self.server.connectionLost(self.conn)
+
+
+class asyncMessengingServer(messengingServer):
+    def __init__(self) -> None:
+        super().__init__()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.stopEvent: Optional[asyncio.Event] = None
+        self.broadcastScheduled: bool = False
+        self.commandResultsScheduled: bool = False
+        self.pendingReadsScheduled: bool = False
+        self.flushScheduled: bool = False
+        self.useUvloop: bool = False
+        self.timerHandle: Optional[asyncio.TimerHandle] = None
+        self.timerVisit: float = 0.0 ## When the timer handle will advance the timer wheel
+
+    def run(self, args=None) -> None:
+        args = self.parseArguments() if args is None else args
+        self.useUvloop = args.uvloop
+        return super().run(args)
+
+    def registerServerSocket(self) -> None:
+        self.loop = self.createEventLoop()
+        self.stopEvent = asyncio.Event()
+        ## The loop accepts up to backlog connections each time the listening socket is ready, and sets TCP_NODELAY itself
+        self.listener = self.loop.run_until_complete(self.loop.create_server(lambda: chatProtocol(self), sock=self.serverSocket, backlog=self.backlog))
+
+    def createEventLoop(self) -> asyncio.AbstractEventLoop:
+        if self.useUvloop:
+            try:
+                import uvloop
+                return uvloop.new_event_loop()
+            except ImportError:
+                print("uvloop is not installed, so the default asyncio event loop will be used")
+        return asyncio.new_event_loop()
+
+    def enableMetrics(self, metricsFile: str = "server-stats.txt") -> None:
+        ## Transports buffer their own writes, so the outbound backlog is measured in bytes rather than frames
+        super().enableMetrics(metricsFile)
+        del self.metrics.gauges["outbound.frames.total"], self.metrics.gauges["outbound.frames.max"]
+
+    def measureLag(self, expected: float, interval: float = 0.25) -> None:
+        ## There is no select() call to instrument, so the loop lag is measured as how late a periodic timer runs
+        now = self.loop.time()
+        self.loopLag.record(max(0.0, now - expected))
+        self.loop.call_at(now + interval, self.measureLag, now + interval)
+
+    def _executeEventLoop(self) -> None:
+        self.logDebug("Server", "Server-Running", "Success")
+        if self.metrics is not None: self.loop.call_soon(self.measureLag, self.loop.time())
+        try:
+            self.loop.run_until_complete(self.stopEvent.wait())
+        except KeyboardInterrupt: pass
+        try:
+            print("Server is Terminating")
+            if self.profilingWindow is not None: self.closeProfilingWindow()
+            self.closeRemainingSessions()
+            self.closeRemainingConnections()
+            self.listener.close()
+            for room in self.rooms.values(): room.close()
+            self.loop.run_until_complete(self.listener.wait_closed())
+            self.loop.run_until_complete(asyncio.sleep(0)) ## Lets the closed transports run their callbacks
+            self.loop.close()
+            self.logDebug("Server", "Server-Termination", "Success")
+        except (KeyboardInterrupt, Exception):
+            self.logDebug("Server", "Server-Termination", "Warning")
+        self.eventLog.close()
+
+    def acceptConnection(self, conn: transportConnection) -> None:
+        conn.byteBucket = createBucket(self.byteRate, self.byteBurst, time.monotonic())
+        self.connections.registerConnection(conn)
+        self.startHandshakeTimer(conn)
+        if self.metrics is not None: self.connectionsAccepted.inc()
+        self.logEvent(None, "Connection-Accepted", "Success", conn)
+
+    def rejectTransport(self, conn: transportConnection) -> None:
+        ## The connection is never registered, and is closed once the pre-encoded rejection has been written
+        conn.closing = conn.closed = True
+        conn.transport.write(self.connectionRejection)
+        conn.transport.close()
+        if self.metrics is not None: self.connectionsRejected.inc()
+
+    def serviceConnection(self, conn: transportConnection) -> None:
+        self.serviceFrames(conn.user, conn, conn.bufferedRequests())
+        if conn in self.pendingReads:
+            conn.transport.pause_reading()
+            self.schedulePendingReads()
+        if conn.byteBucket is not None and conn.byteBucket.tokens < 0 and not conn.closing and not conn.readPaused: self.pauseReading(conn)
+        self.scheduleBroadcast()
+
+    def schedulePendingReads(self) -> None:
+        ## The connections with frames left buffered are serviced in turn, once per pass of the event loop
+        if self.pendingReadsScheduled: return None
+        self.pendingReadsScheduled = True
+        self.loop.call_soon(self.runPendingReads)
+
+    def runPendingReads(self) -> None:
+        self.pendingReadsScheduled = False
+        self.servicePendingReads()
+        if self.pendingReads: self.schedulePendingReads()
+        self.scheduleBroadcast()
+
+    def connectionLost(self, conn: transportConnection) -> None:
+        ## As with the selectors engine, frames left buffered after maxFramesPerPass are still serviced before the session
+        ## is closed, by finishPendingReads()
+        conn.eof = True
+        if conn in self.pendingReads: return None
+        self.closeSession(conn.user, conn)
+        self.scheduleBroadcast()
+
+    def finishPendingReads(self, conn: transportConnection) -> None:
+        ## Called once every frame buffered on the connection has been serviced
+        if conn.eof: self.closeSession(conn.user, conn)
+        elif not conn.readPaused: conn.transport.resume_reading()
+
+    def setReadInterest(self, conn: transportConnection, interest: bool) -> None:
+        conn.readPaused = not interest
+        if not interest: conn.transport.pause_reading()
+        elif conn not in self.pendingReads: conn.transport.resume_reading()
+
+    def scheduleBroadcast(self) -> None:
+        ## Chats logged during the same iteration of the event loop are broadcast together, as with the selectors engine
+        if self.broadcastScheduled: return None
+        self.broadcastScheduled = True
+        self.loop.call_soon(self.runBroadcast)
+
+    def runBroadcast(self) -> None:
+        self.broadcastScheduled = False
+        self.broadcastNewChats()
+        if self.slowConsumers: self.disconnectSlowConsumers()
+
+    def scheduleCommandResults(self) -> None:
+        ## A page of each pending query is sent per pass of the event loop, as with the selectors engine
+        if self.commandResultsScheduled: return None
+        self.commandResultsScheduled = True
+        self.loop.call_soon(self.runCommandResults)
+
+    def runCommandResults(self) -> None:
+        self.commandResultsScheduled = False
+        self.serviceCommandResults()
+        if self.slowConsumers: self.disconnectSlowConsumers()
+        if self.commandResults: self.scheduleCommandResults()
+
+    def queueFrame(self, conn: transportConnection, frame: bytes) -> None:
+        if self.metrics is not None: self.bytesOut.inc(len(frame))
+        if conn.queueFrame(frame): self.scheduleFlush(conn)
+        if conn.outboundBytes > self.outboundHighWatermark and conn.paused: self.relieveBackpressure(conn)
+
+    def scheduleFlush(self, conn: transportConnection) -> None:
+        self.pendingFlush.add(conn)
+        if self.flushScheduled: return None
+        self.flushScheduled = True
+        self.loop.call_at(max(self.loop.time(), self.nextFlush), self.runFlush)
+
+    def runFlush(self) -> None:
+        self.flushScheduled = False
+        self.nextFlush = self.loop.time() + self.flushInterval
+        pendingFlush = list(self.pendingFlush)
+        self.pendingFlush.clear()
+        for conn in pendingFlush:
+            if conn.closed: continue
+            if conn.flushFrames() and self.metrics is not None: self.sendCalls.inc()
+
+    def scheduleTimer(self, deadline: float, callback: Callable[[transportConnection], None], conn: transportConnection) -> timer:
+        entry = super().scheduleTimer(deadline, callback, conn)
+        visit = self.timers.visitTime(deadline)
+        if self.timerHandle is None or visit < self.timerVisit: self.scheduleTimers(visit)
+        return entry
+
+    def scheduleTimers(self, visit: Optional[float]) -> None:
+        ## The loop's own clock may differ from time.monotonic() (as with uvloop), so the handle is scheduled with a delay
+        if self.timerHandle is not None: self.timerHandle.cancel()
+        self.timerHandle = None if visit is None else self.loop.call_later(max(0.0, visit - time.monotonic()), self.runTimers)
+        self.timerVisit = visit or 0.0
+
+    def runTimers(self) -> None:
+        self.timerHandle = None
+        self.timers.advance(time.monotonic())
+        self.scheduleTimers(self.timers.nextDeadline())
+
+    def reapConnection(self, user: Optional[str], conn: transportConnection) -> None:
+        ## The transport is aborted, as closing it would wait for its buffer to be flushed to a peer that is gone
+        conn.clearOutbound()
+        self.closeSession(user, conn)
+        conn.transport.abort()
+        self.scheduleBroadcast()
+
+    def resumeWriting(self, conn: transportConnection) -> None:
+        ## Called once the transport's buffer has drained below its low watermark
+        if conn.closed: return None
+        conn.paused = False
+        conn.flushFrames()
+        if conn.congested and not conn.paused: self.endCongestion(conn)
+
+    def disconnectSlowConsumer(self, user: Optional[str], conn: transportConnection) -> None:
+        ## The transport's buffer is discarded rather than flushed, as the client is not reading it, so unlike the selectors
+        ## engine no Session-Termination frame can be sent ahead of the disconnection
+        conn.clearOutbound()
+        self.closeSession(user, conn)
+        conn.transport.abort()
+
+    def detachConnection(self, conn: transportConnection) -> None:
+        pass
+
+    def closeAfterFlush(self, conn: transportConnection) -> None:
+        conn.closing = True
+        self.connections.unregisterConnection(conn)
+        self.pendingFlush.discard(conn)
+        self.pendingReads.discard(conn)
+        self.releaseTimers(conn)
+        conn.close()
+
+    def closeRemainingConnections(self) -> None:
+        for cc in list(self.connections.filenoToConnection.values()):
+            self.connections.unregisterConnection(cc)
+            cc.close()
+
+    def exit(self) -> None:
+        ## The server may be stopped from a signal handler or another thread, so the event loop is woken up safely
+        self.eventLoopFlag = False
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stopEvent.set)
@@ -0,0 +1,113 @@
+import asyncio
+from typing import Dict, Optional, Union
+from message import frameConnection, frameDecoder, request, formatResume, COMPRESSION_METHODS
+
+##A headless client for the chat server built on asyncio streams, which the terminal client and scripted bots share
+##--> connect() opens the connection and registers the user, negotiating the protocol version and compression
+##--> send() and command() write a frame, and only wait if the socket's buffer is full
+##--> Updates are read with receive(), or by iterating over the client, until the connection is closed
+##--> The last sequence number received in each room is tracked, so calling connect() again after the connection was lost
+##    resumes the session, and the server sends only the chat that was missed (or a Gap notice if it is no longer held)
+##NOTE: Nothing blocks a thread, so thousands of clients can run as tasks of a single event loop
+##Usage:
+##  client = chatClient("alice")
+##  await client.connect("127.0.0.1", 8000)
+##  await client.send("Hello")
+##  async for update in client: print(update["Body"])
+
+Frame = Dict[str, Union[Dict[str, str], str]]
+
+
+class chatClient(frameConnection):
+    def __init__(self, user: str, protocol: int = 2, compression: bool = True, readSize: int = 65536) -> None:
+        super().__init__(bufferSize=0) ## The stream reader receives into its own buffer
+        self.user: str = user
+        self.offeredProtocol: int = protocol ## The highest protocol version that is offered to the server
+        self.offeredCompression: bool = compression ## Whether the server may compress the frames that it sends
+        self.readSize: int = readSize
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.room: Optional[str] = None ## The room that messages are sent to, where None is the server's default room
+        self.sequences: Dict[Optional[str], int] = {} ## The last sequence number received in each room the user is in
+
+    async def connect(self, host: str, port: int) -> Frame:
+        ## Each connection starts with the text protocol, and negotiates the protocol version and compression again
+        self.protocol, self.req, self.decoder = 1, request(), frameDecoder(0)
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        return await self.register()
+
+    async def register(self) -> Frame:
+        ## Returns the server's acknowledgement, and raises ConnectionError if the session was rejected
+        headers = {"Protocol": str(self.offeredProtocol)}
+        if self.offeredCompression: headers["Compression"] = ",".join(COMPRESSION_METHODS)
+        if self.sequences: headers["Resume"] = formatResume(self.sequences)
+        self.write("", "User-Creation", headers)
+        ack = await self.receive()
+        if ack is None or ack["Headers"]["Message-Type"] != "User-Creation":
+            await self.close()
+            raise ConnectionError("The server closed the connection" if ack is None else ack["Body"])
+        ## Servers that do not support a later protocol or compression do not reply with those headers
+        self.setProtocol(int(ack["Headers"].get("Protocol", 1)))
+        if "Compression" in ack["Headers"]: self.setDecompression()
+        return ack
+
+    def write(self, message: str, messageType: str, headers: Optional[Dict[str, str]] = None) -> None:
+        self.writer.write(self.req.createRawRequest(self.user, message, messageType, "Text", headers))
+
+    async def send(self, message: str, room: Optional[str] = None) -> None:
+        self.write(message, "User-Message", self.roomHeaders(room))
+        await self.writer.drain()
+
+    async def command(self, command: str, room: Optional[str] = None) -> None:
+        ## Commands such as /history, /search, /join and /msg, whose replies are received as updates
+        self.write(command, "User-Command", self.roomHeaders(room))
+        await self.writer.drain()
+        self.switchRoom(command)
+
+    def switchRoom(self, command: str) -> None:
+        ## Messages are sent to the room that was joined last, and to the default room once it has been left
+        name, _, argument = command.strip().partition(" ")
+        if name == "/join" and argument.strip():
+            self.room = argument.strip()
+        elif name == "/leave" and argument.strip() in ("", self.room):
+            self.room = None
+
+    def roomHeaders(self, room: Optional[str]) -> Optional[Dict[str, str]]:
+        room = self.room if room is None else room
+        return None if room is None else {"Room": room}
+
+    async def receive(self) -> Optional[Frame]:
+        ## Returns the next frame from the server, or None once the connection has been closed
+        while True:
+            for frame in self.bufferedRequests():
+                headers = frame["Headers"]
+                if headers["Message-Type"] == "Ping":
+                    ## The server disconnects clients that stay silent, so its heartbeats are answered without being returned
+                    self.write("", "Pong")
+                    continue
+                if "Sequence" in headers:
+                    ## A gap notice stands in for every chat action that was dropped
+                    self.sequences[headers.get("Room")] = int(headers["Sequence"]) + int(headers.get("Gap", 1)) - 1
+                elif headers.get("Command") == "/leave" and "Room" in headers:
+                    self.sequences.pop(headers["Room"], None)
+                return frame
+            try:
+                data = await self.reader.read(self.readSize)
+            except (ConnectionError, OSError): return None
+            if not data: return None
+            self.decoder.feed(data)
+
+    def __aiter__(self) -> "chatClient":
+        return self
+
+    async def __anext__(self) -> Frame:
+        frame = await self.receive()
+        if frame is None: raise StopAsyncIteration
+        return frame
+
+    async def close(self) -> None:
+        if self.writer is None or self.writer.is_closing(): return None
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError): pass
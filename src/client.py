@@ -1,141 +1,133 @@
 import socket
+import asyncio
 import argparse
-import threading
 from typing import Dict, Optional, Union
 from prompt_toolkit import PromptSession
 from prompt_toolkit.patch_stdout import patch_stdout
-import time
-from message import clientConnection
+from chatClient import chatClient
 
 ##TODO: Go through the code and external libraries to check for potential exceptions
-##BUG: When server disconnects, an error message is only sometimes displayed, always exists though
+##NOTE: The socket and the prompt are multiplexed by a single asyncio event loop, so there are no threads to coordinate
+##      when either the user or the server ends the session. The connection itself is a headless chatClient
 
 class clientMessenger:
-    def __init__(self) -> None:
-        self.sock = self.createClientSocket()
-        self.clientConnection = clientConnection(self.sock)
-        self.exit_flag = threading.Event()
-
-        self.designmessage = \
-        """
-        This application is strictly supported on Windows only, rather than Linux. This is because\n
-        1. No/Limited compatability in terminal interface manipulation between platforms (this extends to TUIs)
-        =====> e.g. GNU Readlines, ncurses, msvcrt, urwid etc.
-        2. Design differences caused by platform  differences
-        =====> e.g. Input() Calls will hang on Windows since you cannot select() stdin to sidestep this issue (unlike Linux)
-        3. Differences in threading
-        =====> e.g. Python daemon Threads fail to be killed during process termination on Linux (unlike Windows)
-        4. Differences in signal
-        =====> e.g. signal.SIGALRM doesn't exist in Windows (unlike), and other signals have different side-effects on different platforms
-
-        Even when there is platform reimplementations, there's often side-effects or bugs
-
-        --> I actually spent more time attempting full cross-compatability the on the actual networking part
-        --> Therefore a conscious design decision was made to stick with a single platform in order to provide a more robust application
-        """
-        
-    def createClientSocket(self) -> None:
-        return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-    def exit(self) -> None: 
-        self.exit_flag.set()
-
-    def close(self) -> None: 
-        try:
-            self.sock.close()
-        except OSError:
-            print(f"Localhost: Underlying issue with releasing connection resources")
-        except socket.error as msg:
-            print(f"Localhost: {str(msg).split(':')[-1].strip()}")
+    def __init__(self, protocol: int = 2, compression: bool = True) -> None:
+        self.protocol = protocol ## The highest protocol version that is offered to the server
+        self.compression = compression ## Whether the server may compress the frames that it sends
+        self.client: Optional[chatClient] = None
+        self.closedByUser: bool = False
 
     def run(self, USER: str, HOST: str, PORT: int) -> None:
-        ##TODO: encapsulate the below lines into a function for sock
-        self.USER = USER
-        self.sock.setblocking(1)
-        if self.connect(HOST, PORT) is False: return
-
-        message =  self.registerUser(USER)
-        self.processRetrievedMessage(message)
-        if self.exit_flag.is_set(): return
-
-        t1 = threading.Thread(target=self.output)
-        t2 = threading.Thread(target=self.input, daemon=True)
-        t1.start()
-        t2.start()
-
-        self.exit_flag.wait()
-        t1.join(0)
-        self.close()
-        
-    def output(self) -> None:
-        while self.exit_flag.is_set() is False:
-            message = self.clientConnection.receiveRequest()
-            self.processRetrievedMessage(message)
+        try:
+            asyncio.run(self.runSession(USER, HOST, PORT))
+        except KeyboardInterrupt: pass
 
-    def input(self) -> None:
-        session = PromptSession()
+    async def runSession(self, USER: str, HOST: str, PORT: int) -> None:
+        self.USER, self.HOST, self.PORT = USER, HOST, PORT
+        self.client = chatClient(USER, self.protocol, self.compression)
+        if await self.connect(HOST, PORT) is False: return None
         with patch_stdout():
-            while self.exit_flag.is_set() is False:
-                try:
-                    result = session.prompt(f"{self.USER}: ", )
-                    if self.exit_flag.is_set() is True: break
-                    self.clientConnection.sendRequest(user=self.USER, message=result)
-                except KeyboardInterrupt:
-                    self.exit_flag.set()
+            ## The session ends once either the server closes the connection or the user leaves the prompt
+            tasks = {asyncio.ensure_future(self.output()), asyncio.ensure_future(self.input())}
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in tasks: task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        await self.client.close()
+
+    async def output(self) -> None:
+        while True:
+            async for message in self.client:
+                if self.processRetrievedMessage(message) is False: return None
+            if await self.reconnect() is False: return self.terminateSession(None)
+
+    async def reconnect(self, attempts: int = 3) -> bool:
+        ## The connection was lost rather than closed by the server, so the session is resumed from the last sequence number
+        ## received in each room. The server may not have noticed the loss yet, so the username can still be in use for a moment
+        for attempt in range(attempts):
+            print("Localhost: The connection was lost, reconnecting")
+            await asyncio.sleep(0.5 * 2 ** attempt)
+            try:
+                await self.client.connect(self.HOST, self.PORT)
+            except (ConnectionError, OSError): continue
+            print("Localhost: Reconnected, any messages that were missed follow")
+            return True
+        return False
 
-    def connect(self, HOST: str, PORT: int) -> bool:
+    async def input(self) -> None:
+        session = PromptSession()
+        while True:
+            try:
+                result = await session.prompt_async(f"{self.USER}: ")
+            except (KeyboardInterrupt, EOFError):
+                self.closedByUser = True
+                return self.terminateSession(None)
+            ## Lines starting with a slash are commands, such as /history, /search, /from, /since, /join, /leave and /rooms
+            try:
+                if result.startswith("/"):
+                    await self.client.command(result)
+                else:
+                    await self.client.send(result)
+            except (ConnectionError, OSError):
+                print("Localhost: The message could not be sent, as the connection was lost")
+
+    async def connect(self, HOST: str, PORT: int) -> bool:
+        print(f"Localhost: Attempting to register with name '{self.USER}'")
         try:
-            self.sock.connect((HOST, PORT))
-            return True
+            ack = await self.client.connect(HOST, PORT)
         except ConnectionRefusedError:
             print("Localhost: The target machine is refusing connections")
+            return False
         except socket.gaierror:
             print("Localhost: Failed to resolve the provided hostname")
-        except socket.error as msg:
+            return False
+        except ConnectionError:
+            ## Raised once the server rejects the registration, or closes the connection instead of replying
+            print("Server: The Server has rejected the session-creation")
+            return False
+        except OSError as msg:
             print(f"Localhost: {str(msg).split(':')[-1].strip()}")
-        return False
+            return False
+        self.displayMessage(ack)
+        return True
 
-    def registerUser(self, USER: str) -> Optional[str]:
-        print(f"Localhost: Attempting to register with name '{USER}'")
-        self.clientConnection.sendRequest(user=USER, messageType="User-Creation")
-        return self.clientConnection.receiveRequest()
-
-    def processRetrievedMessage(self, message: Optional[Dict[str, Union[Dict[str, str], str]]]) -> None:
-        violatingTypes = {"Session-Rejection"}
+    def processRetrievedMessage(self, message: Optional[Dict[str, Union[Dict[str, str], str]]]) -> bool:
+        ## Returns whether the session continues
+        violatingTypes = {"Session-Rejection", "Session-Termination"}
         if message == None or message["Headers"]["Message-Type"] in violatingTypes:
             self.terminateSession(message)
-        else:
-            self.displayMessage(message) ## TODO: Maybe perform more than just display
+            return False
+        self.displayMessage(message) ## TODO: Maybe perform more than just display
+        return True
 
     def displayMessage(self, message: Dict[str, Union[Dict[str, str], str]]) -> None:
-        print(message["Body"])
-    
-    def terminateSession(self, message):
-        if message == None and self.exit_flag.is_set():
+        headers = message["Headers"]
+        if "Direct" in headers:
+            print(f"[direct] {message['Body']}")
+        else:
+            print(message["Body"] if headers.get("Room") is None else f"[{headers['Room']}] {message['Body']}")
+
+    def terminateSession(self, message: Optional[Dict[str, Union[Dict[str, str], str]]]) -> None:
+        if message == None and self.closedByUser:
             print("Localhost: The Client has terminated the session")
-        elif message == None and not self.exit_flag.is_set():
-            print("Localhost: The Server has disconnected from the session", flush=True)
-            ## NOTE: The prompt_toolkit library logic with the hanging "input/prompt" thread causes a bug
-            ## FIXED: By context switching and then printing, the outcome of this bug is circumvented
-            self.exit_flag.wait(0.04)
-            print("\r\n", flush=True)
+        elif message == None:
+            print("Localhost: The Server has disconnected from the session")
         elif message["Headers"]["Message-Type"] == "Session-Rejection":
             print("Server: The Server has rejected the session-creation")
         elif message["Headers"]["Message-Type"] == "Session-Termination":
             print("Server: The Server has terminated the session")
-        # time.sleep(5)
-        self.exit_flag.set()
-            
+
 def parseArguments() -> None:
     parser = argparse.ArgumentParser(description="A application to provide IM services to clients")
     parser.add_argument("user", type=str)
     parser.add_argument("host", type=str)
     parser.add_argument("port", type=int)
+    parser.add_argument("--protocol", type=int, choices=[1, 2], default=2, help="The highest protocol version to offer the server")
+    parser.add_argument("--no-compression", action="store_true", help="Do not let the server compress the frames that it sends")
     return parser.parse_args()
 
 def main():
     args = parseArguments()
-    cm = clientMessenger()
+    cm = clientMessenger(args.protocol, not args.no_compression)
     cm.run(args.user, args.host, args.port)
 
 if __name__ == "__main__":
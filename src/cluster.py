@@ -0,0 +1,368 @@
+import os
+import selectors
+import signal
+import socket
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+from message import clientConnection, negotiateProtocol, parseResume, request
+from directMessages import mailboxes, DirectMessage
+from server import chatObject, messengingServer, createListeningSocket, DEFAULT_ROOM, ROOM_NAME_PATTERN, USERNAME_PATTERN
+from eventLog import eventLog
+
+##A multi-process mode, in which K forked workers each run the messengingServer loop on a shared listening socket
+##The parent process runs the messageBus, which the workers are connected to over Unix domain sockets
+##--> Every chat append is sent to the bus, which relays it to every worker (including the sender) in the order received
+##    so the bus acts as a sequencer, and each worker's chatObject applies the same appends in the same global order
+##--> Usernames are reserved with the bus before a session is created, so they stay unique across workers. The worker
+##    carries on serving its other connections meanwhile, and creates (or rejects) the session once the bus has answered
+##--> Neither end ever blocks on the other: each queues its frames, and a worker whose queue on the bus passes the
+##    --outbound-high-watermark pauses the bus' reads from every worker until it has drained to the low watermark
+##--> Appends carry the name of their room, and every worker keeps a replica of every room (even those without local members)
+##--> Direct messages are routed by the bus to the worker that the recipient is connected to, and the bus holds the
+##    mailboxes of offline users, which it replays to a worker once the recipient has reserved their name there
+##NOTE: The bus messages reuse the chat protocol (frames, frameDecoder and the outbound queues of clientConnection)
+##NOTE: Names are carried in the bus' headers, so both ends check them against USERNAME_PATTERN before routing, and a
+##      worker that sends the bus a frame it can not decode or service is dropped rather than stopping the bus
+##NOTE: This relies on os.fork(), so it is not available on Windows
+##NOTE: The chat history is kept in memory only, as --history-dir is not supported in this mode
+##NOTE: SIGUSR1 (a metrics dump) and SIGUSR2 (a profiling window) are sent to the parent process, the one that was started,
+##      which forwards them to every worker, so each worker dumps its own metrics and writes its own profiles
+FORWARDED_SIGNALS = (signal.SIGUSR1, signal.SIGUSR2) if hasattr(signal, "SIGUSR1") else ()
+
+
+class messageBus:
+    def __init__(self, highWatermark: int = 1048576, lowWatermark: int = 262144) -> None:
+        self.selector: selectors.DefaultSelector = selectors.DefaultSelector()
+        self.workers: List[clientConnection] = []
+        ## Relayed frames can not be dropped without the replicas diverging, so a worker that falls behind instead pauses
+        ## the reads from every worker (which in turn stop reading from their clients once their own buffers fill)
+        self.highWatermark: int = highWatermark
+        self.lowWatermark: int = lowWatermark
+        self.congested: Set[clientConnection] = set() ## The workers whose queues have passed the high watermark
+        self.users: Set[str] = set() ## The usernames that are reserved across every worker
+        self.userWorkers: Dict[str, clientConnection] = {} ## The worker that each reserved username is connected to
+        self.mailboxes: mailboxes = mailboxes()
+        self.encoder: request = request()
+        self.eventLoopFlag: bool = True
+        self.busServices = {"Bus-Append": self.serviceAppend, "Bus-Reserve": self.serviceReserve, "Bus-Release": self.serviceRelease,
+                            "Bus-Direct": self.serviceDirect}
+
+    def addWorker(self, sock: socket.socket) -> None:
+        conn = clientConnection(sock)
+        self.workers.append(conn)
+        self.selector.register(sock, selectors.EVENT_READ, data=conn)
+
+    def removeWorker(self, conn: clientConnection) -> None:
+        ## The names reserved on the worker are released, as its sessions end along with it
+        for user in [user for user, worker in self.userWorkers.items() if worker is conn]:
+            self.users.discard(user)
+            del self.userWorkers[user]
+        self.workers.remove(conn)
+        if conn.sock in self.selector.get_map(): self.selector.unregister(conn.sock)
+        conn.close()
+        if conn in self.congested: self.endCongestion(conn)
+
+    def run(self) -> None:
+        while self.eventLoopFlag and len(self.workers) > 0:
+            for selectorKey, bitmask in self.selector.select(timeout=2.0):
+                conn = selectorKey.data
+                if bitmask & selectors.EVENT_READ:
+                    self.serviceWorker(conn)
+                if bitmask & selectors.EVENT_WRITE and conn in self.workers:
+                    self.flushWorker(conn)
+        for conn in list(self.workers):
+            self.removeWorker(conn)
+
+    def serviceWorker(self, conn: clientConnection) -> None:
+        try:
+            for message in conn.receiveRequests():
+                self.busServices[message["Headers"]["Message-Type"]](conn, message)
+        except (ValueError, KeyError):
+            return self.removeWorker(conn)
+        if conn.eof: self.removeWorker(conn)
+
+    def queueFrame(self, conn: clientConnection, frame: bytes) -> None:
+        if conn.queueFrame(frame): self.setWriteInterest(conn, True)
+        if conn.outboundBytes > self.highWatermark and conn not in self.congested:
+            self.congested.add(conn)
+            if len(self.congested) == 1:
+                for worker in self.workers: self.updateInterest(worker)
+
+    def flushWorker(self, conn: clientConnection) -> None:
+        try:
+            drained = conn.flushFrames()
+        except OSError:
+            return self.removeWorker(conn)
+        if conn in self.congested and conn.outboundBytes <= self.lowWatermark: self.endCongestion(conn)
+        if drained: self.setWriteInterest(conn, False)
+
+    def endCongestion(self, conn: clientConnection) -> None:
+        ## Reads from the workers resume once none of them is still congested
+        self.congested.discard(conn)
+        if len(self.congested) == 0:
+            for worker in self.workers: self.updateInterest(worker)
+
+    def setWriteInterest(self, conn: clientConnection, interest: bool) -> None:
+        if conn.writeInterest == interest: return None
+        conn.writeInterest = interest
+        self.updateInterest(conn)
+
+    def updateInterest(self, conn: clientConnection) -> None:
+        ## As in messengingServer.updateInterest, a worker with neither interest is unregistered
+        events = (0 if self.congested else selectors.EVENT_READ) | (selectors.EVENT_WRITE if conn.writeInterest else 0)
+        registered = conn.sock in self.selector.get_map()
+        if events == 0:
+            if registered: self.selector.unregister(conn.sock)
+        elif registered:
+            self.selector.modify(conn.sock, events, data=conn)
+        else:
+            self.selector.register(conn.sock, events, data=conn)
+
+    def serviceAppend(self, conn: clientConnection, message: Dict) -> None:
+        ## The relayed frame is encoded once and shared between every worker
+        headers = message["Headers"]
+        if not ROOM_NAME_PATTERN.fullmatch(headers["Room"]): raise ValueError(f"Invalid room {headers['Room']}")
+        frame = self.encoder.createRawRequest(headers["User"], message["Body"], "Bus-Append", "Text", {"Visibility": headers["Visibility"], "Room": headers["Room"]})
+        for worker in self.workers:
+            self.queueFrame(worker, frame)
+
+    def serviceReserve(self, conn: clientConnection, message: Dict) -> None:
+        user = message["Headers"]["User"]
+        accepted = user not in self.users and USERNAME_PATTERN.fullmatch(user) is not None
+        self.queueFrame(conn, self.encoder.createRawRequest(user, "Accepted" if accepted else "Rejected", "Bus-Reserved", "Text"))
+        if not accepted: return None
+        self.users.add(user)
+        self.userWorkers[user] = conn
+        dms, dropped = self.mailboxes.collect(user)
+        if dropped > 0:
+            dms.insert(0, DirectMessage(0.0, "Server", user, f"{dropped} direct messages were dropped while you were offline"))
+        for dm in dms:
+            self.queueFrame(conn, self.encodeDirect(dm, {"Replayed": "true"}))
+
+    def serviceRelease(self, conn: clientConnection, message: Dict) -> None:
+        self.users.discard(message["Headers"]["User"])
+        self.userWorkers.pop(message["Headers"]["User"], None)
+
+    def serviceDirect(self, conn: clientConnection, message: Dict) -> None:
+        headers = message["Headers"]
+        dm = DirectMessage(float(headers["Timestamp"]), headers["User"], headers["Recipient"], message["Body"])
+        if not (USERNAME_PATTERN.fullmatch(dm.sender) and USERNAME_PATTERN.fullmatch(dm.recipient)): raise ValueError(f"Invalid recipient {dm.recipient}")
+        worker = self.userWorkers.get(dm.recipient)
+        if worker is None:
+            self.mailboxes.deliver(dm)
+        else:
+            self.queueFrame(worker, self.encodeDirect(dm))
+
+    def encodeDirect(self, dm: DirectMessage, headers: Optional[Dict[str, str]] = None) -> bytes:
+        return self.encoder.createRawRequest(dm.sender, dm.message, "Bus-Direct", "Text", dict(headers or {}, Recipient=dm.recipient, Timestamp=repr(dm.timestamp)))
+
+    def exit(self) -> None:
+        self.eventLoopFlag = False
+
+
+class busConnection(clientConnection):
+    ## The worker's end of the bus, where frames are sent as soon as the socket accepts them and are otherwise queued,
+    ## and onBlocked is called so that the worker waits for the socket to be writable
+    __slots__ = ("encoder", "onBlocked")
+
+    def __init__(self, sock: socket.socket) -> None:
+        super().__init__(sock)
+        self.encoder: request = request()
+        self.onBlocked: Optional[Callable[[], None]] = None
+
+    def send(self, frame: bytes) -> None:
+        if not self.queueFrame(frame): return None ## The earlier frames are still waiting for the socket
+        try:
+            if not self.flushFrames() and self.onBlocked is not None: self.onBlocked()
+        except OSError: self.eof = True ## The bus has stopped, which the worker notices as it next reads from it
+
+    def publish(self, user: str, messageString: str, visibility: str, room: str) -> None:
+        self.send(self.encoder.createRawRequest(user, messageString, "Bus-Append", "Text", {"Visibility": visibility, "Room": room}))
+
+    def reserve(self, user: str) -> None:
+        ## The bus answers with Bus-Reserved, after any appends that it relayed before the reservation
+        self.send(self.encoder.createRawRequest(user, "", "Bus-Reserve", "Text"))
+
+    def sendDirect(self, dm: DirectMessage) -> None:
+        if not (USERNAME_PATTERN.fullmatch(dm.sender) and USERNAME_PATTERN.fullmatch(dm.recipient)): raise ValueError(f"{dm.recipient} is not a valid username")
+        self.send(self.encoder.createRawRequest(dm.sender, dm.message, "Bus-Direct", "Text", {"Recipient": dm.recipient, "Timestamp": repr(dm.timestamp)}))
+
+    def release(self, user: str) -> None:
+        self.send(self.encoder.createRawRequest(user, "", "Bus-Release", "Text"))
+
+
+class replicatedChatObject(chatObject):
+    ## Appends are published to the bus, and only applied to the chat once the bus has relayed them back
+    def __init__(self, bus: busConnection, capacity: int = 4096, maxBytes: Optional[int] = None, name: str = DEFAULT_ROOM) -> None:
+        super().__init__(capacity, maxBytes, name)
+        self.bus: busConnection = bus
+
+    def appendChat(self, user: str, messageString: str, visibility: str) -> None:
+        self.bus.publish(user, messageString, visibility, self.name)
+
+    def applyChat(self, user: str, messageString: str, visibility: str) -> NamedTuple:
+        return super().appendChat(user, messageString, visibility)
+
+
+class clusterWorker(messengingServer):
+    def __init__(self, bus: busConnection, listener: socket.socket) -> None:
+        self.bus: busConnection = bus ## Set before the default room is created, as rooms publish to the bus
+        self.listener: socket.socket = listener
+        super().__init__()
+        self.bus.onBlocked = self.watchBusWrites
+        ## The connections waiting for the bus to answer their User-Creation, and the headers they sent with it
+        self.reservations: Dict[str, Tuple[clientConnection, Dict[str, str]]] = {}
+        self.userServices["User-Creation"] = self.serviceClusterUserCreation
+
+    def run(self, args) -> None:
+        self.args = args
+        self.resetRooms()
+        self.eventLog = eventLog(self.logfile, args.log_format, args.log_queue_size)
+        self.configureDelivery(args)
+        self.configureTimeouts(args)
+        self.configureLimits(args)
+        self.configureSockets(args)
+        self.configureProfiling(args)
+        if args.metrics: self.enableMetrics(f"{args.metrics_file}.{os.getpid()}")
+        if self._setup(args.port, args.host) is False: return False
+        self.selector.register(self.bus.sock, selectors.EVENT_READ, data="Bus")
+        return self._executeEventLoop()
+
+    def createChatObject(self, name: str) -> chatObject:
+        if self.args is None: return replicatedChatObject(self.bus, name=name)
+        return replicatedChatObject(self.bus, self.args.chat_capacity, self.args.chat_max_bytes, name)
+
+    def removeRoom(self, room: chatObject) -> None:
+        ## Rooms are kept once created, as their appends are still relayed from the other workers
+        pass
+
+    def createServerSocket(self) -> bool:
+        ## Every worker shares the listening socket that was created before forking
+        self.serverSocket = self.listener
+        return True
+
+    def serviceSelectorKey(self, selectorKey: selectors.SelectorKey, bitmask: int) -> None:
+        if selectorKey.data != "Bus": return None
+        if bitmask & selectors.EVENT_READ:
+            for message in self.bus.receiveRequests():
+                self.applyBusMessage(message)
+            if self.bus.eof: return self.exit()
+        if bitmask & selectors.EVENT_WRITE:
+            try:
+                drained = self.bus.flushFrames()
+            except OSError:
+                return self.exit()
+            if drained: self.selector.modify(self.bus.sock, selectors.EVENT_READ, data="Bus")
+
+    def watchBusWrites(self) -> None:
+        self.selector.modify(self.bus.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, data="Bus")
+
+    def applyBusMessage(self, message: Dict) -> None:
+        headers = message["Headers"]
+        if headers["Message-Type"] == "Bus-Append":
+            self.getRoom(headers["Room"]).applyChat(headers["User"], message["Body"], headers["Visibility"])
+        elif headers["Message-Type"] == "Bus-Reserved":
+            self.finishReservation(headers["User"], message["Body"] == "Accepted")
+        elif headers["Message-Type"] == "Bus-Direct":
+            dm = DirectMessage(float(headers["Timestamp"]), headers["User"], headers["Recipient"], message["Body"])
+            conn = self.connections.userToConnection.get(dm.recipient)
+            if conn is None:
+                ## The recipient has just left, and the bus will have released them by the time this arrives
+                return self.bus.sendDirect(dm)
+            self.deliverDirectMessage(conn, dm, {"Sent": f"{dm.timestamp:.3f}"} if "Replayed" in headers else None)
+
+    def serviceClusterUserCreation(self, **kwargs) -> None:
+        user, conn = kwargs["user"], kwargs["conn"]
+        if not USERNAME_PATTERN.fullmatch(user) or user in self.connections.userToConnection or user in self.reservedNames or user in self.reservations:
+            return self.rejectSessionCreation(user, conn)
+        ## Nothing more is read from the connection until the bus has answered, and any frames that the client pipelined
+        ## behind its User-Creation are left buffered until then
+        self.reservations[user] = (conn, kwargs["headers"])
+        self.setReadInterest(conn, False)
+        self.bus.reserve(user)
+
+    def finishReservation(self, user: str, accepted: bool) -> None:
+        conn, headers = self.reservations.pop(user)
+        if conn.closing or not self.connections.isRegistered(conn):
+            ## The connection was closed (e.g. by the handshake timeout) while the bus was answering
+            if accepted: self.bus.release(user)
+            return None
+        if not accepted: return self.rejectSessionCreation(user, conn)
+        self.createSession(user, conn, negotiateProtocol(headers), self.negotiateCompression(headers), parseResume(headers))
+        ## The bus replays the user's mailbox right after the reservation, so it is delivered once the session exists
+        self.setReadInterest(conn, True)
+        self.pendingReads.add(conn)
+
+    def routeDirectMessage(self, dm: DirectMessage) -> bool:
+        ## The recipient may be connected to any worker, so the message is routed by the bus
+        self.bus.sendDirect(dm)
+        return True
+
+    def replayMailbox(self, user: str, conn: clientConnection) -> None:
+        ## The mailboxes are held by the bus
+        pass
+
+    def closeSession(self, user: Optional[str], conn: clientConnection) -> None:
+        registered = user is not None and self.connections.userToConnection.get(user) is conn
+        super().closeSession(user, conn)
+        if registered: self.bus.release(user)
+
+
+class clusterServer:
+    def __init__(self) -> None:
+        self.bus: messageBus = messageBus()
+        self.workerPids: List[int] = []
+
+    def run(self, args) -> None:
+        self.bus.highWatermark = args.outbound_high_watermark
+        self.bus.lowWatermark = min(args.outbound_low_watermark, args.outbound_high_watermark)
+        if not hasattr(os, "fork"):
+            print("Multi-process mode is not supported on this platform")
+            return False
+        if args.history_dir is not None:
+            ## Every worker holds a replica of the chat, so there is no single writer for the history files
+            print("The chat history is not persisted in multi-process mode")
+        try:
+            listener = createListeningSocket(args.host, args.port, args.backlog, args.send_buffer, args.receive_buffer)
+        except OSError as e:
+            print(f"Socket Setup Error: {e}")
+            return False
+        ## The forwarding handlers are installed before forking, so that the parent is never killed by a signal in the meantime
+        for signum in FORWARDED_SIGNALS: signal.signal(signum, self.forward_handler)
+        for _ in range(args.workers):
+            busEnd, workerEnd = socket.socketpair()
+            pid = os.fork()
+            if pid == 0:
+                ## The worker ignores them until it has installed its own handlers
+                for signum in FORWARDED_SIGNALS: signal.signal(signum, signal.SIG_IGN)
+                busEnd.close()
+                self.bus.selector.close()
+                for conn in self.bus.workers: conn.sock.close()
+                clusterWorker(busConnection(workerEnd), listener).run(args)
+                os._exit(0)
+            workerEnd.close()
+            self.bus.addWorker(busEnd)
+            self.workerPids.append(pid)
+        listener.close()
+
+        print(f"Server listening on {args.host}:{args.port} with {args.workers} workers\n\n")
+        signal.signal(signal.SIGINT, self.sig_handler)
+        signal.signal(signal.SIGTERM, self.sig_handler)
+        self.bus.run()
+        self.stopWorkers()
+
+    def stopWorkers(self) -> None:
+        for pid in self.workerPids:
+            try:
+                os.kill(pid, signal.SIGINT)
+            except ProcessLookupError: pass
+        for pid in self.workerPids:
+            os.waitpid(pid, 0)
+
+    def sig_handler(self, signum, frame) -> None:
+        self.bus.exit()
+
+    def forward_handler(self, signum, frame) -> None:
+        for pid in self.workerPids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError: pass
@@ -0,0 +1,55 @@
+from collections import OrderedDict, deque, namedtuple
+from typing import Any, Deque, Dict, List, Tuple
+
+##Direct messages never enter a room's log, so they are never visited by a broadcast or seen by any other user
+##--> A direct message to an online user is queued straight onto their connection, found by username
+##--> A direct message to an offline user is held in their mailbox, which is replayed when they next create a session
+##NOTE: Each mailbox holds at most capacity messages (the oldest are dropped first), and at most maxMailboxes are held
+##      (the least recently written to is dropped first), so offline buffering is bounded however many users are messaged
+
+DirectMessage = namedtuple("DirectMessage", ["timestamp", "sender", "recipient", "message"])
+
+
+class mailboxes:
+    def __init__(self, capacity: int = 100, maxMailboxes: int = 10000) -> None:
+        self.capacity: int = capacity
+        self.maxMailboxes: int = maxMailboxes
+        self.boxes: "OrderedDict[str, Deque[DirectMessage]]" = OrderedDict()
+        self.dropped: Dict[str, int] = {} ## The number of messages dropped from each mailbox
+        self.droppedMailboxes: int = 0
+
+    def __len__(self) -> int:
+        return sum(len(box) for box in self.boxes.values())
+
+    def deliver(self, dm: DirectMessage) -> None:
+        box = self.boxes.get(dm.recipient)
+        if box is None:
+            if len(self.boxes) == self.maxMailboxes: self.dropMailbox()
+            box = self.boxes[dm.recipient] = deque()
+        else:
+            self.boxes.move_to_end(dm.recipient)
+        if len(box) == self.capacity:
+            box.popleft()
+            self.dropped[dm.recipient] = self.dropped.get(dm.recipient, 0) + 1
+        box.append(dm)
+
+    def dropMailbox(self) -> None:
+        recipient, _ = self.boxes.popitem(last=False)
+        self.dropped.pop(recipient, None)
+        self.droppedMailboxes += 1
+
+    def collect(self, recipient: str) -> Tuple[List[DirectMessage], int]:
+        ## Empties the recipient's mailbox, returning its messages and the number that were dropped from it
+        box = self.boxes.pop(recipient, None)
+        return ([] if box is None else list(box)), self.dropped.pop(recipient, 0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        ## The held messages, as plain data, for a server that is handing its sessions over to another process
+        return {"boxes": {recipient: [list(dm) for dm in box] for recipient, box in self.boxes.items()},
+                "dropped": self.dropped, "droppedMailboxes": self.droppedMailboxes}
+
+    def restore(self, state: Dict[str, Any]) -> None:
+        for recipient, box in state["boxes"].items():
+            self.boxes[recipient] = deque(DirectMessage(*dm) for dm in box)
+        self.dropped.update(state["dropped"])
+        self.droppedMailboxes = state["droppedMailboxes"]
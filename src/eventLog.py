@@ -0,0 +1,124 @@
+import json
+import struct
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Iterator, List, Optional, Tuple, Union
+from message import encodeVarint, decodeVarint
+
+##An event log that keeps disk I/O and formatting off the event loop
+##--> The event loop only appends a compact record (a monotonic timestamp, the cached peer address, the user and the event)
+##    to a bounded queue, which costs a deque append and no syscalls
+##--> A background writer thread drains the queue in batches, formats the records as JSONL or a compact binary form and
+##    writes each batch with a single write(), either once batchSize records are queued or every flushInterval seconds
+##NOTE: Records are dropped (and counted) rather than queued without bound when the writer falls behind, so that a slow
+##      disk can never stall message delivery or grow the server's memory
+
+EventRecord = Tuple[float, str, Union[int, str], Optional[str], str, str]
+LOG_FORMATS = ("jsonl", "binary")
+BINARY_TIMESTAMP = struct.Struct("<d")
+
+
+class eventLog:
+    def __init__(self, path: str = "server.log", logFormat: str = "jsonl", maxQueue: int = 65536,
+                 batchSize: int = 512, flushInterval: float = 0.5) -> None:
+        self.path: str = path
+        self.logFormat: str = logFormat
+        self.maxQueue: int = maxQueue
+        self.batchSize: int = batchSize
+        self.flushInterval: float = flushInterval
+        self.records: Deque[EventRecord] = deque()
+        self.dropped: int = 0 ## Only the event loop increments this, and only the writer reads it
+        self.reportedDrops: int = 0
+        self.written: int = 0
+        self.batches: int = 0
+        self.epochOffset: float = time.time() - time.monotonic() ## Converts the monotonic timestamps to wall-clock time
+        self.wakeup: threading.Event = threading.Event()
+        self.stopping: bool = False
+        self.writer: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self.writer is not None: return None
+        self.writer = threading.Thread(target=self.writeLoop, name="eventLog-writer", daemon=True)
+        self.writer.start()
+
+    def log(self, host: str, port: Union[int, str], user: Optional[str], eventType: str, description: str) -> None:
+        ## Called on the event loop, so this does no formatting and no I/O
+        records = self.records
+        if len(records) >= self.maxQueue:
+            self.dropped += 1
+            return None
+        records.append((time.monotonic(), host, port, user, eventType, description))
+        if len(records) == self.batchSize: self.wakeup.set()
+
+    def close(self, timeout: float = 5.0) -> None:
+        ## The writer drains every queued record before it stops
+        if self.writer is None: return None
+        self.stopping = True
+        self.wakeup.set()
+        self.writer.join(timeout)
+        self.writer = None
+
+    def writeLoop(self) -> None:
+        with open(self.path, "ab") as file:
+            while True:
+                self.wakeup.wait(self.flushInterval)
+                self.wakeup.clear()
+                stopping = self.stopping
+                self.writeBatch(file)
+                if stopping: return None
+
+    def writeBatch(self, file) -> None:
+        records, batch = self.records, []
+        while records:
+            batch.append(records.popleft())
+        dropped = self.dropped - self.reportedDrops
+        if dropped > 0:
+            ## The drops are recorded in the log itself, so a gap in the log is never silent
+            self.reportedDrops += dropped
+            batch.append((time.monotonic(), "", "", "Server", "Log-Records-Dropped", str(dropped)))
+        if len(batch) == 0: return None
+        file.write(self.encodeBatch(batch))
+        file.flush()
+        self.written += len(batch)
+        self.batches += 1
+
+    def encodeBatch(self, batch: List[EventRecord]) -> bytes:
+        if self.logFormat == "binary":
+            return b"".join(self.encodeBinaryRecord(record) for record in batch)
+        offset = self.epochOffset
+        return "".join(json.dumps({"time": round(timestamp + offset, 6), "host": host, "port": port, "user": user,
+                                   "event": eventType, "description": description}, ensure_ascii=False) + "\n"
+                       for timestamp, host, port, user, eventType, description in batch).encode("utf-8")
+
+    def encodeBinaryRecord(self, record: EventRecord) -> bytes:
+        ## A record is a varint length, followed by a little-endian double timestamp and five varint-length prefixed strings
+        timestamp, *fields = record
+        body = [BINARY_TIMESTAMP.pack(timestamp + self.epochOffset)]
+        for field in fields:
+            encoded = ("" if field is None else str(field)).encode("utf-8")
+            body.append(encodeVarint(len(encoded)))
+            body.append(encoded)
+        body = b"".join(body)
+        return encodeVarint(len(body)) + body
+
+
+def readBinaryLog(path: str) -> Iterator[Dict[str, Union[float, str]]]:
+    ## Decodes a log written in the binary format into the same fields as the JSONL format
+    with open(path, "rb") as file:
+        data = file.read()
+    position = 0
+    while position < len(data):
+        length, position = decodeVarint(data, position)
+        if length is None or position + length > len(data): raise ValueError("Truncated log record")
+        end = position + length
+        timestamp, = BINARY_TIMESTAMP.unpack_from(data, position)
+        position += BINARY_TIMESTAMP.size
+        fields = []
+        for _ in range(5):
+            size, position = decodeVarint(data, position)
+            fields.append(data[position:position + size].decode("utf-8"))
+            position += size
+        if position != end: raise ValueError("Malformed log record")
+        host, port, user, eventType, description = fields
+        yield {"time": timestamp, "host": host, "port": port, "user": user, "event": eventType, "description": description}
@@ -0,0 +1,62 @@
+import base64
+import json
+import socket
+import struct
+from typing import Dict, List, Tuple
+
+##A running server hands its listening socket, every client socket and the state of their sessions over to a newly
+##started server process, so that it can be restarted (e.g. to upgrade it) without any client noticing
+##--> The old server listens on a Unix socket (its handoff socket), and a new server started with --takeover connects to it
+##--> The old server sends the state as a length-prefixed JSON document, followed by the file descriptors with SCM_RIGHTS,
+##    in batches of up to HANDOFF_FD_BATCH per message, in the order that the state lists the connections
+##--> The new server acknowledges once it has restored every session, but does not serve them yet. Only then does the old
+##    server stop, closing its own copies of the descriptors without shutting the sockets down (so the connections stay
+##    open in the new server), and once it has, it commits the handoff, upon which the new server starts serving
+##NOTE: If the new server fails, or never acknowledges, the old server carries on serving as if nothing had happened, and
+##      a new server that is not sent the commit (such as when its acknowledgement came too late) gives the sockets up,
+##      so the two servers never serve the same connections
+HANDOFF_FD_BATCH = 250 ## Linux accepts at most 253 descriptors (SCM_MAX_FD) in a single message
+HANDOFF_HEADER = struct.Struct("!Q")
+HANDOFF_ACK = b"K"
+HANDOFF_COMMIT = b"C"
+
+def sendHandoff(sock: socket.socket, state: Dict, fds: List[int]) -> None:
+    state["descriptors"] = len(fds)
+    document = json.dumps(state, separators=(",", ":")).encode("utf-8")
+    sock.sendall(HANDOFF_HEADER.pack(len(document)) + document)
+    ## Each batch of descriptors rides on a single byte, as ancillary data can not be sent without any data
+    for offset in range(0, len(fds), HANDOFF_FD_BATCH):
+        socket.send_fds(sock, [b"F"], fds[offset:offset + HANDOFF_FD_BATCH])
+
+def receiveHandoff(sock: socket.socket) -> Tuple[Dict, List[int]]:
+    ## Returns the state and the file descriptors that were sent with sendHandoff()
+    size = HANDOFF_HEADER.unpack(receiveExactly(sock, HANDOFF_HEADER.size))[0]
+    state = json.loads(receiveExactly(sock, size))
+    fds: List[int] = []
+    while len(fds) < state["descriptors"]:
+        data, received, flags, _ = socket.recv_fds(sock, 1, HANDOFF_FD_BATCH)
+        fds.extend(received)
+        if not data or flags & socket.MSG_CTRUNC:
+            ## Such as running into this process's file descriptor limit, in which case none of them are kept
+            for fd in fds: closeDescriptor(fd)
+            raise ConnectionError(f"Received {len(fds)} of {state['descriptors']} file descriptors")
+    return state, fds
+
+def receiveExactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 1048576))
+        if not chunk: raise ConnectionError("The handoff socket was closed")
+        data += chunk
+    return bytes(data)
+
+def closeDescriptor(fd: int) -> None:
+    try:
+        socket.close(fd)
+    except OSError: pass
+
+def encodeBytes(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii")
+
+def decodeBytes(data: str) -> bytes:
+    return base64.b64decode(data)
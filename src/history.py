@@ -0,0 +1,427 @@
+import bisect
+import mmap
+import os
+import struct
+import time
+import zlib
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional
+from message import encodeVarint, decodeVarint
+from search import chatIndex, tokenize
+from server import ChatAction, chatObject, DEFAULT_ROOM
+
+##A durable, append-only chat history that sits behind the in-memory chatObject
+##--> Chat actions are appended to segment files, which are named after the sequence number of their first chat action
+##    and rolled over once they reach segmentBytes (or once their first chat action is older than segmentSeconds), so that
+##    old history can be retired a whole file at a time
+##--> Appends are buffered and written by commit(), which the server calls once per iteration of its event loop, so the
+##    write() and fsync() cost is shared by every chat action logged during that iteration (group commit)
+##--> With a syncInterval, commit() only fsyncs once the interval has passed, and the server's timer calls maintain()
+##    periodically to sync whatever is left once the appends stop, and to roll and retire segments on a quiet server
+##NOTE: Chat actions are only durable once synced, so with a syncInterval they may be delivered before they are durable
+##--> Every indexInterval chat actions, a (sequence, timestamp, offset) entry is added to the segment's sparse index
+##    so that a read can seek close to a sequence number or time, and decode forward from there
+##--> Reads map the segment files with mmap, and decode the records straight from the mapping
+##--> Only the newest chat actions are indexed in memory (the index window), and queries that reach further back carry on
+##    by scanning the segment files, so the memory held by the index does not grow with the history
+##NOTE: A record is a varint length, a CRC32 and the body, so a record torn by a crash is detected and truncated on startup
+
+TIMESTAMP = struct.Struct("<d")
+CHECKSUM = struct.Struct("<I")
+INDEX_ENTRY = struct.Struct("<QdQ") ## The sequence number, timestamp and file offset of an indexed record
+
+
+def encodeRecord(chat: NamedTuple) -> bytes:
+    fields = [encodeVarint(chat.sequence), TIMESTAMP.pack(chat.timestamp)]
+    for field in (chat.user, chat.message, chat.visibility):
+        encoded = field.encode("utf-8")
+        fields.append(encodeVarint(len(encoded)))
+        fields.append(encoded)
+    body = b"".join(fields)
+    return encodeVarint(len(body)) + CHECKSUM.pack(zlib.crc32(body)) + body
+
+def decodeRecord(view: memoryview, position: int) -> Optional[tuple]:
+    ## Returns the chat action and the offset of the next record, or None if the record is truncated or corrupt
+    length, start = decodeVarint(view, position)
+    if length is None or start + CHECKSUM.size + length > len(view): return None
+    start += CHECKSUM.size
+    end = start + length
+    if zlib.crc32(view[start:end]) != CHECKSUM.unpack_from(view, start - CHECKSUM.size)[0]: return None
+    sequence, position = decodeVarint(view, start)
+    timestamp, = TIMESTAMP.unpack_from(view, position)
+    position += TIMESTAMP.size
+    fields = []
+    for _ in range(3):
+        ## Most fields are shorter than 128 bytes, so their length is a single byte
+        size = view[position]
+        if size < 128: position += 1
+        else: size, position = decodeVarint(view, position)
+        fields.append(str(view[position:position + size], "utf-8"))
+        position += size
+    return ChatAction(sequence, timestamp, *fields), end
+
+
+class segmentFile:
+    def __init__(self, directory: str, baseSequence: int) -> None:
+        self.baseSequence: int = baseSequence
+        self.path: str = os.path.join(directory, f"{baseSequence:020d}.segment")
+        self.indexPath: str = os.path.join(directory, f"{baseSequence:020d}.index")
+        self.size: int = 0 ## The number of bytes of valid records in the file
+        self.nextSequence: int = baseSequence
+        self.lastTimestamp: float = 0.0
+        self.indexSequences: List[int] = []
+        self.indexTimestamps: List[float] = []
+        self.indexOffsets: List[int] = []
+        self.map: Optional[mmap.mmap] = None
+        self.mapSize: int = 0
+
+    def loadIndex(self) -> None:
+        ## Index entries past the end of the valid records are ignored, as the index may be ahead of a torn segment
+        if not os.path.exists(self.indexPath): return None
+        with open(self.indexPath, "rb") as file:
+            data = file.read()
+        for position in range(0, len(data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size):
+            sequence, timestamp, offset = INDEX_ENTRY.unpack_from(data, position)
+            self.addIndexEntry(sequence, timestamp, offset)
+
+    def addIndexEntry(self, sequence: int, timestamp: float, offset: int) -> None:
+        self.indexSequences.append(sequence)
+        self.indexTimestamps.append(timestamp)
+        self.indexOffsets.append(offset)
+
+    def truncateIndex(self) -> None:
+        while self.indexOffsets and self.indexOffsets[-1] >= self.size:
+            self.indexSequences.pop()
+            self.indexTimestamps.pop()
+            self.indexOffsets.pop()
+        with open(self.indexPath, "wb") as file:
+            file.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in zip(self.indexSequences, self.indexTimestamps, self.indexOffsets)))
+
+    def recoverTail(self) -> int:
+        ## Decodes the records after the last index entry, to find the sequence number and timestamp of the last chat
+        ## action, and returns the offset just past it
+        offset = self.indexOffsets[-1] if self.indexOffsets and self.indexOffsets[-1] < self.size else 0
+        validEnd = offset
+        for chat, validEnd in self.records(offset):
+            self.nextSequence, self.lastTimestamp = chat.sequence + 1, chat.timestamp
+        self.unmap()
+        return validEnd
+
+    def view(self) -> memoryview:
+        ## The mapping is recreated when the segment has grown since it was mapped
+        if self.size == 0: return memoryview(b"")
+        if self.map is None or self.mapSize != self.size:
+            self.unmap()
+            with open(self.path, "rb") as file:
+                self.map = mmap.mmap(file.fileno(), self.size, access=mmap.ACCESS_READ)
+            self.mapSize = self.size
+        return memoryview(self.map)
+
+    def unmap(self) -> None:
+        if self.map is None: return None
+        try:
+            self.map.close()
+        except BufferError: pass ## A reader still holds a view, so the mapping is released along with that view
+        self.map = None
+
+    def seekSequence(self, sequence: int) -> int:
+        ## Returns the offset of the last indexed record at or before the sequence number
+        i = bisect.bisect_right(self.indexSequences, sequence) - 1
+        return self.indexOffsets[i] if i >= 0 else 0
+
+    def seekTimestamp(self, timestamp: float) -> int:
+        i = bisect.bisect_left(self.indexTimestamps, timestamp) - 1
+        return self.indexOffsets[i] if i >= 0 else 0
+
+    def records(self, offset: int = 0) -> Iterator[tuple]:
+        ## Yields each chat action along with the offset of the record after it, stopping at the first invalid record
+        view = self.view()
+        try:
+            while offset < self.size:
+                record = decodeRecord(view, offset)
+                if record is None: return None
+                offset = record[1]
+                yield record
+        finally:
+            view.release()
+
+
+class chatHistory:
+    def __init__(self, directory: str, segmentBytes: int = 64 * 1048576, retentionBytes: Optional[int] = None,
+                 retentionSeconds: Optional[float] = None, syncInterval: float = 0.0, indexInterval: int = 128,
+                 segmentSeconds: Optional[float] = None) -> None:
+        self.directory: str = directory
+        self.segmentBytes: int = segmentBytes
+        self.segmentSeconds: Optional[float] = segmentSeconds
+        self.retentionBytes: Optional[int] = retentionBytes
+        self.retentionSeconds: Optional[float] = retentionSeconds
+        self.syncInterval: float = syncInterval ## 0 fsyncs on every commit, otherwise at most once per interval
+        self.indexInterval: int = indexInterval
+        self.segments: List[segmentFile] = []
+        self.pending: bytearray = bytearray() ## Records appended since the last write
+        self.pendingIndex: bytearray = bytearray()
+        self.unsynced: bool = False
+        self.lastSync: float = time.monotonic()
+        self.file = None
+        self.indexFile = None
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def firstSequence(self) -> int:
+        return self.segments[0].baseSequence if self.segments else 0
+
+    @property
+    def nextSequence(self) -> int:
+        return self.segments[-1].nextSequence if self.segments else 0
+
+    def recover(self, capacity: int) -> List[NamedTuple]:
+        ## Rebuilds the segment list, and returns (up to) the last capacity chat actions to seed the in-memory chat
+        ## Each segment is only decoded from its last index entry, so startup does not replay the whole history
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(".segment"))
+        for name in names:
+            segment = segmentFile(self.directory, int(name[:-len(".segment")]))
+            segment.size = os.path.getsize(segment.path)
+            segment.loadIndex()
+            ## The retention by age goes by the last chat action of a segment, as its mtime changes when it is copied
+            validEnd = segment.recoverTail()
+            if self.segments: self.segments[-1].nextSequence = segment.baseSequence
+            self.segments.append(segment)
+        if not self.segments: return []
+
+        newest = self.segments[-1]
+        if validEnd != newest.size:
+            ## The tail of the segment was torn by a crash, so it is truncated back to the last complete record
+            newest.unmap()
+            with open(newest.path, "r+b") as file:
+                file.truncate(validEnd)
+            newest.size = validEnd
+        newest.truncateIndex()
+        return list(self.read(max(self.firstSequence, self.nextSequence - capacity)))
+
+    def append(self, chat: NamedTuple) -> None:
+        if self.file is None: self.openSegment(chat.sequence)
+        segment = self.segments[-1]
+        if (chat.sequence - segment.baseSequence) % self.indexInterval == 0:
+            offset = segment.size + len(self.pending)
+            self.pendingIndex += INDEX_ENTRY.pack(chat.sequence, chat.timestamp, offset)
+            segment.addIndexEntry(chat.sequence, chat.timestamp, offset)
+        self.pending += encodeRecord(chat)
+        segment.nextSequence = chat.sequence + 1
+        segment.lastTimestamp = chat.timestamp
+
+    def commit(self) -> None:
+        ## Writes every pending record with a single write(), and fsyncs them unless one was done within syncInterval
+        self.write()
+        if self.unsynced and time.monotonic() - self.lastSync >= self.syncInterval: self.sync()
+        if self.file is not None and self.rollDue():
+            self.rollSegment()
+            self.compact()
+
+    def maintain(self) -> None:
+        ## Called by the server's timer, so that the tail is synced, and old segments are rolled and retired, even once
+        ## nothing more is appended
+        self.commit()
+        self.compact()
+
+    def rollDue(self) -> bool:
+        segment = self.segments[-1]
+        if segment.size >= self.segmentBytes: return True
+        ## The first chat action of a segment is always indexed, so the index holds its timestamp
+        return self.segmentSeconds is not None and len(segment.indexTimestamps) > 0 and segment.indexTimestamps[0] < time.time() - self.segmentSeconds
+
+    def write(self) -> None:
+        if not self.pending: return None
+        self.file.write(self.pending)
+        self.file.flush()
+        self.indexFile.write(self.pendingIndex)
+        self.indexFile.flush()
+        self.segments[-1].size += len(self.pending)
+        self.pending, self.pendingIndex = bytearray(), bytearray()
+        self.unsynced = True
+
+    def sync(self) -> None:
+        ## The index is not synced, as it can be rebuilt from the segment
+        os.fsync(self.file.fileno())
+        self.unsynced = False
+        self.lastSync = time.monotonic()
+
+    def openSegment(self, sequence: int) -> None:
+        if not self.segments or self.rollDue():
+            self.segments.append(segmentFile(self.directory, sequence))
+        segment = self.segments[-1]
+        self.file = open(segment.path, "ab")
+        self.indexFile = open(segment.indexPath, "ab")
+
+    def rollSegment(self) -> None:
+        ## The full (or aged) segment is sealed, and the next append opens a new one
+        self.sync()
+        self.file.close()
+        self.indexFile.close()
+        self.file = self.indexFile = None
+
+    def compact(self) -> None:
+        ## Retires whole segments once the history exceeds retentionBytes or they are older than retentionSeconds
+        ## NOTE: The newest segment is always retained
+        total = sum(segment.size for segment in self.segments)
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            expired = self.retentionSeconds is not None and oldest.lastTimestamp < time.time() - self.retentionSeconds
+            oversized = self.retentionBytes is not None and total > self.retentionBytes
+            if not (expired or oversized): return None
+            oldest.unmap()
+            os.remove(oldest.path)
+            if os.path.exists(oldest.indexPath): os.remove(oldest.indexPath)
+            total -= oldest.size
+            self.segments.pop(0)
+
+    def read(self, start: int, end: Optional[int] = None) -> Iterator[NamedTuple]:
+        ## Yields the retained chat actions with start <= sequence < end, in order
+        self.write()
+        end = self.nextSequence if end is None else end
+        i = max(0, bisect.bisect_right([segment.baseSequence for segment in self.segments], start) - 1)
+        for segment in self.segments[i:]:
+            if segment.baseSequence >= end: return None
+            for chat, _ in segment.records(segment.seekSequence(start)):
+                if chat.sequence >= end: return None
+                if chat.sequence >= start: yield chat
+
+    def readReversed(self, start: int, end: int) -> Iterator[NamedTuple]:
+        ## Yields the retained chat actions with start <= sequence < end, newest first
+        ## Each segment is decoded backwards a block at a time, where a block is the records between two sparse index entries
+        self.write()
+        for segment in reversed(self.segments):
+            stop = min(end, segment.nextSequence)
+            if stop <= segment.baseSequence: continue
+            if stop <= start: return None
+            i = bisect.bisect_left(segment.indexSequences, stop) - 1
+            while stop > max(start, segment.baseSequence):
+                offset, blockStart = (segment.indexOffsets[i], segment.indexSequences[i]) if i >= 0 else (0, segment.baseSequence)
+                block = []
+                for chat, _ in segment.records(offset):
+                    if chat.sequence >= stop: break
+                    if chat.sequence >= start: block.append(chat)
+                yield from reversed(block)
+                if i < 0: break
+                stop, i = blockStart, i - 1
+
+    def findSequence(self, timestamp: float) -> int:
+        ## Returns the sequence number of the first retained chat action logged at or after the timestamp
+        self.write()
+        i = max(0, bisect.bisect_right([segment.indexTimestamps[0] if segment.indexTimestamps else 0.0 for segment in self.segments], timestamp) - 1)
+        for segment in self.segments[i:]:
+            for chat, _ in segment.records(segment.seekTimestamp(timestamp)):
+                if chat.timestamp >= timestamp: return chat.sequence
+        return self.nextSequence
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.write()
+            self.rollSegment()
+        for segment in self.segments: segment.unmap()
+
+
+class archivedIndex(chatIndex):
+    ## Indexes the newest window chat actions, and answers for the older chat actions in the history by scanning its segments
+    ## NOTE: A query scans at most scanLimit archived chat actions, so a query for a rare term can not stall the event loop,
+    ##       and the timestamp that the scan stopped at is left in scanCutoff so that the user can be told
+    def __init__(self, history: chatHistory, window: int, scanLimit: int = 20000) -> None:
+        super().__init__()
+        self.archive: chatHistory = history
+        self.window: int = window
+        self.scanLimit: int = scanLimit
+
+    def add(self, chat: NamedTuple) -> None:
+        super().add(chat)
+        self.retire(chat.sequence + 1 - self.window)
+
+    def scanArchive(self, matches: Callable[[NamedTuple], bool], limit: int) -> List[int]:
+        ## Returns the newest public chat actions below the index window that match, in order
+        results = []
+        for scanned, chat in enumerate(self.archive.readReversed(self.archive.firstSequence, self.floor)):
+            if scanned == self.scanLimit:
+                self.scanCutoff = chat.timestamp
+                break
+            if chat.visibility == "public" and matches(chat):
+                results.append(chat.sequence)
+                if len(results) == limit: break
+        results.reverse()
+        return results
+
+    def history(self, limit: int) -> List[int]:
+        results = super().history(limit)
+        if len(results) < limit: results[:0] = self.scanArchive(lambda chat: True, limit - len(results))
+        return results
+
+    def fromUser(self, user: str, limit: int) -> List[int]:
+        results = super().fromUser(user, limit)
+        if len(results) < limit: results[:0] = self.scanArchive(lambda chat: chat.user == user, limit - len(results))
+        return results
+
+    def search(self, terms: Iterable[str], limit: int) -> List[int]:
+        terms = set(terms)
+        results = super().search(terms, limit)
+        if len(results) < limit: results[:0] = self.scanArchive(lambda chat: terms <= tokenize(chat.message), limit - len(results))
+        return results
+
+    def since(self, timestamp: float, limit: int) -> List[int]:
+        ## The history's sparse index finds where to start reading, so only the chat actions that are returned are scanned
+        start = bisect.bisect_left(self.sequences, self.floor)
+        if start < len(self.timestamps) and self.timestamps[start] < timestamp: return super().since(timestamp, limit)
+        results = []
+        for scanned, chat in enumerate(self.archive.read(self.archive.findSequence(timestamp), self.floor)):
+            if len(results) == limit: return results
+            if scanned == self.scanLimit:
+                self.scanCutoff = chat.timestamp
+                return results
+            if chat.visibility == "public" and chat.timestamp >= timestamp: results.append(chat.sequence)
+        return results + super().since(timestamp, limit - len(results))
+
+
+class durableChatObject(chatObject):
+    ## The ring buffer holds the recent chat, and chat actions that have been evicted from it are read back from the history
+    def __init__(self, history: chatHistory, capacity: int = 4096, maxBytes: Optional[int] = None, name: str = DEFAULT_ROOM,
+                 indexWindow: Optional[int] = None, scanLimit: int = 20000) -> None:
+        super().__init__(capacity, maxBytes, name)
+        self.history: chatHistory = history
+        self.index: archivedIndex = archivedIndex(history, capacity if indexWindow is None else indexWindow, scanLimit)
+        chats = history.recover(capacity)
+        ## The index window may reach further back than the ring buffer, in which case the rest of it is indexed from the history
+        indexStart = max(history.firstSequence, history.nextSequence - self.index.window)
+        self.index.retire(indexStart)
+        for chat in history.read(indexStart, chats[0].sequence if chats else indexStart):
+            if chat.visibility == "public": self.index.add(chat)
+        for chat in chats: self.restoreChat(chat)
+        ## Sequence numbers carry on from the history, so they are never reused across restarts
+        if len(self) == 0: self.firstSequence = self.nextSequence = history.nextSequence
+
+    def appendChat(self, user: str, messageString: str, visibility: str) -> NamedTuple:
+        ca = super().appendChat(user, messageString, visibility)
+        self.history.append(ca)
+        return ca
+
+    def retainedSequence(self) -> int:
+        return self.history.firstSequence
+
+    def getChatsBySequence(self, sequences: Iterable[int]) -> List[NamedTuple]:
+        chats = []
+        for sequence in sequences:
+            chat = self.getChat(sequence) if sequence >= self.firstSequence else next(self.history.read(sequence, sequence + 1), None)
+            if chat is not None: chats.append(chat)
+        return chats
+
+    def getChatsSince(self, sequence: int):
+        if sequence >= self.firstSequence: return super().getChatsSince(sequence)
+        archived = list(self.history.read(sequence, self.firstSequence))
+        _, chats = super().getChatsSince(self.firstSequence)
+        ## Only the chat actions that have also been retired from the history are reported as a gap
+        return self.firstSequence - sequence - len(archived), archived + chats
+
+    def commit(self) -> None:
+        self.history.commit()
+        self.index.retire(self.history.firstSequence)
+
+    def maintain(self) -> None:
+        self.history.maintain()
+        self.index.retire(self.history.firstSequence)
+
+    def close(self) -> None:
+        self.history.close()
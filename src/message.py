@@ -1,7 +1,10 @@
 
+import codecs
 import socket
-from bidict import bidict
-from typing import Optional, List, Dict
+import time
+import zlib
+from collections import deque
+from typing import Iterator, Optional, List, Dict, Tuple, Union
 
 ##TODO: Replace safeEncodeValues/safeDecodeValues to escapeCharacters
 ##TODO: Consider how the above methods will escape characters, and which characters they will escape
@@ -11,12 +14,12 @@ class request:
         self.rawRequest: bytes = b""
         self.stringRequest: str = ""
 
-    def setStringRequest(self, user: str, message: str = "", messageType="User-Message", contentType: str = "Text") -> None:
+    def setStringRequest(self, user: str, message: str = "", messageType="User-Message", contentType: str = "Text", headers: Optional[Dict[str, str]] = None) -> None:
         self.stringRequest = message
-        self.rawRequest = self.createRawRequest(user, message, messageType, contentType)
+        self.rawRequest = self.createRawRequest(user, message, messageType, contentType, headers)
 
     ##TODO: These variables should be provided in when setRequest is set
-    def createRawRequest(self, user: str, message: str, messageType: str, contentType: str) -> bytes:
+    def createRawRequest(self, user: str, message: str, messageType: str, contentType: str, headers: Optional[Dict[str, str]] = None) -> bytes:
         string = ""
         ##First we want to see if there are any values that we want to safely encode here
         body = message.encode("unicode-escape").decode("utf-8")
@@ -24,7 +27,10 @@ class request:
         string += f"User:{user}\r\n"
         string += f"Message-Type:{messageType}\r\n"
         string += f"Content-Type:{contentType}\r\n"
-        string += f"Content-Length:{len(repr(body)) - 2}\r\n" ## -2 to remove the two quotes that repr() produces
+        ##Any additional headers must come before Content-Length, which is always the last header
+        if headers is not None:
+            string += "".join(f"{key}:{value}\r\n" for key, value in headers.items())
+        string += f"Content-Length:{len(body)}\r\n" ## The escaped body is ASCII, so its length is also its length in bytes
         ##Then we add the body (i.e. the message)
         string += f"{body}\r\n\r\n"
         return string.encode("utf-8")
@@ -53,30 +59,387 @@ class response:
         return splitString[-1].encode("utf-8").decode("unicode-escape")
 
 
+##A streaming decoder that extracts frames from a persistent receive buffer
+##NOTE: Several frames may arrive in a single recv(), and a frame may be split across several recv() calls
+##      so any partial frame is kept in the buffer until the rest of it arrives
+##NOTE: The bytes received are copied into the buffer straight away, so a server can share one recvView between all of its
+##      connections rather than allocating a receive buffer per connection
+class frameDecoder:
+    def __init__(self, bufferSize: int = 65536, maxHeaderSize: int = 8192, initial: bytes = b"", recvView: Optional[memoryview] = None,
+                 maxBodySize: int = 1048576) -> None:
+        self.buffer: bytearray = bytearray(initial)
+        self.offset: int = 0 ## The start of the first frame in the buffer that has not been decoded yet
+        self.recvView: memoryview = memoryview(bytearray(bufferSize)) if recvView is None else recvView
+        self.maxHeaderSize: int = maxHeaderSize
+        self.maxBodySize: int = maxBodySize ## A frame may not claim a longer body, so a peer can not grow the buffer without limit
+        self.pendingHeaders: Optional[Dict[str, str]] = None ## The headers of a frame whose body has not fully arrived
+        self.pendingBodyStart: int = 0
+        self.pendingBodyLength: int = 0
+        self.pendingScan: int = 0 ## Where the search for the terminator of a legacy frame's body carries on from
+
+    def receiveFrom(self, sock: socket.socket) -> int:
+        ## Returns the number of bytes received, where 0 signifies that the peer has closed the connection
+        size = sock.recv_into(self.recvView)
+        self.feed(self.recvView[:size])
+        return size
+
+    def feed(self, data: Union[bytes, memoryview]) -> None:
+        ## The decoded prefix of the buffer is only discarded here, so that it is moved once per receive rather than once per frame
+        if self.offset > 0:
+            del self.buffer[:self.offset]
+            self.pendingBodyStart -= self.offset
+            self.pendingScan -= self.offset
+            self.offset = 0
+        self.buffer += data
+
+    def frames(self) -> Iterator[Dict[str, Union[Dict[str, str], str]]]:
+        ## Yields every complete frame that is currently buffered
+        while True:
+            frame = self.decodeFrame()
+            if frame is None: return
+            yield frame
+
+    def decodeFrame(self) -> Optional[Dict[str, Union[Dict[str, str], str]]]:
+        if self.pendingHeaders is None and self.decodeHeaders() is False: return None
+        bodyStart = self.pendingBodyStart
+        bodyEnd = bodyStart + self.pendingBodyLength
+        if self.buffer[bodyEnd:bodyEnd + 4] != b"\r\n\r\n":
+            bodyEnd = self.findLegacyBodyEnd(bodyStart, bodyEnd)
+            if bodyEnd is None: return None
+
+        body = codecs.unicode_escape_decode(memoryview(self.buffer)[bodyStart:bodyEnd])[0]
+        headers, self.pendingHeaders = self.pendingHeaders, None
+        self.offset = bodyEnd + 4
+        return {"Headers": headers, "Body": body}
+
+    def decodeHeaders(self) -> bool:
+        ## Content-Length is always the last header, and the body immediately follows it
+        ## so the header block is located with a single search and then decoded in one pass
+        start, position = self.offset, self.offset
+        while True:
+            marker = self.buffer.find(b"Content-Length:", position)
+            if marker == -1:
+                if len(self.buffer) - start > self.maxHeaderSize: raise ValueError("The frame headers are too large")
+                return False
+            if marker == start or self.buffer[marker - 2:marker] == b"\r\n": break
+            position = marker + 1 ## The marker was part of another header's value
+        end = self.buffer.find(b"\r\n", marker)
+        if end == -1: return False
+
+        headers = {}
+        for line in self.buffer[start:end].decode("utf-8").split("\r\n"):
+            key, separator, value = line.partition(":")
+            if separator == "": raise ValueError(f"Malformed header: {key}")
+            headers[key] = value
+        bodyLength = int(headers["Content-Length"])
+        if not 0 <= bodyLength <= self.maxBodySize: raise ValueError(f"The frame body of {bodyLength} bytes is too large")
+        self.pendingHeaders, self.pendingBodyStart, self.pendingBodyLength = headers, end + 2, bodyLength
+        self.pendingScan = end + 2
+        return True
+
+    def findLegacyBodyEnd(self, bodyStart: int, declaredEnd: int) -> Optional[int]:
+        ## Clients from before Content-Length was the escaped body's length sent len(repr(body)) - 2, which is longer whenever the
+        ## body has a backslash (such as any escaped non-ASCII text) or both kinds of quote. The escaped body never contains a line
+        ## break, so such a frame's body ends at the first terminator, which always arrives before its declared end
+        end = self.buffer.find(b"\r\n\r\n", self.pendingScan)
+        if end == -1:
+            if len(self.buffer) >= declaredEnd + 4: raise ValueError("The frame body does not match its Content-Length")
+            self.pendingScan = max(bodyStart, len(self.buffer) - 3)
+            return None
+        if end > declaredEnd: raise ValueError("The frame body does not match its Content-Length")
+        return end
+
+
+##Version 2 of the protocol is a compact binary framing, which is negotiated with a Protocol header during User-Creation
+##Each frame is the message type code (1 byte), then the varint lengths of the user, the additional headers and the body,
+##and then the user, the additional headers ("Key:Value\r\n" pairs, usually empty) and the raw UTF-8 body with no escaping
+##NOTE: A message type without a code is sent as code 0, with its name in a Message-Type header
+MESSAGE_TYPE_CODES: Dict[str, int] = {"User-Creation": 1, "User-Message": 2, "User-Command": 3, "Chat-Update": 4, "Session-Rejection": 5, "Session-Termination": 6,
+                                      "Server-Stats": 7, "Ping": 8, "Pong": 9, "Throttle": 10, "Server-Profile": 11}
+MESSAGE_TYPE_NAMES: Dict[int, str] = {code: name for name, code in MESSAGE_TYPE_CODES.items()}
+SMALL_VARINTS: List[bytes] = [bytes((value,)) for value in range(128)]
+
+def encodeVarint(value: int) -> bytes:
+    if value < 128: return SMALL_VARINTS[value]
+    encoded = bytearray()
+    while value >= 128:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+def decodeVarint(buffer: bytearray, position: int) -> Tuple[Optional[int], int]:
+    ## Returns None as the value if the varint has not been fully received
+    value, shift = 0, 0
+    while position < len(buffer):
+        byte = buffer[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 128: return value, position
+        shift += 7
+        if shift > 63: raise ValueError("Malformed varint")
+    return None, position
+
+
+class binaryRequest(request):
+    def createRawRequest(self, user: str, message: str, messageType: str, contentType: str = "Text", headers: Optional[Dict[str, str]] = None) -> bytes:
+        code = MESSAGE_TYPE_CODES.get(messageType, 0)
+        if code == 0 or contentType != "Text":
+            headers = dict(headers or {}, **{"Message-Type": messageType, "Content-Type": contentType})
+        userBytes = user.encode("utf-8")
+        headerBytes = "".join(f"{key}:{value}\r\n" for key, value in headers.items()).encode("utf-8") if headers else b""
+        body = message.encode("utf-8")
+        return b"".join((SMALL_VARINTS[code], encodeVarint(len(userBytes)), encodeVarint(len(headerBytes)), encodeVarint(len(body)), userBytes, headerBytes, body))
+
+
+class binaryFrameDecoder(frameDecoder):
+    def decodeFrame(self) -> Optional[Dict[str, Union[Dict[str, str], str]]]:
+        buffer, position = self.buffer, self.offset
+        if position >= len(buffer): return None
+        code = buffer[position]
+        userLength, position = decodeVarint(buffer, position + 1)
+        if userLength is None: return None
+        headersLength, position = decodeVarint(buffer, position)
+        if headersLength is None: return None
+        bodyLength, position = decodeVarint(buffer, position)
+        if bodyLength is None: return None
+        if userLength + headersLength > self.maxHeaderSize: raise ValueError("The frame headers are too large")
+        if bodyLength > self.maxBodySize: raise ValueError(f"The frame body of {bodyLength} bytes is too large")
+        headersStart = position + userLength
+        bodyStart = headersStart + headersLength
+        bodyEnd = bodyStart + bodyLength
+        if len(buffer) < bodyEnd: return None
+
+        ## The fields are decoded straight from views of the receive buffer, which are released before it is next resized
+        with memoryview(buffer) as view:
+            headers = {"User": str(view[position:headersStart], "utf-8"), "Message-Type": MESSAGE_TYPE_NAMES.get(code), "Content-Type": "Text"}
+            if headersLength > 0:
+                for line in str(view[headersStart:bodyStart], "utf-8").split("\r\n")[:-1]:
+                    key, separator, value = line.partition(":")
+                    if separator == "": raise ValueError(f"Malformed header: {key}")
+                    headers[key] = value
+            body = str(view[bodyStart:bodyEnd], "utf-8")
+        if headers["Message-Type"] is None: raise ValueError(f"Unknown message type code: {code}")
+        self.offset = bodyEnd
+        return {"Headers": headers, "Body": body}
+
+
+PROTOCOL_ENCODERS = {1: request, 2: binaryRequest}
+PROTOCOL_DECODERS = {1: frameDecoder, 2: binaryFrameDecoder}
+
+def negotiateProtocol(headers: Dict[str, str]) -> int:
+    ## A peer offers the highest protocol version it supports, and the highest version supported by both is used
+    try:
+        offered = int(headers.get("Protocol", 1))
+    except ValueError: return 1
+    return max((version for version in PROTOCOL_ENCODERS if version <= offered), default=1)
+
+
+##Every Chat-Update broadcast from a room carries the chat action's Sequence header, and a client that reconnects presents
+##the last sequence number it received in each room with a Resume header during User-Creation, e.g. "Resume: 41,games=7"
+##where the bare number is for the default room. The server then sends only the chat actions that were missed
+def formatResume(sequences: Dict[Optional[str], int]) -> str:
+    return ",".join(str(sequence) if room is None else f"{room}={sequence}" for room, sequence in sequences.items())
+
+def parseResume(headers: Dict[str, str]) -> Dict[Optional[str], int]:
+    resume = {}
+    for item in headers.get("Resume", "").split(","):
+        room, separator, sequence = item.strip().rpartition("=")
+        try:
+            resume[room if separator else None] = int(sequence)
+        except ValueError: continue
+    return resume
+
+
+##Compression of the frames sent to a client is negotiated with a Compression header during User-Creation, after which
+##every frame sent to that client is wrapped in an envelope: a flag byte (0 for a raw frame, 1 for deflated data), the
+##varint length of the payload and then the payload
+##--> Frames of at least threshold bytes are compressed into a single raw deflate stream per connection, which is flushed
+##    with Z_SYNC_FLUSH after every frame, so each frame is compressed against the text of the frames before it
+##--> Smaller frames are not worth compressing, so the envelope header is sent ahead of the shared, unmodified frame
+##NOTE: Frames are queued uncompressed, and only compressed as they are sent, so that frames which are never sent (as the
+##      client fell behind) never enter the deflate stream
+##NOTE: The deflate context is only allocated once the first large frame is sent, and uses a smaller window than zlib's
+##      default, so an idle connection costs nothing and a busy one ~64KiB rather than ~256KiB
+COMPRESSION_METHODS = ("deflate",)
+RAW_ENVELOPE, DEFLATE_ENVELOPE = 0, 1
+COMPRESSION_WINDOW_BITS = 13
+COMPRESSION_MEMORY_LEVEL = 6
+
+def negotiateCompression(headers: Dict[str, str]) -> Optional[str]:
+    ## A peer offers a comma separated list of the compression methods it supports, and the first supported one is used
+    offered = (method.strip() for method in headers.get("Compression", "").split(","))
+    return next((method for method in offered if method in COMPRESSION_METHODS), None)
+
+
+class frameCompressor:
+    def __init__(self, threshold: int = 256, level: int = 6) -> None:
+        self.threshold: int = threshold
+        self.level: int = level
+        self.deflater = None
+        self.inputBytes: int = 0 ## The bytes of the frames that were compressed, and what they were compressed to
+        self.outputBytes: int = 0
+
+    def pack(self, frame: bytes) -> Tuple[bytes, ...]:
+        ## Returns the envelope as the chunks to be sent, in order
+        if len(frame) < self.threshold:
+            return (SMALL_VARINTS[RAW_ENVELOPE] + encodeVarint(len(frame)), frame)
+        if self.deflater is None:
+            self.deflater = zlib.compressobj(self.level, zlib.DEFLATED, -COMPRESSION_WINDOW_BITS, COMPRESSION_MEMORY_LEVEL)
+        data = self.deflater.compress(frame) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+        self.inputBytes += len(frame)
+        self.outputBytes += len(data)
+        return (SMALL_VARINTS[DEFLATE_ENVELOPE] + encodeVarint(len(data)) + data,)
+
+
+class inflatingDecoder:
+    ## Unwraps the envelopes of a compressed stream, and feeds the frames within them to the protocol's decoder
+    def __init__(self, decoder: frameDecoder) -> None:
+        self.decoder: frameDecoder = decoder
+        self.recvView: memoryview = decoder.recvView
+        self.envelopes: bytearray = bytearray()
+        self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        ## Any bytes that were received after the negotiating frame are already enveloped
+        remaining = bytes(decoder.buffer[decoder.offset:])
+        del decoder.buffer[decoder.offset:]
+        self.feed(remaining)
+
+    def receiveFrom(self, sock: socket.socket) -> int:
+        size = sock.recv_into(self.recvView)
+        self.feed(self.recvView[:size])
+        return size
+
+    def feed(self, data: Union[bytes, memoryview]) -> None:
+        envelopes, position, payloads = self.envelopes, 0, []
+        envelopes += data
+        while position < len(envelopes):
+            flag = envelopes[position]
+            length, start = decodeVarint(envelopes, position + 1)
+            if length is None or start + length > len(envelopes): break
+            payload = bytes(envelopes[start:start + length])
+            if flag == DEFLATE_ENVELOPE:
+                payload = self.inflater.decompress(payload)
+            elif flag != RAW_ENVELOPE: raise ValueError(f"Unknown envelope: {flag}")
+            payloads.append(payload)
+            position = start + length
+        del envelopes[:position]
+        if payloads: self.decoder.feed(b"".join(payloads))
+
+    def frames(self) -> Iterator[Dict[str, Union[Dict[str, str], str]]]:
+        return self.decoder.frames()
+
+    def decodeFrame(self) -> Optional[Dict[str, Union[Dict[str, str], str]]]:
+        return self.decoder.decodeFrame()
+
+
+class broadcastFrame(bytes):
+    ## A frame of a room's broadcast, which the coalesce policy may drop as the client can catch up with /history,
+    ## unlike the other frames (direct messages, command replies and rejections), which are only ever sent once
+    __slots__ = ()
+
+
+##The protocol state of a connection, i.e. how frames are encoded onto it and decoded from it, and the frames queued to it
+##NOTE: The outbound queue only holds frames that have not started to be sent, so its frames can be dropped or replaced
+##      when the peer is not keeping up, while the frame being sent is held separately
+##NOTE: A server holds one of these per connection, and its selector key's data is the connection itself, so its state is
+##      kept in __slots__ and servicing an event needs no lookups. The user is None until User-Creation has been accepted
+class frameConnection:
+    __slots__ = ("protocol", "req", "decoder", "compressor", "outbound", "outboundBytes", "congested", "skippedFrames",
+                 "timer", "lastActivity", "user", "fileno", "messageBucket", "byteBucket", "readPaused", "resumeTimer")
+
+    def __init__(self, bufferSize: int = 65536, recvView: Optional[memoryview] = None) -> None:
+        self.protocol: int = 1
+        self.req: Optional[request] = None ## The encoder for sendRequest(), which is only created once it is first used
+        self.decoder: frameDecoder = frameDecoder(bufferSize, recvView=recvView)
+        self.compressor: Optional[frameCompressor] = None ## Set once compression of the frames sent to the peer is negotiated
+        self.outbound: deque = deque() ## Frames are queued by reference, so a broadcast frame is shared between connections
+        self.outboundBytes: int = 0
+        self.congested: bool = False ## Set while frames to the peer are being skipped, as it fell too far behind
+        self.skippedFrames: int = 0
+        self.timer = None ## The pending handshake, heartbeat or idle deadline of a server's connection
+        self.lastActivity: float = 0.0 ## When bytes were last received from the peer
+        self.user: Optional[str] = None ## The user registered on the connection
+        self.fileno: int = -1 ## The socket's file descriptor, which is cached as fileno() returns -1 once it is closed
+        self.messageBucket = None ## The server's rate limits on the messages and the bytes received, where None is unlimited
+        self.byteBucket = None
+        self.readPaused: bool = False ## Set while reads are deferred, as the peer has sent more bytes than its rate limit allows
+        self.resumeTimer = None
+
+    def setProtocol(self, protocol: int) -> None:
+        ## Any bytes that were received after the negotiating frame are decoded with the new protocol
+        if protocol == self.protocol: return None
+        remaining = self.decoder.buffer[self.decoder.offset:]
+        self.decoder = PROTOCOL_DECODERS[protocol](maxHeaderSize=self.decoder.maxHeaderSize, initial=remaining, recvView=self.decoder.recvView,
+                                                   maxBodySize=self.decoder.maxBodySize)
+        if self.req is not None: self.req = PROTOCOL_ENCODERS[protocol]()
+        self.protocol = protocol
+
+    def setCompression(self, threshold: int = 256, level: int = 6) -> None:
+        ## Compresses the frames that are sent to the peer
+        self.compressor = frameCompressor(threshold, level)
+
+    def setDecompression(self) -> None:
+        ## Inflates the frames that are received from the peer, which must be called after setProtocol()
+        self.decoder = inflatingDecoder(self.decoder)
+
+    def dropOldest(self, targetBytes: int) -> int:
+        ## Drops the oldest queued frames until at most targetBytes are queued, and returns the number dropped
+        outbound, dropped = self.outbound, 0
+        while self.outboundBytes > targetBytes and outbound:
+            self.outboundBytes -= len(outbound.popleft())
+            dropped += 1
+        return dropped
+
+    def dropBroadcasts(self) -> int:
+        ## Drops the queued broadcast frames, keeping the others in order, and returns the number dropped
+        kept = [frame for frame in self.outbound if type(frame) is not broadcastFrame]
+        dropped = len(self.outbound) - len(kept)
+        self.outbound.clear()
+        self.outbound.extend(kept)
+        self.outboundBytes = sum(len(frame) for frame in kept)
+        return dropped
+
+    def clearOutbound(self) -> int:
+        dropped = len(self.outbound)
+        self.outbound.clear()
+        self.outboundBytes = 0
+        return dropped
+
+    def bufferedRequests(self) -> Iterator[Dict[str, Union[Dict[str, str], str]]]:
+        ## Yields every complete frame that is buffered, re-reading the decoder as the protocol may change between frames
+        while True:
+            frame = self.decoder.decodeFrame()
+            if frame is None: return
+            yield frame
+
+
 ##Once one side has created a message object which has been encoded into a bytes object
 ##The next thing to do is to send it to the destination socket
 ## --> That means that we need to hold the other pair of that comms in the class clientConnection
+##NOTE: The connections are indexed by file descriptor and the sessions by username, which keeps usernames unique, while
+##      each connection holds its own user, so there is no reverse lookup from a connection to its user
 ##TODO: Rename this to connectionRegistry, or connectionDictionary or sessions
 class connections:
     def __init__(self) -> None:
-        self.filenoToConnection: bidict[socket.fileno, clientConnection] = bidict()
-        self.userToConnection: bidict[str, clientConnection] = bidict()
+        self.filenoToConnection: Dict[int, clientConnection] = {}
+        self.userToConnection: Dict[str, clientConnection] = {}
 
     def registerConnection(self, connection: "clientConnection") -> None:
-        self.filenoToConnection[connection.sock.fileno()] = connection
+        self.filenoToConnection[connection.fileno] = connection
 
     def unregisterConnection(self, connection: "clientConnection") -> None:
-        try:
-            self.filenoToConnection.pop(connection.sock.fileno())
-        except KeyError: pass
+        if self.isRegistered(connection): del self.filenoToConnection[connection.fileno]
+
+    def isRegistered(self, connection: "clientConnection") -> bool:
+        return self.filenoToConnection.get(connection.fileno) is connection
 
     def registerUser(self, user: str, connection: "clientConnection") -> None:
         self.userToConnection[user] = connection
+        connection.user = user
 
     def unregisterUser(self, user: str) -> None:
-        try:
-            self.userToConnection.pop(user)
-        except KeyError: pass
+        connection = self.userToConnection.pop(user, None)
+        if connection is not None: connection.user = None
         
     def close(self, user: str, connection: "clientConnection") -> None:
         self.unregisterConnection(connection)
@@ -84,37 +447,117 @@ class connections:
         connection.close()
         
 
+def formatPeerName(address) -> tuple:
+    ## IPv6 addresses also carry a flow label and scope id, and Unix sockets have no host or port
+    return address[:2] if isinstance(address, tuple) else ("localhost", 0)
+
+##A sendmsg() is limited to IOV_MAX buffers (1024 on Linux), and a batch is limited in size so that frames stay in the
+##outbound queue, where the slow consumer policy can still drop them, until the socket is ready for them
+SEND_BATCH_BUFFERS = 512
+SEND_BATCH_BYTES = 262144
+SEND_SCATTER_GATHER = hasattr(socket.socket, "sendmsg") ## Windows has no sendmsg(), so each chunk is sent separately
+
 ##TODO: Consider changing the name to something else maybe just connection -- If named to connection, name connections class to something else
-class clientConnection:
-    def __init__(self, socket: socket.socket) -> None:
+class clientConnection(frameConnection):
+    __slots__ = ("sock", "peername", "eof", "sending", "closing", "writeInterest", "bytesInCounter", "bytesOutCounter", "sendCallsCounter")
+
+    def __init__(self, socket: socket.socket, recvView: Optional[memoryview] = None, peername: Optional[tuple] = None) -> None:
+        super().__init__(recvView=recvView)
         self.sock = socket
         self.sock.setblocking(False)
-        self.req = request()
-        self.resp = response()
+        self.fileno = socket.fileno()
+        ## Cached, as getpeername() fails once the peer has reset the connection, and a server passes the address from accept()
+        self.peername = self.getPeerName() if peername is None else formatPeerName(peername)
+        self.eof: bool = False ## Set once the peer has closed the connection
+        self.sending: deque = deque() ## The chunks of the frames currently being sent, after any compression
+        self.closing: bool = False ## Set when the connection should be closed once the outbound queue has been flushed
+        self.writeInterest: bool = False ## Whether the connection is registered for EVENT_WRITE
+        self.bytesInCounter = None ## The server's counters, which are only set while metrics are enabled
+        self.bytesOutCounter = None
+        self.sendCallsCounter = None
 
-    def sendRequest(self, user: str, message: str = "", messageType: str = "User-Message", contentType: str = "Text") -> None:
-        self.req.setStringRequest(user, message, messageType, contentType)
+    def sendRequest(self, user: str, message: str = "", messageType: str = "User-Message", contentType: str = "Text", headers: Optional[Dict[str, str]] = None) -> None:
+        if self.req is None: self.req = PROTOCOL_ENCODERS[self.protocol]()
+        self.req.setStringRequest(user, message, messageType, contentType, headers)
         return self.sock.sendall(self.req.rawRequest)
 
-    def receiveRequest(self) -> Optional[str]:
-        self.resp.setRawRequest(self.receiveMessage())
-        return None if self.resp.stringRequest == "" else self.resp.stringRequest
+    def setCompression(self, threshold: int = 256, level: int = 6) -> None:
+        ## The frames already queued (such as the negotiating reply) are sent uncompressed
+        self.sending.extend(self.outbound)
+        self.clearOutbound()
+        super().setCompression(threshold, level)
+
+    def getPeerName(self) -> tuple:
+        try:
+            return formatPeerName(self.sock.getpeername())
+        except OSError: return ("Undefined", 0)
+
+    def queueFrame(self, frame: bytes) -> bool:
+        ## Returns whether the queue was previously empty, i.e. whether the caller needs to wait for the socket to be writable
+        wasEmpty = len(self.outbound) == 0 and len(self.sending) == 0
+        self.outbound.append(frame)
+        self.outboundBytes += len(frame)
+        return wasEmpty
+
+    def unsentBytes(self) -> int:
+        ## The queued frames, and the chunks (after any compression) that are still being sent
+        return self.outboundBytes + sum(len(chunk) for chunk in self.sending)
+
+    def flushFrames(self) -> bool:
+        ## Sends as much of the outbound queue as the socket will accept, and returns whether the queue has been drained
+        ## NOTE: The queued frames are sent with a single scatter-gather sendmsg() per batch, so they are neither concatenated
+        ##       nor sent with a syscall each, and a partial send leaves the unsent remainder of a chunk (as a memoryview,
+        ##       so without copying) at the front
+        sending = self.sending
+        while True:
+            if self.outbound and len(sending) < SEND_BATCH_BUFFERS: self.fillSending()
+            if not sending: return True
+            try:
+                if len(sending) == 1 or SEND_SCATTER_GATHER is False:
+                    sent = self.sock.send(sending[0])
+                else:
+                    sent = self.sock.sendmsg(sending)
+            except (BlockingIOError, InterruptedError): return False
+            if self.sendCallsCounter is not None:
+                self.sendCallsCounter.inc()
+                self.bytesOutCounter.inc(sent)
+            while sent > 0:
+                chunk = sending[0]
+                if sent < len(chunk):
+                    sending[0] = memoryview(chunk)[sent:]
+                    return False
+                sent -= len(chunk)
+                sending.popleft()
+
+    def fillSending(self) -> None:
+        ## Moves a batch of queued frames into the chunks being sent, compressing them if that has been negotiated
+        sending, outbound, compressor, batchBytes = self.sending, self.outbound, self.compressor, 0
+        while outbound and len(sending) < SEND_BATCH_BUFFERS and batchBytes < SEND_BATCH_BYTES:
+            frame = outbound.popleft()
+            self.outboundBytes -= len(frame)
+            batchBytes += len(frame)
+            if compressor is None: sending.append(frame)
+            else: sending.extend(compressor.pack(frame))
+
+    def receiveRequests(self) -> Iterator[Dict[str, Union[Dict[str, str], str]]]:
+        ## Performs a single receive (for use with a selector), and then yields every complete frame that has been buffered
+        try:
+            size = self.decoder.receiveFrom(self.sock)
+            self.eof = size == 0
+            if self.bytesInCounter is not None: self.bytesInCounter.inc(size)
+            if self.byteBucket is not None: self.byteBucket.charge(time.monotonic(), size)
+        except (BlockingIOError, InterruptedError): pass
+        except (ConnectionAbortedError, ConnectionResetError, socket.error):
+            self.eof = True
+        yield from self.bufferedRequests()
 
-    def receiveMessage(self) -> None:
-        ##NOTE: Message end should also be signified by len(output) == 0
-        buffer = b""
-        bufferSize = 1024
-        terminationStr = b"\r\n\r\n"
-        while bufferSize >= 1024:
+    def receiveRequest(self) -> Optional[Dict[str, Union[Dict[str, str], str]]]:
+        ## Blocks until a complete frame has been received, and returns None if the connection was closed
+        while True:
+            for frame in self.bufferedRequests(): return frame
             try:
-                output = self.sock.recv(1024)
-            except (ConnectionAbortedError, ConnectionResetError, socket.error): break
-            
-            buffer += output
-            bufferSize = len(output)
-            if terminationStr in buffer: break
-
-        return buffer
+                if self.decoder.receiveFrom(self.sock) == 0: return None
+            except (ConnectionAbortedError, ConnectionResetError, socket.error): return None
 
     def close(self) -> None:
         self.sock.close()
@@ -0,0 +1,86 @@
+import math
+import time
+from typing import Callable, Dict, Optional, Union
+
+##An in-process registry of counters, histograms and gauges for instrumenting the server
+##NOTE: The server holds None instead of a registry when metrics are disabled, and every instrumentation point is
+##      guarded by a single `is not None` check, so that disabled instrumentation costs next to nothing
+
+
+class counter:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value: int = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+
+class histogram:
+    ## Log-bucketed with ~2% resolution, so recording is O(1) and memory is bounded however many values are recorded
+    __slots__ = ("logBase", "buckets", "count", "total", "maximum")
+
+    def __init__(self, resolution: float = 0.02) -> None:
+        self.logBase: float = math.log1p(resolution)
+        self.buckets: Dict[int, int] = {}
+        self.count: int = 0
+        self.total: float = 0.0
+        self.maximum: float = 0.0
+
+    def record(self, value: float) -> None:
+        bucket = int(math.log(value) / self.logBase) if value > 1e-9 else -1000000
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.maximum: self.maximum = value
+
+    def percentile(self, percent: float) -> Optional[float]:
+        if self.count == 0: return None
+        target, seen = self.count * percent / 100, 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target: return min(math.exp((bucket + 0.5) * self.logBase), self.maximum)
+        return self.maximum
+
+    def summary(self) -> Dict[str, Optional[float]]:
+        return {"count": self.count, "mean": self.total / self.count if self.count else None,
+                "p50": self.percentile(50), "p99": self.percentile(99), "max": self.maximum}
+
+
+class metricsRegistry:
+    def __init__(self) -> None:
+        self.startTime: float = time.time()
+        self.counters: Dict[str, counter] = {}
+        self.histograms: Dict[str, histogram] = {}
+        self.gauges: Dict[str, Callable[[], Union[int, float]]] = {} ## Gauges are only evaluated when a snapshot is taken
+
+    def counter(self, name: str) -> counter:
+        if name not in self.counters: self.counters[name] = counter()
+        return self.counters[name]
+
+    def histogram(self, name: str) -> histogram:
+        if name not in self.histograms: self.histograms[name] = histogram()
+        return self.histograms[name]
+
+    def gauge(self, name: str, function: Callable[[], Union[int, float]]) -> None:
+        self.gauges[name] = function
+
+    def snapshot(self) -> Dict[str, Union[int, float, None]]:
+        values: Dict[str, Union[int, float, None]] = {"uptime.seconds": time.time() - self.startTime}
+        values.update((name, metric.value) for name, metric in self.counters.items())
+        for name, function in self.gauges.items():
+            try:
+                values[name] = function()
+            except Exception: values[name] = None
+        for name, metric in self.histograms.items():
+            values.update((f"{name}.{key}", value) for key, value in metric.summary().items())
+        return values
+
+    def render(self) -> str:
+        ## A plaintext rendering with one "name value" pair per line
+        return "".join(f"{name} {value:.6g}\n" if isinstance(value, float) else f"{name} {value}\n" for name, value in sorted(self.snapshot().items()))
+
+    def dump(self, path: str) -> None:
+        with open(path, "a") as file:
+            file.write(f"# {time.strftime('%Y-%m-%d %H:%M:%S')}\n{self.render()}\n")
@@ -0,0 +1,129 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Counter as CounterType, List, Optional, Sequence
+
+##Profiling windows, which are opened and closed on a running server (with SIGUSR2 or a Server-Profile request) so that a
+##slowdown can be diagnosed without restarting the server, which would lose the state that caused it
+##--> "cprofile" traces every call made on the event loop's thread, which is exact but slows the loop down while it is open
+##--> "sampling" samples the event loop thread's stack from a background thread every sampleInterval seconds, which costs
+##    the loop little, and counts the stacks in the folded format that flame graph tools read. While the loop is busy, the
+##    sampler waits for the GIL, so samples are taken at most every sys.getswitchinterval() (5ms by default)
+##--> "memory" starts tracemalloc, and diffs a snapshot taken as the window closes against one taken as it opened, which
+##    shows where memory grew in the meantime (such as the rooms' chat, the receive buffers or the connection maps)
+##NOTE: Nothing is installed while no window is open, so the server pays nothing for profiling until a window is opened
+##NOTE: Every file that a window writes starts with the annotation it was closed with (the server's metrics at that
+##      moment), as "#" comment lines
+PROFILERS = ("cprofile", "sampling", "memory")
+IGNORED_ALLOCATIONS = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                       tracemalloc.Filter(False, "<unknown>"))
+
+def parseProfilers(text: str) -> List[str]:
+    profilers = [name.strip() for name in text.replace(",", " ").split() if name.strip()]
+    for name in profilers:
+        if name not in PROFILERS: raise ValueError(f"Unknown profiler {name}, expected one of {', '.join(PROFILERS)}")
+    return profilers
+
+
+class stackSampler:
+    def __init__(self, threadId: int, interval: float = 0.005, maxDepth: int = 64) -> None:
+        self.threadId: int = threadId
+        self.interval: float = interval
+        self.maxDepth: int = maxDepth
+        self.stacks: CounterType[str] = Counter() ## The number of samples of each stack, outermost frame first
+        self.samples: int = 0
+        self.stopping: threading.Event = threading.Event()
+        self.thread: threading.Thread = threading.Thread(target=self.sampleLoop, name="stack-sampler", daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+        self.thread.join()
+
+    def sampleLoop(self) -> None:
+        while not self.stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.threadId)
+            stack = []
+            while frame is not None and len(stack) < self.maxDepth:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if not stack: continue
+            stack.reverse()
+            self.stacks[";".join(stack)] += 1
+            self.samples += 1
+
+
+class profilingWindow:
+    def __init__(self, profilers: Sequence[str], directory: str = ".", sampleInterval: float = 0.005, top: int = 40) -> None:
+        self.profilers: List[str] = list(profilers)
+        self.directory: str = directory
+        self.sampleInterval: float = sampleInterval
+        self.top: int = top ## The number of functions, or allocation sites, listed in the text reports
+        self.opened: float = 0.0
+        self.profile: Optional[cProfile.Profile] = None
+        self.sampler: Optional[stackSampler] = None
+        self.snapshot: Optional[tracemalloc.Snapshot] = None
+        self.tracing: bool = False ## Whether this window started tracemalloc, and so must stop it
+
+    def open(self, threadId: Optional[int] = None) -> None:
+        ## Must be called on the thread to be profiled (cProfile only traces the thread that enabled it), unless threadId is given
+        self.opened = time.time()
+        if "memory" in self.profilers:
+            self.tracing = not tracemalloc.is_tracing()
+            if self.tracing: tracemalloc.start()
+            self.snapshot = tracemalloc.take_snapshot().filter_traces(IGNORED_ALLOCATIONS)
+        if "sampling" in self.profilers:
+            self.sampler = stackSampler(threading.get_ident() if threadId is None else threadId, self.sampleInterval)
+            self.sampler.start()
+        if "cprofile" in self.profilers:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def close(self, annotation: str = "") -> List[str]:
+        ## Stops every profiler, and returns the paths of the files written
+        if self.profile is not None: self.profile.disable()
+        if self.sampler is not None: self.sampler.stop()
+        snapshot = None
+        if self.snapshot is not None:
+            snapshot = tracemalloc.take_snapshot().filter_traces(IGNORED_ALLOCATIONS)
+            if self.tracing: tracemalloc.stop()
+        os.makedirs(self.directory, exist_ok=True)
+        ## The process id tells apart the files of a cluster's workers, which may be profiled at the same time
+        prefix = os.path.join(self.directory, f"profile-{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.opened))}-{os.getpid()}")
+        header = f"Profiling window of {time.time() - self.opened:.3f}s opened at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.opened))}\n{annotation}"
+        header = "".join(f"# {line}\n" for line in header.rstrip("\n").split("\n"))
+        paths = []
+        if self.profile is not None:
+            ## The raw statistics can be loaded with pstats (or a viewer such as snakeviz), and the text report is sorted by cumulative time
+            self.profile.dump_stats(prefix + ".prof")
+            report = io.StringIO()
+            pstats.Stats(self.profile, stream=report).sort_stats("cumulative").print_stats(self.top)
+            paths += [prefix + ".prof", self.writeReport(prefix + "-cprofile.txt", header + report.getvalue())]
+        if self.sampler is not None:
+            lines = [f"# {self.sampler.samples} samples every {self.sampleInterval * 1e3:g}ms\n"]
+            lines += [f"{stack} {count}\n" for stack, count in self.sampler.stacks.most_common()]
+            paths.append(self.writeReport(prefix + "-samples.folded", header + "".join(lines)))
+        if snapshot is not None:
+            paths.append(self.writeReport(prefix + "-memory.txt", header + self.formatMemoryGrowth(self.snapshot, snapshot)))
+        return paths
+
+    def formatMemoryGrowth(self, before: tracemalloc.Snapshot, after: tracemalloc.Snapshot) -> str:
+        differences = after.compare_to(before, "lineno")
+        total = sum(difference.size_diff for difference in differences)
+        lines = [f"# {sum(stat.size for stat in after.statistics('filename')) / 1048576:.1f} MiB traced, {total / 1048576:+.3f} MiB during the window\n"]
+        lines += [f"{difference}\n" for difference in differences[:self.top]]
+        return "".join(lines)
+
+    def writeReport(self, path: str, text: str) -> str:
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(text)
+        return path
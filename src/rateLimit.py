@@ -0,0 +1,44 @@
+from typing import Optional
+
+##A token bucket, which limits a client to an average rate while allowing it bursts of up to burst at once
+##--> The bucket is refilled lazily, from the time elapsed since it was last used, so idle buckets cost nothing
+##--> consume() only takes tokens that are available, so the frame can be rejected, whereas charge() always takes them
+##    and lets the bucket go into debt, which is how received bytes are limited (the reads are deferred until it is repaid)
+
+class tokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated", "limited")
+
+    def __init__(self, rate: float, burst: float, now: float) -> None:
+        self.rate: float = rate ## The tokens added per second
+        self.burst: float = max(burst, 1.0) ## The most tokens the bucket holds
+        self.tokens: float = self.burst
+        self.updated: float = now
+        self.limited: bool = False ## Set once consume() has failed, and cleared by the next consume() that succeeds
+
+    def refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def consume(self, now: float, amount: float = 1.0) -> bool:
+        self.refill(now)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            self.limited = False
+            return True
+        self.limited = True
+        return False
+
+    def charge(self, now: float, amount: float) -> float:
+        ## Returns the seconds until the bucket is out of debt, which is 0 if it is not in debt
+        self.refill(now)
+        self.tokens -= amount
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def retryAfter(self, amount: float = 1.0) -> float:
+        ## The seconds until consume(amount) would succeed, as of the last time that the bucket was used
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+def createBucket(rate: float, burst: float, now: float) -> Optional[tokenBucket]:
+    ## A rate of 0 (or less) disables the limit
+    return tokenBucket(rate, burst, now) if rate > 0 else None
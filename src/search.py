@@ -0,0 +1,120 @@
+import re
+from datetime import datetime
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set
+
+##An index over the public chat, which is maintained as each chat action is appended, so queries never scan the chat
+##--> An inverted index maps each token to its postings, the ascending sequence numbers of the chat actions containing it
+##--> Each user's postings, and the (sequence, timestamp) pairs of every chat action, serve /from and /since queries
+##NOTE: Postings are compact int64 arrays, and queries walk them backwards from the newest chat action, so a query costs
+##      O(limit * log n) however long the chat is (an AND of several terms walks the shortest postings instead)
+##NOTE: Chat actions that can no longer be read are below the floor, and are removed in bulk once they outnumber the
+##      live postings, so this costs O(1) amortised per chat action
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+def tokenize(text: str) -> Set[str]:
+    return set(TOKEN_PATTERN.findall(text.lower()))
+
+def containsSequence(postings: array, sequence: int) -> bool:
+    i = bisect_left(postings, sequence)
+    return i < len(postings) and postings[i] == sequence
+
+
+class chatIndex:
+    def __init__(self) -> None:
+        self.tokens: Dict[str, array] = {}
+        self.users: Dict[str, array] = {}
+        self.sequences: array = array("q")
+        self.timestamps: array = array("d")
+        self.floor: int = 0 ## The sequence number of the oldest chat action that can still be read
+        self.compactedFloor: int = 0
+        self.scanCutoff: Optional[float] = None ## Set when the last query stopped short of the oldest chat, to when it stopped
+
+    def __len__(self) -> int:
+        return len(self.sequences) - bisect_left(self.sequences, self.floor)
+
+    def add(self, chat: NamedTuple) -> None:
+        sequence = chat.sequence
+        for token in tokenize(chat.message):
+            postings = self.tokens.get(token)
+            if postings is None: postings = self.tokens[token] = array("q")
+            postings.append(sequence)
+        postings = self.users.get(chat.user)
+        if postings is None: postings = self.users[chat.user] = array("q")
+        postings.append(sequence)
+        self.sequences.append(sequence)
+        self.timestamps.append(chat.timestamp)
+
+    def retire(self, floor: int) -> None:
+        if floor <= self.floor: return None
+        self.floor = floor
+        if floor - self.compactedFloor > max(len(self), 4096): self.compact()
+
+    def compact(self) -> None:
+        floor = self.floor
+        for postingsMap in (self.tokens, self.users):
+            for key, postings in list(postingsMap.items()):
+                start = bisect_left(postings, floor)
+                if start == len(postings): del postingsMap[key]
+                elif start > 0: del postings[:start]
+        start = bisect_left(self.sequences, floor)
+        del self.sequences[:start]
+        del self.timestamps[:start]
+        self.compactedFloor = floor
+
+    def newest(self, postings: array, limit: int) -> List[int]:
+        start = max(bisect_left(postings, self.floor), len(postings) - limit)
+        return postings[start:].tolist()
+
+    def history(self, limit: int) -> List[int]:
+        return self.newest(self.sequences, limit)
+
+    def fromUser(self, user: str, limit: int) -> List[int]:
+        postings = self.users.get(user)
+        return [] if postings is None else self.newest(postings, limit)
+
+    def since(self, timestamp: float, limit: int) -> List[int]:
+        ## Returns the first chat actions logged at or after the timestamp
+        start = max(bisect_left(self.timestamps, timestamp), bisect_left(self.sequences, self.floor))
+        return self.sequences[start:start + limit].tolist()
+
+    def search(self, terms: Iterable[str], limit: int) -> List[int]:
+        ## Returns the newest chat actions that contain every term
+        postingsLists = [self.tokens.get(token) for token in set(terms)]
+        if len(postingsLists) == 0 or None in postingsLists: return []
+        postingsLists.sort(key=len)
+        shortest, others = postingsLists[0], postingsLists[1:]
+        if not others: return self.newest(shortest, limit)
+        results = []
+        for i in range(len(shortest) - 1, bisect_left(shortest, self.floor) - 1, -1):
+            sequence = shortest[i]
+            if all(containsSequence(postings, sequence) for postings in others):
+                results.append(sequence)
+                if len(results) == limit: break
+        results.reverse()
+        return results
+
+
+TIME_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+def parseLimit(text: str, default: int, maximum: int) -> int:
+    if text == "": return default
+    try:
+        limit = int(text)
+    except ValueError: raise ValueError(f"The count must be a number, not {text}")
+    return min(max(limit, 1), maximum)
+
+def parseTime(text: str, now: float) -> float:
+    ## Accepts a relative time (30s, 10m, 2h or 1d ago), a time of day today (HH:MM[:SS]), an ISO date and time or a Unix timestamp
+    match = re.fullmatch(r"(\d+)([smhd])", text)
+    if match: return now - int(match.group(1)) * TIME_UNITS[match.group(2)]
+    if re.fullmatch(r"\d{1,2}:\d{2}(:\d{2})?", text):
+        return datetime.combine(datetime.fromtimestamp(now).date(), datetime.strptime(text, "%H:%M:%S" if text.count(":") == 2 else "%H:%M").time()).timestamp()
+    try:
+        return datetime.fromisoformat(text).timestamp()
+    except ValueError: pass
+    try:
+        return float(text)
+    except ValueError: raise ValueError(f"The time {text} could not be understood, try 10m, 14:30 or 2024-01-31T14:30")
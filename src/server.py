@@ -1,68 +1,232 @@
 import argparse
+import errno
+import os
+import re
 import selectors
 import socket
 import signal
-import logging
-from datetime import datetime
+import struct
+import sys
+import time
 from collections import namedtuple
-from typing import Dict, Iterable, List, NamedTuple, Optional, Union
-from message import connections, clientConnection
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple, Union
+from message import connections, clientConnection, request, broadcastFrame, negotiateProtocol, negotiateCompression, parseResume, PROTOCOL_ENCODERS, COMPRESSION_METHODS
+from metrics import metricsRegistry
+from eventLog import eventLog, LOG_FORMATS
+from search import chatIndex, tokenize, parseLimit, parseTime
+from directMessages import mailboxes, DirectMessage
+from timerWheel import timer, timerWheel
+from rateLimit import createBucket
+from profiling import profilingWindow, parseProfilers
+from handoff import sendHandoff, receiveHandoff, receiveExactly, encodeBytes, decodeBytes, HANDOFF_ACK, HANDOFF_COMMIT
 
 ##TODO: Restructure the class hierarchies into application, session, connection (or app/session and connection)
 ##TODO: Use enum types for better code quality
 ##TODO: Consider whether we need to strip \r or \n from the end of a line when storing messages in the chatObject
-##TODO: Design the logging system to write to the log file
 
 ##FUTURE: Have a function to setup a "SERVER" admin user
 
+ChatAction = namedtuple("ChatAction", ["sequence", "timestamp", "user", "message", "visibility"])
+DEFAULT_ROOM = "lobby" ## Every user is a member of the default room for as long as their session lasts
+SLOW_CONSUMER_POLICIES = ("coalesce", "drop-oldest", "disconnect")
+ROOM_NAME_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,32}")
+USERNAME_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,32}") ## Usernames are routed in headers, so they can never hold a line break
+RATE_LIMITED_TYPES = frozenset(("User-Message", "User-Command")) ## The frames that a session's message rate limit applies to
+HISTORY_MAINTENANCE_INTERVAL = 1.0 ## The most seconds between syncs of the history, and checks for segments to roll or retire
+
 class chatObject:
-    def __init__(self) -> None:
-        ## When a user registers, we set a pointer to the top of the stack
-        ## NOTE: Not using deque because it doesn't support slicing
-        self.chat: List[NamedTuple] = [] ## This can result in a memory leak, so we should store the remaining
-        self.userPointers: Dict[str, int] = {}
-        self.chatAction: NamedTuple = namedtuple("ChatAction", ["datetime", "user", "message", "visibility"])
-    
-    def logUserMessage(self, user: str, messageString: str, visibility: str = "public") -> None:
-        ca = self.chatAction(datetime.now(), user, messageString, visibility)
-        self.chat.append(ca)
+    ## Each room has its own chatObject, i.e. its own log, index and cursors for its members (the userPointers)
+    def __init__(self, capacity: int = 4096, maxBytes: Optional[int] = None, name: str = DEFAULT_ROOM) -> None:
+        ## The chat is a fixed-capacity ring buffer, where the chat action with sequence number n lives in slot n % capacity
+        ## Sequence numbers increase monotonically and are never reused, so they can be used as cursors into the chat
+        ## NOTE: Entries are evicted once the capacity (count) or maxBytes (size of the stored messages) is exceeded
+        self.capacity: int = capacity
+        self.maxBytes: Optional[int] = maxBytes
+        self.chat: List[Optional[NamedTuple]] = [None] * capacity
+        self.chatBytes: int = 0
+        self.firstSequence: int = 0 ## The sequence number of the oldest retained chat action
+        self.nextSequence: int = 0 ## The sequence number that the next chat action will be assigned
+        self.userPointers: Dict[str, int] = {} ## Each user's cursor is the sequence number of the next chat action they have not read
+        self.chatAction: NamedTuple = ChatAction
+        self.index: chatIndex = chatIndex() ## Indexes the public chat for the User-Command queries
+        self.name: str = name
+        self.broadcastSequence: int = 0 ## The sequence number of the next chat action to be broadcast
+        self.notify: Optional[Callable[["chatObject"], None]] = None ## Called whenever a chat action is appended
+
+    def __len__(self) -> int:
+        return self.nextSequence - self.firstSequence
+
+    def logUserMessage(self, user: str, messageString: str, visibility: str = "public") -> NamedTuple:
+        return self.appendChat(user, messageString, visibility)
+
+    def logServerMessage(self, messageString: str, visibility="public") -> NamedTuple:
+        return self.appendChat("Server", messageString, visibility)
+
+    def appendChat(self, user: str, messageString: str, visibility: str) -> NamedTuple:
+        if len(self) == self.capacity: self.evictOldest()
+        ca = self.chatAction(self.nextSequence, time.time(), user, messageString, visibility)
+        self.chat[ca.sequence % self.capacity] = ca
+        self.chatBytes += self.getChatSize(ca)
+        self.nextSequence += 1
+        if visibility == "public": self.index.add(ca)
+        if self.maxBytes is not None:
+            ## We always retain the most recent chat action, even if it exceeds maxBytes on its own
+            while self.chatBytes > self.maxBytes and len(self) > 1: self.evictOldest()
+        if self.notify is not None: self.notify(self)
+        return ca
+
+    def restoreChat(self, chat: NamedTuple) -> None:
+        ## Puts back a chat action that was logged earlier (by this room's history, or by a server handing over to this one)
+        ## without appending it again or broadcasting it
+        if len(self) == 0: self.firstSequence = self.nextSequence = chat.sequence
+        if len(self) == self.capacity: self.evictOldest()
+        self.chat[chat.sequence % self.capacity] = chat
+        self.chatBytes += self.getChatSize(chat)
+        self.nextSequence = chat.sequence + 1
+        if chat.visibility == "public": self.index.add(chat)
+        if self.maxBytes is not None:
+            while self.chatBytes > self.maxBytes and len(self) > 1: self.evictOldest()
+
+    def evictOldest(self) -> None:
+        slot = self.firstSequence % self.capacity
+        self.chatBytes -= self.getChatSize(self.chat[slot])
+        self.chat[slot] = None
+        self.firstSequence += 1
+        self.index.retire(self.retainedSequence())
+
+    def retainedSequence(self) -> int:
+        ## The sequence number of the oldest chat action that can still be read
+        return self.firstSequence
 
-    def logServerMessage(self, messageString: str, visibility="public") -> None:
-        self.chat.append(self.chatAction(datetime.now(), "Server", messageString, visibility))
+    def getChatSize(self, chat: NamedTuple) -> int:
+        return sys.getsizeof(chat.message)
+
+    def getChat(self, sequence: int) -> Optional[NamedTuple]:
+        if sequence < self.firstSequence or sequence >= self.nextSequence: return None
+        return self.chat[sequence % self.capacity]
+
+    def getChatsBySequence(self, sequences: Iterable[int]) -> List[NamedTuple]:
+        return [chat for chat in map(self.getChat, sequences) if chat is not None]
+
+    def getChatsSince(self, sequence: int) -> Tuple[int, List[NamedTuple]]:
+        ## Returns the number of chat actions that were evicted before they could be read (the gap), and the retained chat actions
+        gap = max(0, self.firstSequence - sequence)
+        start = max(sequence, self.firstSequence)
+        return gap, [self.chat[seq % self.capacity] for seq in range(start, self.nextSequence)]
 
     def getNewChats(self, user: str) -> Optional[List[NamedTuple]]:
-        if self.userPointers.get(user) >= len(self.chat): return None
         pointer = self.userPointers.get(user)
-        self.userPointers[user] = len(self.chat)
-        ret = [chat for chat in self.chat[pointer:] if chat.visibility == "public" and chat.user != user]
+        if pointer >= self.nextSequence: return None
+        gap, chats = self.getChatsSince(pointer)
+        self.userPointers[user] = self.nextSequence
+        ret = [chat for chat in chats if chat.visibility == "public" and chat.user != user]
+        if gap > 0: ret.insert(0, self.createGapNotice(pointer, gap))
         return None if len(ret) == 0 else ret
 
-    def registerUser(self, user: str) -> None:
-        self.userPointers[user] = len(self.chat)
-        self.logServerMessage(f"{user} has just joined the server!")
+    def createGapNotice(self, sequence: int, gap: int) -> NamedTuple:
+        ## A reader that fell behind the evicted window is told how much it missed rather than pinning the old chat in memory
+        return self.chatAction(sequence, time.time(), "Server", f"{gap} messages were dropped before they could be delivered", "gap")
+
+    def registerUser(self, user: str, announcement: Optional[str] = None) -> None:
+        self.userPointers[user] = self.nextSequence
+        self.logServerMessage(announcement or f"{user} has just joined the server!")
     
-    def unregisterUser(self, user: str) -> None:
+    def unregisterUser(self, user: str, announcement: Optional[str] = None) -> None:
         del self.userPointers[user]
-        self.logServerMessage(f"{user} has just left the server!")
+        self.logServerMessage(announcement or f"{user} has just left the server!")
+
+    def commit(self) -> None:
+        ## Called once per iteration of the event loop, before the new chat actions are broadcast
+        pass
+
+    def maintain(self) -> None:
+        ## Called every HISTORY_MAINTENANCE_INTERVAL seconds, whether or not anything has been appended
+        pass
+
+    def close(self) -> None:
+        pass
 
 
 class messengingServer:
     def __init__(self) -> None:
-        self.registeredUsers: Dict[str, bool] = {}
         self.reservedNames = {"Server", "bot", "helper", "localhost"}
-        self.chat: chatObject = chatObject()
+        self.args: Optional[argparse.Namespace] = None
+        self.rooms: Dict[str, chatObject] = {}
+        self.userRooms: Dict[str, Set[str]] = {} ## The names of the rooms that each user is a member of
+        self.updatedRooms: Set[chatObject] = set() ## The rooms with chat actions that have not been broadcast yet
+        self.mailboxes: mailboxes = mailboxes() ## The direct messages held for offline users
+        self.chat: chatObject = self.createRoom(DEFAULT_ROOM)
+        self.encoders: Dict[int, request] = {protocol: encoder() for protocol, encoder in PROTOCOL_ENCODERS.items()}
         self.eventLoopFlag: bool = True
         self.logfile = "server.log"
-        logging.basicConfig(filename="server.log", level=logging.DEBUG)
-        self.userServices = {"User-Creation": self.__serviceUserCreation, "User-Message": self.__serviceUserMessage, "User-Command": self.__serviceUserCommand}
+        self.eventLog: eventLog = eventLog(self.logfile) ## Events are written to the log file by a background thread
+        self.userServices = {"User-Creation": self.__serviceUserCreation, "User-Message": self.__serviceUserMessage, "User-Command": self.__serviceUserCommand,
+                             "Server-Stats": self.__serviceServerStats, "Server-Profile": self.__serviceServerProfile, "Ping": self.__servicePing, "Pong": self.__servicePong}
+        self.userCommands = {"/history": self.commandHistory, "/search": self.commandSearch, "/from": self.commandFrom, "/since": self.commandSince,
+                             "/join": self.commandJoin, "/leave": self.commandLeave, "/rooms": self.commandRooms, "/msg": self.commandMessage}
+        self.commandResults: Dict[clientConnection, Iterator[bytes]] = {} ## The pages of query results still to be sent to each connection
+        self.commandLimit: int = 50 ## The default and maximum number of results returned by a query
+        self.maxCommandLimit: int = 500
+        self.commandPageSize: int = 20 ## Each page is a Chat-Update frame, of which one is sent per connection per loop iteration
+        self.commandPageBytes: int = 16384
+        self.resumeLimit: int = 1000 ## The most missed chat actions sent to a reconnecting client per room, beyond which they are a gap
+        self.compression: Optional[str] = "deflate" ## The compression offered to clients, where None disables it
+        self.compressionThreshold: int = 256 ## Frames smaller than this are sent uncompressed
+        self.compressionLevel: int = 6
+        self.outboundHighWatermark: int = 1048576 ## The slow consumer policy is applied once this many bytes are queued to a connection
+        self.outboundLowWatermark: int = 262144
+        self.slowConsumerPolicy: str = "coalesce"
+        self.slowConsumers: Set[clientConnection] = set() ## The connections to disconnect at the end of this pass of the event loop
+        self.pendingFlush: Set[clientConnection] = set() ## The connections with frames queued since they were last flushed
+        self.flushInterval: float = 0.0 ## The minimum seconds between flushes, where 0 flushes at the end of every pass of the event loop
+        self.nextFlush: float = 0.0
+        ## Every connection has at most one pending timer, for its handshake deadline before User-Creation and its liveness
+        ## check afterwards, where a value of 0 disables the timeout (or heartbeat)
+        self.timers: timerWheel = timerWheel(time.monotonic())
+        self.loopTime: float = time.monotonic() ## When select() last returned, which is when the events were received
+        self.handshakeTimeout: float = 10.0 ## The seconds a connection has to send User-Creation
+        self.heartbeatInterval: float = 30.0 ## The seconds of silence from a client before it is sent a Ping
+        self.idleTimeout: float = 90.0 ## The seconds of silence from a client (which answers Pings) before it is disconnected
+        self.maxSelectTimeout: float = 2.0 ## select() wakes up at least this often, so that exit() is noticed
+        ## A session's messages, and a connection's received bytes, are limited by token buckets, where a rate of 0 disables
+        ## the limit. Messages over the limit are rejected with a Throttle frame, while bytes over it defer further reads
+        self.messageRate: float = 50.0 ## The messages (and commands) per second that a session may send on average
+        self.messageBurst: float = 100.0
+        self.byteRate: float = 1048576.0 ## The bytes per second that a connection may send on average
+        self.byteBurst: float = 4194304.0
+        self.maxFramesPerPass: int = 32 ## The most frames serviced per connection per pass of the event loop, where 0 is unlimited
+        self.pendingReads: Set[clientConnection] = set() ## The connections with frames left buffered once they reached that
+        self.recvView: memoryview = memoryview(bytearray(65536)) ## Every connection receives into this, and copies what it received
+        ## The listening socket's options, where a buffer size of None leaves the operating system's default
+        self.backlog: int = socket.SOMAXCONN
+        self.sendBufferSize: Optional[int] = None
+        self.receiveBufferSize: Optional[int] = None
+        self.tcpNoDelay: bool = True ## The frames are already batched once per pass of the event loop, so Nagle only adds latency
+        self.acceptBatch: int = 256 ## The most connections accepted per readiness event of the listening socket
+        self.maxConnections: int = defaultMaxConnections() ## Connections beyond this are rejected as they are accepted, where 0 is unlimited
+        self.connectionRejection: bytes = self.encoders[1].createRawRequest("Server", "Server: The server is full, try again later", "Session-Rejection", "Text")
+        ## A newly started server can take over the listening socket and every session through a Unix socket (see handoff.py)
+        self.handoffPath: Optional[str] = None ## The handoff socket that this server listens on, where None disables it
+        self.takeoverPath: Optional[str] = None ## The handoff socket of the server that this one takes over from
+        self.handoffSocket: Optional[socket.socket] = None
+        self.handoffPeer: Optional[socket.socket] = None ## A server waiting to take over, which is handed over at the end of the pass
+        self.handoffTimeout: float = 10.0
+        self.handedOff: bool = False
+        self.metrics: Optional[metricsRegistry] = None ## None while metrics are disabled
+        self.metricsFile: str = "server-stats.txt"
+        ## A profiling window is opened and closed with SIGUSR2 or a Server-Profile request (see profiling.py)
+        self.profilingWindow: Optional[profilingWindow] = None ## None while no window is open
+        self.profilers: List[str] = ["cprofile", "memory"] ## The profilers of a window opened with SIGUSR2
+        self.profileDirectory: str = "."
+        self.profileSampleInterval: float = 0.005
         self.setupSignalHandlers()
 
-    def _setup(self, PORT: int) -> None:
+    def _setup(self, PORT: int, HOST: str = "127.0.0.1") -> None:
         self.PORT: int = PORT
-        self.HOST: str = "127.0.0.1"
+        self.HOST: str = HOST
         self.connections: connections = connections()
-        self.selector: selectors.DefaultSelector = selectors.DefaultSelector()
         self.serverSocket: socket.socket = None
+        self.eventLog.start()
         return self.__setupServerSocket()
 
     def setupSignalHandlers(self):
@@ -72,35 +236,202 @@ class messengingServer:
         try:
             signal.signal(signal.SIGINT, self.sig_handler)
         except AttributeError: pass ## Avoid errors caused by OS differences
+        try:
+            signal.signal(signal.SIGUSR1, self.metrics_handler)
+        except AttributeError: pass ## Avoid errors caused by OS differences
+        try:
+            signal.signal(signal.SIGUSR2, self.profile_handler)
+        except AttributeError: pass ## Avoid errors caused by OS differences
+
+    def enableMetrics(self, metricsFile: str = "server-stats.txt") -> None:
+        self.metrics = metricsRegistry()
+        self.metricsFile = metricsFile
+        self.loopWakeups = self.metrics.counter("loop.wakeups")
+        self.loopEvents = self.metrics.counter("loop.events")
+        self.connectionsAccepted = self.metrics.counter("connections.accepted")
+        self.connectionsRejected = self.metrics.counter("connections.rejected")
+        self.loopIteration = self.metrics.histogram("loop.iteration.seconds")
+        self.loopLag = self.metrics.histogram("loop.lag.seconds") ## The delay between an event becoming ready and being serviced
+        self.framesReceived = self.metrics.counter("frames.received")
+        self.bytesIn = self.metrics.counter("bytes.in")
+        self.bytesOut = self.metrics.counter("bytes.out")
+        self.sendCalls = self.metrics.counter("send.calls")
+        self.interestChanges = self.metrics.counter("loop.interest.changes")
+        self.framesCoalesced = self.metrics.counter("backpressure.frames.coalesced")
+        self.framesDropped = self.metrics.counter("backpressure.frames.dropped")
+        self.slowDisconnects = self.metrics.counter("backpressure.disconnects")
+        self.pingsSent = self.metrics.counter("liveness.pings")
+        self.idleDisconnects = self.metrics.counter("liveness.idle.disconnects")
+        self.handshakeTimeouts = self.metrics.counter("liveness.handshake.timeouts")
+        self.messagesThrottled = self.metrics.counter("ratelimit.messages.rejected")
+        self.readsPaused = self.metrics.counter("ratelimit.reads.paused")
+        self.readsDeferred = self.metrics.counter("loop.reads.deferred")
+        self.metrics.gauge("timers.pending", lambda: len(self.timers))
+        self.metrics.gauge("backpressure.congested", lambda: sum(conn.congested for conn in self.connections.filenoToConnection.values()))
+        self.metrics.gauge("connections", lambda: len(self.connections.filenoToConnection))
+        self.metrics.gauge("sessions", lambda: len(self.connections.userToConnection))
+        self.metrics.gauge("rooms", lambda: len(self.rooms))
+        self.metrics.gauge("chat.length", lambda: len(self.chat))
+        self.metrics.gauge("chat.bytes", lambda: self.chat.chatBytes)
+        self.metrics.gauge("outbound.frames.total", lambda: sum(len(conn.outbound) for conn in self.connections.filenoToConnection.values()))
+        self.metrics.gauge("outbound.frames.max", lambda: max((len(conn.outbound) for conn in self.connections.filenoToConnection.values()), default=0))
+        ## How far the most lagging client is behind, as the bytes queued to it that it has not yet been sent
+        self.metrics.gauge("outbound.bytes.total", lambda: sum(conn.unsentBytes() for conn in self.connections.filenoToConnection.values()))
+        self.metrics.gauge("outbound.bytes.max", lambda: max((conn.unsentBytes() for conn in self.connections.filenoToConnection.values()), default=0))
+        self.metrics.gauge("mailboxes.queued", lambda: len(self.mailboxes))
+        self.metrics.gauge("compression.bytes.in", lambda: sum(conn.compressor.inputBytes for conn in self.connections.filenoToConnection.values() if conn.compressor is not None))
+        self.metrics.gauge("compression.bytes.out", lambda: sum(conn.compressor.outputBytes for conn in self.connections.filenoToConnection.values() if conn.compressor is not None))
+        self.metrics.gauge("log.queued", lambda: len(self.eventLog.records))
+        self.metrics.gauge("log.dropped", lambda: self.eventLog.dropped)
+        self.metrics.gauge("log.written", lambda: self.eventLog.written)
 
-    def run(self) -> None:
-        args = self.parseArguments()
-        if self._setup(args.port) is True:
+    def run(self, args: Optional[argparse.Namespace] = None) -> None:
+        args = self.parseArguments() if args is None else args
+        self.args = args
+        ## A server taking over only opens the rooms (and their history) once the old server has stopped writing to them
+        if args.takeover is None: self.resetRooms()
+        self.eventLog = eventLog(self.logfile, args.log_format, args.log_queue_size)
+        self.configureDelivery(args)
+        self.configureTimeouts(args)
+        self.configureLimits(args)
+        self.configureSockets(args)
+        self.configureProfiling(args)
+        if args.metrics: self.enableMetrics(args.metrics_file)
+        if self._setup(args.port, args.host) is True:
             self.logDebug("Server", "Server-Setup", "Success")
+            if args.history_dir is not None: self.scheduleMaintenance()
             return self._executeEventLoop()
         else:
             self.logDebug("Server", "Server-Setup", "Failure")
         return False
 
+    def configureDelivery(self, args: argparse.Namespace) -> None:
+        ## Applies the options for how frames are sent to clients
+        self.compression = None if args.compression == "none" else args.compression
+        self.compressionThreshold, self.compressionLevel = args.compression_threshold, args.compression_level
+        self.outboundHighWatermark, self.slowConsumerPolicy = args.outbound_high_watermark, args.slow_consumer_policy
+        self.outboundLowWatermark = min(args.outbound_low_watermark, args.outbound_high_watermark)
+        self.flushInterval = args.flush_interval
+        self.resumeLimit = args.resume_limit
+
+    def configureTimeouts(self, args: argparse.Namespace) -> None:
+        self.handshakeTimeout, self.heartbeatInterval, self.idleTimeout = args.handshake_timeout, args.heartbeat_interval, args.idle_timeout
+
+    def configureLimits(self, args: argparse.Namespace) -> None:
+        self.messageRate, self.messageBurst = args.message_rate, args.message_burst
+        self.byteRate, self.byteBurst = args.byte_rate, args.byte_burst
+        self.maxFramesPerPass = args.max_frames_per_pass
+
+    def configureSockets(self, args: argparse.Namespace) -> None:
+        self.backlog, self.acceptBatch, self.tcpNoDelay = args.backlog, max(1, args.accept_batch), not args.no_tcp_nodelay
+        self.sendBufferSize, self.receiveBufferSize = args.send_buffer, args.receive_buffer
+        if args.max_connections is not None: self.maxConnections = args.max_connections
+        self.handoffPath, self.takeoverPath = args.handoff_socket, args.takeover
+
+    def configureProfiling(self, args: argparse.Namespace) -> None:
+        self.profilers, self.profileDirectory, self.profileSampleInterval = parseProfilers(args.profilers), args.profile_dir, args.profile_sample_interval
+
+    def resetRooms(self) -> None:
+        for room in self.rooms.values(): room.close()
+        self.rooms.clear()
+        self.updatedRooms.clear()
+        self.chat = self.createRoom(DEFAULT_ROOM)
+
+    def getRoom(self, name: str) -> chatObject:
+        ## NOTE: An empty chatObject is falsy (it has a length), so rooms are compared with None
+        room = self.rooms.get(name)
+        return self.createRoom(name) if room is None else room
+
+    def createRoom(self, name: str) -> chatObject:
+        room = self.createChatObject(name)
+        room.broadcastSequence = room.nextSequence ## Any chat restored from the history is not broadcast again
+        room.notify = self.updatedRooms.add
+        self.rooms[name] = room
+        return room
+
+    def createChatObject(self, name: str) -> chatObject:
+        args = self.args
+        if args is None: return chatObject(name=name)
+        if args.history_dir is None: return chatObject(args.chat_capacity, args.chat_max_bytes, name)
+        from history import chatHistory, durableChatObject
+        ## The default room's history is kept at the top of the directory, and every other room's in a subdirectory
+        directory = args.history_dir if name == DEFAULT_ROOM else os.path.join(args.history_dir, "rooms", name)
+        history = chatHistory(directory, args.history_segment_bytes, args.history_retention_bytes,
+                              args.history_retention_seconds, args.history_sync_interval, segmentSeconds=args.history_segment_seconds or None)
+        return durableChatObject(history, args.chat_capacity, args.chat_max_bytes, name, args.history_index_window, args.history_scan_limit)
+
+    def joinRoom(self, user: str, room: chatObject, announcement: Optional[str] = None) -> None:
+        room.registerUser(user, announcement)
+        self.userRooms.setdefault(user, set()).add(room.name)
+
+    def leaveRoom(self, user: str, room: chatObject, announcement: Optional[str] = None) -> None:
+        room.unregisterUser(user, announcement)
+        self.userRooms[user].discard(room.name)
+        if room.userPointers or room.name == DEFAULT_ROOM: return None
+        self.removeRoom(room)
+
+    def removeRoom(self, room: chatObject) -> None:
+        ## Rooms are removed once their last member has left, along with the in-memory copy of their log
+        del self.rooms[room.name]
+        self.updatedRooms.discard(room)
+        room.close()
+
     def _executeEventLoop(self) -> None:
         self.logDebug("Server", "Server-Running", "Success")
         while self.eventLoopFlag:
-            events = self.selector.select(timeout=2.0)
-            for selectorKey, bitmask in events:
-                if selectorKey.data == "ServerSocket":
-                    self.__acceptConnection()
-                else:
-                    self.__serviceConnection(selectorKey, bitmask)
+            events = self.selector.select(timeout=self.selectTimeout())
+            self.loopTime = time.monotonic()
+            if self.metrics is not None:
+                iterationStart = time.perf_counter()
+                self.loopWakeups.inc()
+                self.loopEvents.inc(len(events))
+            self.serviceEvents(events, iterationStart if self.metrics is not None else None)
+            if self.pendingReads: self.servicePendingReads()
+            if self.timers.count: self.timers.advance(self.loopTime)
+            self.broadcastNewChats()
+            if self.commandResults: self.serviceCommandResults()
+            if self.slowConsumers: self.disconnectSlowConsumers()
+            if self.pendingFlush: self.flushPending()
+            if self.handoffPeer is not None: self.handOver()
+            if self.metrics is not None: self.loopIteration.record(time.perf_counter() - iterationStart)
         try:
             print("Server is Terminating")
-            self.closeRemainingSessions()
-            self.closeRemainingConnections()
+            if self.profilingWindow is not None: self.closeProfilingWindow()
+            if not self.handedOff: ## Otherwise the connections were already released by handOver()
+                self.closeRemainingSessions()
+                self.closeRemainingConnections()
             self.serverSocket.close()
+            self.closeHandoffSocket()
+            for room in self.rooms.values(): room.close()
             self.logDebug("Server", "Server-Termination", "Success")
         except (KeyboardInterrupt, Exception):
-            self.logDebug("Server", "Server-Termination" "Warning")
+            self.logDebug("Server", "Server-Termination", "Warning")
+        self.eventLog.close()
 
 
+    def serviceEvents(self, events: List[Tuple[selectors.SelectorKey, int]], iterationStart: Optional[float] = None) -> None:
+        ## A connection's selector key holds the connection itself, so dispatching its event needs no lookups
+        for selectorKey, bitmask in events:
+            if iterationStart is not None: self.loopLag.record(time.perf_counter() - iterationStart)
+            conn = selectorKey.data
+            if isinstance(conn, clientConnection):
+                self.__serviceConnection(conn, bitmask)
+            elif conn == "ServerSocket":
+                self.__acceptConnections()
+            elif conn == "HandoffSocket":
+                self.acceptHandoff()
+            else:
+                self.serviceSelectorKey(selectorKey, bitmask)
+
+    def selectTimeout(self) -> float:
+        ## select() blocks until the next flush or timer is due, rather than waking up periodically to check for them
+        if self.commandResults or self.pendingReads: return 0
+        timeout, now = self.maxSelectTimeout, time.monotonic()
+        if self.pendingFlush: timeout = min(timeout, self.nextFlush - now)
+        deadline = self.timers.nextDeadline()
+        if deadline is not None: timeout = min(timeout, deadline - now)
+        return max(0.0, timeout)
+
     def closeRemainingSessions(self) -> None:
         for user, cc in list(self.connections.userToConnection.items()):
             self.closeSession(user, cc)
@@ -110,151 +441,892 @@ class messengingServer:
             self.connections.unregisterConnection(cc)
 
     def __setupServerSocket(self) -> None:
-        if self.__createServerSocket() == False: return False
-        self.__registerServerSocket()
+        if self.takeoverPath is not None: return self.takeOver()
+        if self.createServerSocket() == False: return False
+        self.registerServerSocket()
+        if self.handoffPath is not None and self.createHandoffSocket() == False: return False
         print(f"Server listening on {self.HOST}:{self.PORT}\n\n")
         return True
 
-    ##TODO: Provide exception handling for setting up the server sock
-    def __createServerSocket(self) -> bool:
+    def createServerSocket(self) -> bool:
         try:
-            self.serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.serverSocket.bind((self.HOST, self.PORT))
-            self.serverSocket.listen()
-            self.serverSocket.setblocking(False)
+            self.serverSocket = createListeningSocket(self.HOST, self.PORT, self.backlog, self.sendBufferSize, self.receiveBufferSize)
             return True
-        except OSError:
-            print(f"Socket Setup Error: The address has already been bound")
-        except socket.error as e:
-            print(f"Socket Setup Error: {e}")
+        except OSError as e:
+            if e.errno == errno.EADDRINUSE: print(f"Socket Setup Error: The address has already been bound")
+            else: print(f"Socket Setup Error: {e}")
         return False
 
-    def __registerServerSocket(self) -> None:
+    def registerServerSocket(self) -> None:
+        self.selector: selectors.DefaultSelector = selectors.DefaultSelector()
         self.selector.register(self.serverSocket, selectors.EVENT_READ, data="ServerSocket")
 
-    def __acceptConnection(self) -> None:
-        conn, _ = self.serverSocket.accept()
-        cc = clientConnection(conn)
-        hostname, port = cc.sock.getpeername()
+    def createHandoffSocket(self) -> bool:
+        ## A socket file left behind by a server that was killed, or that has handed over to this one, is replaced
+        ## NOTE: Whoever can connect to the handoff socket is handed every client socket, so only this user may connect
+        try:
+            if os.path.exists(self.handoffPath): os.unlink(self.handoffPath)
+            self.handoffSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.handoffSocket.bind(self.handoffPath)
+            os.chmod(self.handoffPath, 0o600)
+            self.handoffSocket.listen(1)
+            self.handoffSocket.setblocking(False)
+        except OSError as e:
+            print(f"Handoff Socket Setup Error: {e}")
+            return False
+        self.selector.register(self.handoffSocket, selectors.EVENT_READ, data="HandoffSocket")
+        return True
+
+    def closeHandoffSocket(self) -> None:
+        ## A server that has handed over leaves the socket file, which now belongs to the server that took over
+        if self.handoffSocket is None: return None
+        self.handoffSocket.close()
+        if not self.handedOff and os.path.exists(self.handoffPath): os.unlink(self.handoffPath)
+
+    def acceptHandoff(self) -> None:
+        try:
+            peer, _ = self.handoffSocket.accept()
+        except (BlockingIOError, InterruptedError): return None
+        if hasattr(socket, "SO_PEERCRED"):
+            _, uid, _ = struct.unpack("3i", peer.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+            if uid != os.getuid(): return peer.close()
+        if self.handoffPeer is not None: return peer.close()
+        self.handoffPeer = peer
+
+    def handOver(self) -> None:
+        ## Hands the listening socket and every connection over to the server that connected to the handoff socket, once
+        ## this pass of the event loop has broadcast and flushed what it could, and stops this server once it has them
+        peer, self.handoffPeer = self.handoffPeer, None
+        start = time.perf_counter()
+        self.prepareHandoff()
+        state, fds = self.exportState()
+        try:
+            peer.setblocking(True)
+            peer.settimeout(self.handoffTimeout)
+            sendHandoff(peer, state, fds)
+            acknowledged = peer.recv(1) == HANDOFF_ACK
+        except OSError:
+            acknowledged = False
+        if not acknowledged:
+            ## The new server is never sent the commit, so it gives the sockets up. The rooms were closed for it, so they
+            ## are opened again (with their cursors) to carry on serving
+            peer.close()
+            self.restoreRooms(state["rooms"])
+            return self.logDebug("Server", "Server-Handoff", "Failure")
+        ## The sockets are given up before the commit lets the new server serve them, so the two never serve them at once
+        self.handedOff = True
+        self.releaseConnections()
+        try:
+            peer.sendall(HANDOFF_COMMIT)
+        except OSError as e:
+            ## The new server gives up the sockets without the commit, so the connections are lost with both servers
+            self.logDebug("Server", "Server-Handoff", f"Failure: {e}")
+        else:
+            self.logDebug("Server", "Server-Handoff", f"Success: {len(fds) - 1} connections in {(time.perf_counter() - start) * 1e3:.1f}ms")
+        peer.close()
+        self.exit()
+
+    def prepareHandoff(self) -> None:
+        ## Any pages of query results are queued now, as the iterators producing them can not be handed over, and the rooms
+        ## are closed, so that their history is written out before the new server reads it back
+        for conn, pages in self.commandResults.items():
+            for frame in pages: self.queueFrame(conn, frame)
+        self.commandResults.clear()
+        self.nextFlush = 0.0
+        if self.pendingFlush: self.flushPending()
+        for room in self.rooms.values(): room.close()
+
+    def exportState(self) -> Tuple[Dict, List[int]]:
+        ## Returns the state of every room and connection as plain data, and the file descriptors to hand over, where the
+        ## listening socket comes first and then the connections, in the order of the state's connections
+        ## NOTE: The deflate streams can not be exported, but each frame was flushed with Z_SYNC_FLUSH, so a new stream
+        ##       continues where the old one ended (the client's inflater just never sees it refer back to the old frames)
+        conns = list(self.connections.filenoToConnection.values())
+        rooms = [{"name": room.name, "nextSequence": room.nextSequence, "userPointers": room.userPointers,
+                  "chats": [list(chat) for chat in room.getChatsSince(room.firstSequence)[1]]} for room in self.rooms.values()]
+        state = {"rooms": rooms, "connections": [self.exportConnection(conn) for conn in conns], "mailboxes": self.mailboxes.snapshot()}
+        return state, [self.serverSocket.fileno()] + [conn.fileno for conn in conns]
+
+    def exportConnection(self, conn: clientConnection) -> Dict:
+        ## Only the fields that differ from those of a new connection are exported, so an idle session's state stays small
+        state = {"user": conn.user, "protocol": conn.protocol, "peername": conn.peername}
+        if conn.compressor is not None: state["compressed"] = True
+        if conn.decoder.offset < len(conn.decoder.buffer): state["received"] = encodeBytes(conn.decoder.buffer[conn.decoder.offset:])
+        if conn.sending: state["sending"] = encodeBytes(b"".join(conn.sending))
+        if conn.outbound: state["outbound"] = [encodeBytes(frame) for frame in conn.outbound]
+        if conn.congested: state["skippedFrames"] = conn.skippedFrames
+        if conn.closing: state["closing"] = True
+        if conn.eof: state["eof"] = True
+        return state
+
+    def takeOver(self) -> bool:
+        ## Connects to the running server's handoff socket, and takes over its listening socket and sessions
+        start = time.perf_counter()
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as peer:
+                peer.settimeout(self.handoffTimeout)
+                peer.connect(self.takeoverPath)
+                state, fds = receiveHandoff(peer)
+                self.serverSocket = socket.socket(fileno=fds[0])
+                self.serverSocket.setblocking(False)
+                self.registerServerSocket()
+                self.restoreState(state, fds[1:])
+                peer.sendall(HANDOFF_ACK)
+                ## The sessions are only served once the old server has given up its copies of the sockets
+                if receiveExactly(peer, len(HANDOFF_COMMIT)) != HANDOFF_COMMIT: raise ConnectionError("The handoff was not committed")
+        except (OSError, ValueError) as e:
+            print(f"Takeover Error: {e}")
+            ## The old server may still be serving the connections, so only this server's copies of the sockets are closed
+            if self.serverSocket is not None: self.releaseConnections()
+            return False
+        self.HOST, self.PORT = self.serverSocket.getsockname()[:2]
+        if self.handoffPath is not None: self.createHandoffSocket()
+        self.logDebug("Server", "Server-Takeover", f"Success: {len(fds) - 1} connections in {(time.perf_counter() - start) * 1e3:.1f}ms")
+        print(f"Server took over {len(fds) - 1} connections on {self.HOST}:{self.PORT}\n\n")
+        return True
+
+    def restoreState(self, state: Dict, fds: List[int]) -> None:
+        self.restoreRooms(state["rooms"])
+        self.mailboxes.restore(state["mailboxes"])
+        ## Every connection was accepted from the listening socket, so its family is given rather than queried for each of them
+        family = self.serverSocket.family
+        for fd, connectionState in zip(fds, state["connections"]):
+            self.restoreConnection(socket.socket(family, socket.SOCK_STREAM, fileno=fd), connectionState)
+
+    def restoreRooms(self, rooms: List[Dict]) -> None:
+        ## The rooms are opened afresh (a durable room reads its chat back from its history), and any chat that this did
+        ## not restore is put back from the state, along with the members' cursors
+        self.resetRooms()
+        self.userRooms.clear()
+        for roomState in rooms:
+            room = self.getRoom(roomState["name"])
+            for chat in roomState["chats"]:
+                if chat[0] >= room.nextSequence: room.restoreChat(room.chatAction(*chat))
+            if len(room) == 0: room.firstSequence = room.nextSequence = max(room.nextSequence, roomState["nextSequence"])
+            room.broadcastSequence = room.nextSequence
+            room.userPointers.update(roomState["userPointers"])
+            for user in roomState["userPointers"]: self.userRooms.setdefault(user, set()).add(room.name)
+
+    def restoreConnection(self, sock: socket.socket, state: Dict) -> clientConnection:
+        cc = self.createConnection(sock, tuple(state["peername"]))
+        cc.setProtocol(state["protocol"])
+        if "compressed" in state: cc.setCompression(self.compressionThreshold, self.compressionLevel)
+        if "received" in state: cc.decoder.feed(decodeBytes(state["received"]))
+        if "sending" in state: cc.sending.append(decodeBytes(state["sending"]))
+        for frame in state.get("outbound", ()): cc.queueFrame(decodeBytes(frame))
+        if "skippedFrames" in state: cc.congested, cc.skippedFrames = True, state["skippedFrames"]
+        cc.closing, cc.eof = state.get("closing", False), state.get("eof", False)
         self.connections.registerConnection(cc)
-        self.selector.register(conn, selectors.EVENT_READ | selectors.EVENT_WRITE, data="connection")
-        logging.info(f"{datetime.now()}\t{hostname}\t{port}\tUndefined\tConnection-Accepted\tSuccess")
-        
+        self.selector.register(sock, selectors.EVENT_READ, data=cc)
+        if state["user"] is None:
+            self.startHandshakeTimer(cc)
+        else:
+            self.connections.registerUser(state["user"], cc)
+            cc.messageBucket = createBucket(self.messageRate, self.messageBurst, time.monotonic())
+            self.startLivenessTimer(cc)
+        ## Frames that were received but not serviced yet are serviced on the first pass, and anything queued is flushed
+        if "received" in state or cc.eof: self.pendingReads.add(cc)
+        if cc.sending or cc.outbound or cc.closing: self.pendingFlush.add(cc)
+        return cc
+
+    def releaseConnections(self) -> None:
+        ## This server's copies of the sockets are closed without shutting them down (or telling any client), so that the
+        ## connections stay open in the other server, whether it took over from this one or this one failed to take over
+        for conn in self.connections.filenoToConnection.values(): conn.close()
+        self.serverSocket.close()
+        self.selector.close()
+
+    def __acceptConnections(self) -> None:
+        ## Many clients may be queued in the backlog at once (such as during a reconnect storm), so they are accepted in
+        ## batches until it is empty, and only acceptBatch of them at a time so that the other connections are still serviced
+        for _ in range(self.acceptBatch):
+            try:
+                conn, address = self.serverSocket.accept()
+            except (BlockingIOError, InterruptedError): return None ## The backlog is empty, or another process sharing the socket accepted it first
+            except OSError as e:
+                ## Such as running out of file descriptors, in which case the rest are left in the backlog
+                return self.logDebug("Server", "Connection-Accepted", f"Failure: {e.strerror}")
+            if self.atConnectionLimit():
+                self.rejectConnection(conn)
+                continue
+            cc = self.createConnection(conn, address)
+            self.connections.registerConnection(cc)
+            ## EVENT_WRITE is only registered while the socket will not accept the queued frames, otherwise select() would never block
+            self.selector.register(conn, selectors.EVENT_READ, data=cc)
+            self.startHandshakeTimer(cc)
+            if self.metrics is not None: self.connectionsAccepted.inc()
+            self.logEvent(None, "Connection-Accepted", "Success", cc)
+
+    def atConnectionLimit(self) -> bool:
+        return self.maxConnections > 0 and len(self.connections.filenoToConnection) >= self.maxConnections
 
-    def __serviceConnection(self, selectorKey: selectors.SelectorKey, bitmask: int) -> None:
-        conn = self.connections.filenoToConnection[selectorKey.fd]
-        user = self.connections.userToConnection.inverse.get(conn)
+    def rejectConnection(self, sock: socket.socket) -> None:
+        ## The connection is never registered, and the pre-encoded rejection is sent (the socket's buffer is empty, so it
+        ## can not block) before it is closed. It is counted first, so the count already includes it once the client sees it
+        if self.metrics is not None: self.connectionsRejected.inc()
+        try:
+            sock.send(self.connectionRejection)
+        except OSError: pass
+        sock.close()
+
+    def createConnection(self, sock: socket.socket, address: Optional[tuple] = None) -> clientConnection:
+        if self.tcpNoDelay and sock.family in (socket.AF_INET, socket.AF_INET6): sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        cc = clientConnection(sock, self.recvView, address)
+        cc.byteBucket = createBucket(self.byteRate, self.byteBurst, time.monotonic())
+        if self.metrics is not None: cc.bytesInCounter, cc.bytesOutCounter, cc.sendCallsCounter = self.bytesIn, self.bytesOut, self.sendCalls
+        return cc
+
+    def serviceSelectorKey(self, selectorKey: selectors.SelectorKey, bitmask: int) -> None:
+        ## Services any other file objects that subclasses register with the selector
+        pass
 
-        if bitmask & selectors.EVENT_READ:
-            message = conn.receiveRequest()
-            if message == None:
+    def __serviceConnection(self, conn: clientConnection, bitmask: int) -> None:
+        ## A connection with frames still buffered from an earlier pass is not read from until they have been serviced
+        if bitmask & selectors.EVENT_READ and not conn.closing and conn not in self.pendingReads:
+            conn.lastActivity = self.loopTime
+            if self.serviceFrames(conn.user, conn, conn.receiveRequests()) is False: return None
+            if conn.eof:
                 # print("The connection has been closed by the client")
-                return self.closeSession(user, conn)
-            elif user == None and message["Headers"]["Message-Type"] != "User-Creation":
-                # print("You're first message must be a user-creation type message")
-                return self.closeSession(user, conn)
-            elif user != None and message["Headers"]["Message-Type"] == "User-Creation":
-                # print("You can only register a single user on a connection")
-                return self.closeSession(user, conn)
-            else:
-                self.__serviceMessage(message, conn)
+                if conn not in self.pendingReads: return self.closeSession(conn.user, conn)
+            elif conn.byteBucket is not None and conn.byteBucket.tokens < 0:
+                self.pauseReading(conn)
 
         if bitmask & selectors.EVENT_WRITE:
-            isRegistered = self.registeredUsers.get(user)
-            if isRegistered == False:
-                conn.sendRequest(user="Server", message="Server: Succesfully registed", messageType="User-Creation")
-                self.registeredUsers[user] = True
-            elif isRegistered == True:
-                self.pushUpdatedChats(conn)
+            self.flushConnection(conn.user, conn)
+
+    def serviceFrames(self, user: Optional[str], conn: clientConnection, frames: Iterable[Dict]) -> bool:
+        ## Several frames may have been pipelined into a single receive, so every complete frame is serviced, up to
+        ## maxFramesPerPass of them. Any others are left buffered for the next pass of the event loop, so that a client
+        ## pipelining many frames is served in turn with the others rather than holding them up
+        ## Returns False if the connection has been (or is being) closed
+        serviced = 0
+        try:
+            for message in frames:
+                if self.metrics is not None: self.framesReceived.inc()
+                messageType = message["Headers"]["Message-Type"]
+                if user == None and messageType != "User-Creation":
+                    # print("You're first message must be a user-creation type message")
+                    self.closeSession(user, conn)
+                    return False
+                elif user != None and messageType == "User-Creation":
+                    # print("You can only register a single user on a connection")
+                    self.closeSession(user, conn)
+                    return False
+                if conn.messageBucket is None or messageType not in RATE_LIMITED_TYPES or self.admitMessage(conn):
+                    self.__serviceMessage(message, conn)
+                    if conn.closing: return False
+                    user = conn.user
+                    ## A cluster worker creates the session once the bus has reserved the name, and the frames behind it wait
+                    if user is None: break
+                serviced += 1
+                if serviced == self.maxFramesPerPass:
+                    self.pendingReads.add(conn)
+                    if self.metrics is not None: self.readsDeferred.inc()
+                    break
+        except (ValueError, KeyError):
+            # print("The frame could not be decoded")
+            self.closeSession(user, conn)
+            return False
+        return True
+
+    def servicePendingReads(self) -> None:
+        ## Services the next frames of each connection that had frames left buffered, in turn
+        pendingReads = list(self.pendingReads)
+        self.pendingReads.clear()
+        for conn in pendingReads:
+            if conn.closing or not self.connections.isRegistered(conn): continue
+            if self.serviceFrames(conn.user, conn, conn.bufferedRequests()) is False: continue
+            if conn not in self.pendingReads: self.finishPendingReads(conn)
+
+    def finishPendingReads(self, conn: clientConnection) -> None:
+        ## Called once every frame buffered on the connection has been serviced
+        if conn.eof: self.closeSession(conn.user, conn)
+
+    def admitMessage(self, conn: clientConnection) -> bool:
+        ## Returns whether the session's rate limit admits another message, and tells the client once when it does not
+        bucket = conn.messageBucket
+        wasLimited = bucket.limited
+        if bucket.consume(time.monotonic()): return True
+        if self.metrics is not None: self.messagesThrottled.inc()
+        if not wasLimited:
+            retryAfter = bucket.retryAfter()
+            self.queueFrame(conn, self.encodeFrame(conn, "Server", f"Server: You are sending messages too quickly, so they are being dropped for {retryAfter:.1f}s",
+                                                   "Throttle", {"Retry-After": f"{retryAfter:.3f}"}))
+            self.logEvent(conn.user, "Rate-Limited", "Warning", conn)
+        return False
+
+    def pauseReading(self, conn: clientConnection) -> None:
+        ## The peer has sent more bytes than its rate limit allows, so nothing more is read from it until that has been
+        ## repaid, and meanwhile TCP flow control pushes back on the peer rather than the server buffering its bytes
+        self.setReadInterest(conn, False)
+        conn.resumeTimer = self.scheduleTimer(time.monotonic() + conn.byteBucket.retryAfter(0.0), self.resumeReading, conn)
+        if self.metrics is not None: self.readsPaused.inc()
+
+    def resumeReading(self, conn: clientConnection) -> None:
+        conn.resumeTimer = None
+        if conn.closing or not self.connections.isRegistered(conn): return None
+        self.setReadInterest(conn, True)
+
+    def queueFrame(self, conn: clientConnection, frame: bytes) -> None:
+        if conn.queueFrame(frame): self.pendingFlush.add(conn)
+        ## Frames queued within a pass of the event loop are flushed at its end, so the queue is only a backlog (rather than
+        ## a burst) while the socket is not accepting frames
+        if conn.outboundBytes > self.outboundHighWatermark and conn.writeInterest: self.relieveBackpressure(conn)
+
+    def relieveBackpressure(self, conn: clientConnection) -> None:
+        ## The client is not reading as fast as frames are queued to it, so the queue is bounded by the slow consumer policy
+        ## rather than letting it grow without limit, and the other connections are never made to wait for it
+        if self.slowConsumerPolicy == "drop-oldest":
+            ## The oldest frames are dropped down to the low watermark, so this is not repeated for every new frame
+            dropped = conn.dropOldest(self.outboundLowWatermark)
+            if self.metrics is not None: self.framesDropped.inc(dropped)
+        elif self.slowConsumerPolicy == "coalesce":
+            ## The queued broadcasts, and any until the client catches up, are replaced by a single summary frame, while
+            ## its direct messages and replies stay queued
+            conn.congested = True
+            skipped = conn.dropBroadcasts()
+            conn.skippedFrames += skipped
+            if self.metrics is not None: self.framesCoalesced.inc(skipped)
+        elif conn not in self.slowConsumers:
+            conn.clearOutbound()
+            self.slowConsumers.add(conn)
+            if self.metrics is not None: self.slowDisconnects.inc()
+        else:
+            conn.clearOutbound()
+
+    def skipFrame(self, conn: clientConnection) -> None:
+        conn.skippedFrames += 1
+        if self.metrics is not None: self.framesCoalesced.inc()
+
+    def endCongestion(self, conn: clientConnection) -> None:
+        ## Called once a congested client has read everything that was sent to it
+        skipped, conn.skippedFrames, conn.congested = conn.skippedFrames, 0, False
+        self.queueFrame(conn, self.encodeFrame(conn, "Server", f"Server: You fell behind, so {skipped} updates were skipped (use /history to catch up)", "Chat-Update"))
+
+    def disconnectSlowConsumers(self) -> None:
+        ## Slow consumers are disconnected after the broadcasts, as a session can not be closed while it is being broadcast to
+        slowConsumers = list(self.slowConsumers)
+        self.slowConsumers.clear()
+        for conn in slowConsumers:
+            if not self.connections.isRegistered(conn): continue
+            self.disconnectSlowConsumer(conn.user, conn)
+
+    def disconnectSlowConsumer(self, user: Optional[str], conn: clientConnection) -> None:
+        ## The termination is sent if the socket will accept it, but the session is closed either way
+        conn.clearOutbound()
+        conn.queueFrame(self.encodeFrame(conn, "Server", "Server: You were disconnected as you fell too far behind", "Session-Termination"))
+        try:
+            conn.flushFrames()
+        except OSError: pass
+        self.closeSession(user, conn)
+
+    def flushPending(self) -> None:
+        ## Frames queued during a pass of the event loop (or during a tick of flushInterval) are written together, with a
+        ## single sendmsg() per connection, rather than waiting for EVENT_WRITE and sending each frame on its own
+        ## NOTE: A longer flushInterval batches more frames into each syscall and TCP segment, at the cost of added latency
+        now = time.monotonic()
+        if now < self.nextFlush: return None
+        self.nextFlush = now + self.flushInterval
+        pendingFlush = list(self.pendingFlush)
+        self.pendingFlush.clear()
+        for conn in pendingFlush:
+            self.flushConnection(conn.user, conn)
+
+    def flushConnection(self, user: str, conn: clientConnection) -> None:
+        ## Connections are only registered for EVENT_WRITE while the socket would not accept all of their queued frames
+        try:
+            drained = conn.flushFrames()
+        except OSError:
+            return self.closeSession(user, conn)
+        ## The summary frame is queued (and flushed with the next tick) once the client has caught up
+        if drained and conn.congested: self.endCongestion(conn)
+        if drained and conn.closing: return self.finishClosingConnection(conn)
+        self.setWriteInterest(conn, not drained)
+
+    def setWriteInterest(self, conn: clientConnection, interest: bool) -> None:
+        if conn.writeInterest == interest: return None
+        conn.writeInterest = interest
+        self.updateInterest(conn)
+
+    def setReadInterest(self, conn: clientConnection, interest: bool) -> None:
+        if conn.readPaused != interest: return None
+        conn.readPaused = not interest
+        self.updateInterest(conn)
+
+    def updateInterest(self, conn: clientConnection) -> None:
+        ## A selector can not hold a file object without any events, so a connection with neither interest is unregistered
+        events = (0 if conn.readPaused else selectors.EVENT_READ) | (selectors.EVENT_WRITE if conn.writeInterest else 0)
+        registered = conn.sock in self.selector.get_map()
+        if events == 0:
+            if registered: self.selector.unregister(conn.sock)
+        elif registered:
+            self.selector.modify(conn.sock, events, data=conn)
+        else:
+            self.selector.register(conn.sock, events, data=conn)
+        if self.metrics is not None: self.interestChanges.inc()
+
+    def finishClosingConnection(self, conn: clientConnection) -> None:
+        self.pendingFlush.discard(conn)
+        self.pendingReads.discard(conn)
+        self.releaseTimers(conn)
+        self.connections.unregisterConnection(conn)
+        self.detachConnection(conn)
+        conn.close()
+
+    def detachConnection(self, conn: clientConnection) -> None:
+        if conn.sock in self.selector.get_map(): self.selector.unregister(conn.sock)
+
+    def closeAfterFlush(self, conn: clientConnection) -> None:
+        conn.closing = True
      
-    def closeSession(self, user: str, conn: clientConnection) -> None:
+    def closeSession(self, user: Optional[str], conn: clientConnection) -> None:
         try:
-            self.logEvent(user, "Session-Termination", "Success")
-            self.logEvent(user, "Connection-Termination", "Success")
-            hostname, port = conn.sock.getpeername()
-            print(f"{datetime.now()}\t{hostname}\t{port}\t{user}\tSession-Termination")
-            self.selector.unregister(conn.sock)
+            self.logEvent(user, "Session-Termination", "Success", conn)
+            self.logEvent(user, "Connection-Termination", "Success", conn)
+            self.detachConnection(conn)
             self.connections.close(user, conn)
-            self.chat.unregisterUser(user)
-            del self.registeredUsers[user]
+            self.commandResults.pop(conn, None)
+            self.slowConsumers.discard(conn)
+            self.pendingFlush.discard(conn)
+            self.pendingReads.discard(conn)
+            self.releaseTimers(conn)
+            ## A connection that never created a session has no user to unregister
+            if user is None: return None
+            for name in list(self.userRooms.get(user, ())):
+                self.leaveRoom(user, self.rooms[name])
+            del self.userRooms[user]
         except Exception:
-            self.logEvent(user, "Session-Termination", "Warning")
-            self.logEvent(user, "Connection-Termination", "Warning")
+            self.logEvent(user, "Session-Termination", "Warning", conn)
+            self.logEvent(user, "Connection-Termination", "Warning", conn)
 
 
 
-    def createSession(self, user: str, conn: clientConnection) -> None:
+    def createSession(self, user: str, conn: clientConnection, protocol: int = 1, compression: Optional[str] = None,
+                      resume: Optional[Dict[Optional[str], int]] = None) -> None:
         ## This registers a new user to the new connection
-        hostname, port = conn.sock.getpeername()
-        print(f"{datetime.now()}\t{hostname}\t{port}\t{user}\tSession-Creation")
-        self.registeredUsers[user] = False ##TODO: Consider redundant variable
         self.connections.registerUser(user, conn)
-        self.chat.registerUser(user)
-        self.logEvent(user, "Session-Creation", "Success")
+        ## The acknowledgement is sent with the protocol that the client offered it on, and any later frames with the negotiated one
+        headers = {"Protocol": str(protocol)} if protocol > 1 else {}
+        if compression is not None: headers["Compression"] = compression
+        self.queueFrame(conn, self.encodeFrame(conn, "Server", "Server: Succesfully registed", "User-Creation", headers or None))
+        conn.setProtocol(protocol)
+        if compression is not None: conn.setCompression(self.compressionThreshold, self.compressionLevel)
+        resume = resume or {}
+        self.resumeRoom(user, conn, DEFAULT_ROOM, resume.pop(None, None))
+        for name, sequence in resume.items():
+            if name != DEFAULT_ROOM and ROOM_NAME_PATTERN.fullmatch(name): self.resumeRoom(user, conn, name, sequence)
+        self.replayMailbox(user, conn)
+        conn.messageBucket = createBucket(self.messageRate, self.messageBurst, time.monotonic())
+        self.startLivenessTimer(conn)
+        self.logEvent(user, "Session-Creation", "Success", conn)
         
 
+    def scheduleTimer(self, deadline: float, callback: Callable[[clientConnection], None], conn: clientConnection) -> timer:
+        return self.timers.schedule(deadline, callback, conn)
+
+    def setTimer(self, conn: clientConnection, deadline: float, callback: Callable[[clientConnection], None]) -> None:
+        ## Replaces the connection's pending timer
+        self.timers.cancel(conn.timer)
+        conn.timer = self.scheduleTimer(deadline, callback, conn)
+
+    def cancelTimer(self, conn: clientConnection) -> None:
+        self.timers.cancel(conn.timer)
+        conn.timer = None
+
+    def releaseTimers(self, conn: clientConnection) -> None:
+        ## Called as the connection is closed, which also cancels any deferred resumption of its reads
+        self.cancelTimer(conn)
+        self.timers.cancel(conn.resumeTimer)
+        conn.resumeTimer = None
+
+    def scheduleMaintenance(self) -> None:
+        ## The timer carries no connection, and reschedules itself for as long as the server runs
+        interval = HISTORY_MAINTENANCE_INTERVAL
+        if self.args.history_sync_interval > 0: interval = min(interval, self.args.history_sync_interval)
+        self.scheduleTimer(time.monotonic() + interval, self.maintainRooms, None)
+
+    def maintainRooms(self, _: None) -> None:
+        for room in self.rooms.values(): room.maintain()
+        self.scheduleMaintenance()
+
+    def startHandshakeTimer(self, conn: clientConnection) -> None:
+        if self.handshakeTimeout > 0: self.setTimer(conn, time.monotonic() + self.handshakeTimeout, self.handshakeExpired)
+
+    def handshakeExpired(self, conn: clientConnection) -> None:
+        ## Connections that never send User-Creation would otherwise hold their socket (and a file descriptor) forever
+        self.cancelTimer(conn)
+        if conn.closing or conn.user is not None or not self.connections.isRegistered(conn): return None
+        self.logEvent(None, "Handshake-Timeout", "Warning", conn)
+        if self.metrics is not None: self.handshakeTimeouts.inc()
+        self.reapConnection(None, conn)
+
+    def startLivenessTimer(self, conn: clientConnection) -> None:
+        ## The time of the last activity is only recorded as bytes are received, and is checked once the timer fires, so
+        ## receiving a frame never touches the timer wheel
+        conn.lastActivity = time.monotonic()
+        intervals = [interval for interval in (self.heartbeatInterval, self.idleTimeout) if interval > 0]
+        if intervals: self.setTimer(conn, conn.lastActivity + min(intervals), self.checkLiveness)
+        else: self.cancelTimer(conn)
+
+    def checkLiveness(self, conn: clientConnection) -> None:
+        self.cancelTimer(conn)
+        user = conn.user
+        if user is None or conn.closing: return None
+        now = time.monotonic()
+        idle = now - conn.lastActivity
+        if self.idleTimeout > 0 and idle >= self.idleTimeout:
+            ## The client did not answer the Ping, so its network has most likely vanished (a half-open connection)
+            self.logEvent(user, "Idle-Timeout", "Warning", conn)
+            if self.metrics is not None: self.idleDisconnects.inc()
+            return self.reapConnection(user, conn)
+        if self.heartbeatInterval > 0 and idle >= self.heartbeatInterval:
+            self.queueFrame(conn, self.encodeFrame(conn, "Server", "", "Ping"))
+            if self.metrics is not None: self.pingsSent.inc()
+            return self.setTimer(conn, (conn.lastActivity + self.idleTimeout) if self.idleTimeout > 0 else (now + self.heartbeatInterval), self.checkLiveness)
+        intervals = [interval for interval in (self.heartbeatInterval, self.idleTimeout) if interval > 0]
+        self.setTimer(conn, conn.lastActivity + min(intervals), self.checkLiveness)
+
+    def reapConnection(self, user: Optional[str], conn: clientConnection) -> None:
+        ## The socket is closed without flushing, as the peer is presumed to be gone
+        conn.clearOutbound()
+        self.closeSession(user, conn)
+
+    def resumeRoom(self, user: str, conn: clientConnection, name: str, sequence: Optional[int]) -> None:
+        ## A reconnecting client rejoins the rooms it was in, and is sent the chat actions that it missed in each of them
+        ## (those after the sequence number that it presented) ahead of the room's new chat, rather than the whole history
+        existed = name in self.rooms
+        room = self.getRoom(name)
+        pointer = room.nextSequence
+        self.joinRoom(user, room, None if name == DEFAULT_ROOM else f"{user} has joined {name}")
+        ## A room that has since been removed and created again has restarted its sequence numbers
+        if sequence is None or not existed or sequence + 1 >= pointer: return None
+        self.sendMissedChats(user, conn, room, sequence + 1, pointer)
+
+    def sendMissedChats(self, user: str, conn: clientConnection, room: chatObject, start: int, end: int) -> None:
+        ## Chat actions that were evicted, or that are more than resumeLimit behind, are reported as a gap instead
+        floor = max(start, end - self.resumeLimit)
+        gap, chats = room.getChatsSince(floor)
+        gap += floor - start
+        if gap > 0: self.queueFrame(conn, self.encodeChat(conn, room, room.createGapNotice(start, gap), gap))
+        for chat in chats:
+            if chat.sequence >= end: break
+            if chat.visibility == "public" and chat.user != user: self.queueFrame(conn, self.encodeChat(conn, room, chat))
+
     def rejectSessionCreation(self, user: str, conn: clientConnection) -> None:
         ## This closes a connection that attempt to register a new user that violated some condition
-        message = f"Server: The username {user} is either in use or a reserved username."
+        message = f"Server: The username {user} is either in use, reserved, or not up to 32 letters, digits, _ or -."
         messageType = "Session-Rejection"
-        conn.sendRequest(user, messageType=messageType, message=message, contentType="Text")
-        self.connections.unregisterConnection(conn)
-        self.selector.unregister(conn.sock)
-        self.logEvent(user, "Session-Rejection", message)
-        conn.close()
+        ## The connection is closed once the rejection has been flushed to the client, and the rejected name is only
+        ## echoed in the (escaped) body
+        self.queueFrame(conn, self.encodeFrame(conn, "Server", message, messageType))
+        self.closeAfterFlush(conn)
+        self.logEvent(user, "Session-Rejection", message, conn)
 
 
     def __serviceMessage(self, message: str, conn: clientConnection) -> None:
         messageString, messageUser, messageType = self.__extractDataFromMessage(message)
+        ## Once a session has been created, its frames are only ever acted on as the user it registered (conn.user), and a
+        ## frame that claims to be from anyone else is rejected, so a client can not speak or send direct messages as another user
+        if conn.user is not None and messageUser != conn.user:
+            self.logEvent(conn.user, "User-Mismatch", f"A {messageType} frame claimed to be from {messageUser}", conn)
+            return self.sendReply(conn, f"Server: This session is registered as {conn.user}, so frames from {messageUser} are rejected")
+        start = time.perf_counter() if self.metrics is not None else None
         try:
-            self.userServices[messageType](conn=conn, user=messageUser, message=messageString)
+            self.userServices[messageType](conn=conn, user=messageUser, message=messageString, headers=message["Headers"])
         except KeyError: return print(f"Message-Type not found: {messageType}")
+        if start is not None: self.metrics.histogram(f"handler.{messageType}.seconds").record(time.perf_counter() - start)
 
     def __extractDataFromMessage(self, message: Dict[str, Union[Dict[str, str], str]]) -> Iterable[str]:
         return message["Body"], message["Headers"]["User"], message["Headers"]["Message-Type"]
 
-    def pushUpdatedChats(self, conn: clientConnection) -> None:
-        try:
-            user = self.connections.userToConnection.inverse[conn]
-        except KeyError: return None
-        ##We get the chats that the user has missed
-        chats = self.chat.getNewChats(user)
-        if chats == None: return None
-        ##We now need to decide how we will send this -- We can either send it grouped, or individually. I personally would go with through grouped
-        messageString = self.generateUpdatedChatMessage(chats)
-        ##We then create a request and send it to the session endpoint
-        conn.sendRequest(user="Server", message=messageString, messageType="Chat-Update")
+    def broadcastNewChats(self) -> None:
+        ## Only the rooms that have been appended to since the last broadcast are visited
+        if not self.updatedRooms: return None
+        rooms = list(self.updatedRooms)
+        self.updatedRooms.clear() ## The set is cleared rather than replaced, as the rooms hold a reference to its add()
+        for room in rooms: self.broadcastRoom(room)
+
+    def broadcastRoom(self, room: chatObject) -> None:
+        ## Each new public chat action is encoded once into an immutable frame, which is then queued by reference
+        ## to every member of the room. The cost is therefore proportional to the new chats plus the sends, not the
+        ## backlog, and the members of other rooms are never visited
+        if room.broadcastSequence >= room.nextSequence: return None
+        room.commit() ## The new chat actions are written before they are delivered, though only synced every syncInterval
+        gap, chats = room.getChatsSince(room.broadcastSequence)
+        room.broadcastSequence = room.nextSequence
+        userToConnection = self.connections.userToConnection
+        subscribers = [(user, userToConnection[user], pointer) for user, pointer in room.userPointers.items() if user in userToConnection]
+        if gap > 0:
+            chats.insert(0, room.createGapNotice(chats[0].sequence - gap, gap))
+        for chat in chats:
+            if chat.visibility not in ("public", "gap"): continue
+            frames: Dict[int, bytes] = {} ## The frame is encoded once for each protocol in use
+            for user, conn, pointer in subscribers:
+                ## Users only receive the chat from after they joined, and never their own messages
+                if chat.sequence >= pointer and chat.user != user:
+                    if conn.congested:
+                        self.skipFrame(conn)
+                        continue
+                    frame = frames.get(conn.protocol)
+                    if frame is None:
+                        frame = frames[conn.protocol] = broadcastFrame(self.encodeChat(conn, room, chat, gap))
+                    self.queueFrame(conn, frame)
+        for user, _, _ in subscribers:
+            room.userPointers[user] = room.broadcastSequence
+
+    def encodeFrame(self, conn: clientConnection, user: str, message: str, messageType: str, headers: Optional[Dict[str, str]] = None) -> bytes:
+        return self.encoders[conn.protocol].createRawRequest(user, message, messageType, "Text", headers)
+
+    def encodeChat(self, conn: clientConnection, room: chatObject, chat: NamedTuple, gap: int = 0) -> bytes:
+        ## Chat-Updates carry the chat action's sequence number, which a client presents to resume from if it reconnects
+        ## NOTE: A gap notice has the sequence number of the first chat action that was dropped, and the number dropped
+        headers = {"Sequence": str(chat.sequence)}
+        if chat.visibility == "gap": headers["Gap"] = str(gap)
+        if room.name != DEFAULT_ROOM: headers["Room"] = room.name
+        return self.encodeFrame(conn, "Server", self.generateUpdatedChatMessage([chat]), "Chat-Update", headers)
 
     def generateUpdatedChatMessage(self, chats: List[NamedTuple]):
         return "".join([f"{chat.user}: {chat.message}" for chat in chats])
 
     def __serviceUserCommand(self, **kwargs) -> None:
-        self.logMessage(kwargs["user"], "User-Command", kwargs["message"])
-        raise NotImplementedError
+        ## Commands apply to the room named by the Room header (the default room if there is none), and queries are
+        ## answered from that room's index, with their results queued to be sent a page at a time
+        conn = kwargs["conn"]
+        user = conn.user
+        command, _, argument = kwargs["message"].strip().partition(" ")
+        if command not in self.userCommands:
+            ## The client's text is only echoed in the body, which is escaped, as a header value can not hold a line break
+            return self.sendReply(conn, f"Server: Unknown command {command}, the commands are {', '.join(self.userCommands)}", "unknown")
+        try:
+            room = self.getMemberRoom(user, kwargs["headers"])
+            room.index.scanCutoff = None
+            sequences = self.userCommands[command](user, conn, room, argument.strip())
+        except ValueError as e:
+            return self.sendReply(conn, f"Server: {e}", command)
+        if sequences is not None: self.queueCommandResults(conn, command, room.getChatsBySequence(sequences), room, room.index.scanCutoff)
+
+    def getMemberRoom(self, user: str, headers: Dict[str, str]) -> chatObject:
+        name = headers.get("Room", DEFAULT_ROOM)
+        room = self.rooms.get(name)
+        if room is None or user not in room.userPointers: raise ValueError(f"You are not in the room {name}")
+        return room
+
+    def commandHistory(self, user: str, conn: clientConnection, room: chatObject, argument: str) -> List[int]:
+        return room.index.history(parseLimit(argument, self.commandPageSize, self.maxCommandLimit))
+
+    def commandSearch(self, user: str, conn: clientConnection, room: chatObject, argument: str) -> List[int]:
+        terms = tokenize(argument)
+        if not terms: raise ValueError("Usage: /search <terms>")
+        return room.index.search(terms, self.commandLimit)
+
+    def commandFrom(self, user: str, conn: clientConnection, room: chatObject, argument: str) -> List[int]:
+        sender, _, count = argument.partition(" ")
+        if sender == "": raise ValueError("Usage: /from <user> [count]")
+        return room.index.fromUser(sender, parseLimit(count.strip(), self.commandLimit, self.maxCommandLimit))
+
+    def commandSince(self, user: str, conn: clientConnection, room: chatObject, argument: str) -> List[int]:
+        if argument == "": raise ValueError("Usage: /since <time>")
+        return room.index.since(parseTime(argument, time.time()), self.commandLimit)
+
+    def commandJoin(self, user: str, conn: clientConnection, room: chatObject, argument: str) -> None:
+        ## Rooms are created when they are first joined, and the member is told of the join by its announcement
+        if not ROOM_NAME_PATTERN.fullmatch(argument): raise ValueError("Usage: /join <room>, where a room name is up to 32 letters, digits, _ or -")
+        target = self.getRoom(argument)
+        if user in target.userPointers: raise ValueError(f"You are already in the room {argument}")
+        self.joinRoom(user, target, f"{user} has joined {argument}")
+
+    def commandLeave(self, user: str, conn: clientConnection, room: chatObject, argument: str) -> None:
+        name = argument or room.name
+        target = self.rooms.get(name)
+        if name == DEFAULT_ROOM: raise ValueError(f"You cannot leave the room {DEFAULT_ROOM}")
+        if target is None or user not in target.userPointers: raise ValueError(f"You are not in the room {name}")
+        self.leaveRoom(user, target, f"{user} has left {name}")
+        self.sendReply(conn, f"Server: You have left {name}", "/leave", target)
+
+    def commandRooms(self, user: str, conn: clientConnection, room: chatObject, argument: str) -> None:
+        lines = [f"{name} ({len(self.rooms[name].userPointers)} members){' *' if name in self.userRooms[user] else ''}" for name in sorted(self.rooms)]
+        self.queueCommandLines(conn, "/rooms", lines)
+
+    def commandMessage(self, user: str, conn: clientConnection, room: chatObject, argument: str) -> None:
+        recipient, _, message = argument.partition(" ")
+        if not USERNAME_PATTERN.fullmatch(recipient) or message.strip() == "":
+            raise ValueError("Usage: /msg <user> <message>, where a username is up to 32 letters, digits, _ or -")
+        if recipient in self.reservedNames or recipient == user: raise ValueError(f"You cannot send direct messages to {recipient}")
+        delivered = self.routeDirectMessage(DirectMessage(time.time(), user, recipient, message))
+        self.sendReply(conn, f"Server: Sent to {recipient}" if delivered else f"Server: {recipient} is offline, and will receive the message when they next log in", "/msg")
+
+    def routeDirectMessage(self, dm: NamedTuple) -> bool:
+        ## Routing is a lookup of the recipient's connection, so its cost does not depend on the number of users or messages
+        ## Returns False if the recipient is offline, and the message has been held in their mailbox
+        conn = self.connections.userToConnection.get(dm.recipient)
+        if conn is None:
+            self.mailboxes.deliver(dm)
+            return False
+        self.deliverDirectMessage(conn, dm)
+        return True
+
+    def deliverDirectMessage(self, conn: clientConnection, dm: NamedTuple, headers: Optional[Dict[str, str]] = None) -> None:
+        self.queueFrame(conn, self.encodeFrame(conn, "Server", f"{dm.sender}: {dm.message}", "Chat-Update", dict(headers or {}, Direct=dm.sender)))
+
+    def replayMailbox(self, user: str, conn: clientConnection) -> None:
+        ## Direct messages held while the user was offline are delivered once they log in, along with when they were sent
+        dms, dropped = self.mailboxes.collect(user)
+        if dropped > 0: self.sendReply(conn, f"Server: {dropped} direct messages were dropped while you were offline")
+        for dm in dms:
+            self.deliverDirectMessage(conn, dm, {"Sent": f"{dm.timestamp:.3f}"})
+
+    def sendReply(self, conn: clientConnection, message: str, command: Optional[str] = None, room: Optional[chatObject] = None) -> None:
+        headers = {}
+        if command is not None: headers["Command"] = command
+        if room is not None and room.name != DEFAULT_ROOM: headers["Room"] = room.name
+        self.queueFrame(conn, self.encodeFrame(conn, "Server", message, "Chat-Update", headers or None))
+
+    def queueCommandResults(self, conn: clientConnection, command: str, chats: List[NamedTuple], room: chatObject, cutoff: Optional[float] = None) -> None:
+        ## A cutoff is when a query of the persisted history stopped scanning, as it had scanned as much as a query may
+        scanned = "" if cutoff is None else f" (the search of the older history stopped at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(cutoff))})"
+        if len(chats) == 0:
+            self.commandResults.pop(conn, None)
+            return self.sendReply(conn, f"Server: No messages matched {command}{scanned}", command, room)
+        lines = [f"[{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(chat.timestamp))}] {chat.user}: {chat.message}" for chat in chats]
+        if cutoff is not None: lines.insert(0, f"Server: The results are incomplete{scanned}")
+        self.queueCommandLines(conn, command, lines, room)
+
+    def queueCommandLines(self, conn: clientConnection, command: str, lines: List[str], room: Optional[chatObject] = None) -> None:
+        ## The lines are split into pages bounded by count and size, and any earlier query's remaining pages are dropped
+        pages, page, pageBytes = [], [], 0
+        for line in lines:
+            if page and (len(page) == self.commandPageSize or pageBytes + len(line) > self.commandPageBytes):
+                pages.append(page)
+                page, pageBytes = [], 0
+            page.append(line)
+            pageBytes += len(line) + 1
+        pages.append(page)
+        self.commandResults[conn] = self.encodeCommandPages(conn, command, pages, room)
+        self.scheduleCommandResults()
+
+    def encodeCommandPages(self, conn: clientConnection, command: str, pages: List[List[str]], room: Optional[chatObject]) -> Iterator[bytes]:
+        ## Pages are encoded as they are sent, in case the connection's protocol changes
+        headers = {"Command": command}
+        if room is not None and room.name != DEFAULT_ROOM: headers["Room"] = room.name
+        for number, page in enumerate(pages, 1):
+            yield self.encodeFrame(conn, "Server", "\n".join(page), "Chat-Update", dict(headers, Page=f"{number}/{len(pages)}"))
+
+    def scheduleBroadcast(self) -> None:
+        ## The selectors engine broadcasts the new chat at the end of every loop iteration
+        pass
+
+    def scheduleCommandResults(self) -> None:
+        ## The selectors engine services the pending results at the end of every loop iteration
+        pass
+
+    def serviceCommandResults(self) -> None:
+        ## Sends the next page of each pending query, so that a large result cannot hold up the event loop
+        for conn, pages in list(self.commandResults.items()):
+            frame = next(pages, None)
+            if frame is None or conn.closing:
+                del self.commandResults[conn]
+            else:
+                self.queueFrame(conn, frame)
+
+    def __serviceServerStats(self, **kwargs) -> None:
+        ## The statistics are only served to connections from the local machine
+        conn = kwargs["conn"]
+        if not isLoopbackAddress(conn.peername[0]):
+            message = "Server: Server statistics are only available from the local machine"
+        elif self.metrics is None:
+            message = "Server: Metrics are disabled, start the server with --metrics to enable them"
+        else:
+            message = self.metrics.render()
+        self.queueFrame(conn, self.encodeFrame(conn, "Server", message, "Server-Stats"))
+
+    def __serviceServerProfile(self, **kwargs) -> None:
+        ## "start [profilers]" opens a profiling window, "stop" closes it, and anything else reports whether one is open
+        ## Like the statistics, profiling is only available to connections from the local machine
+        conn = kwargs["conn"]
+        action, _, argument = kwargs["message"].strip().partition(" ")
+        if not isLoopbackAddress(conn.peername[0]):
+            message = "Server: Profiling is only available from the local machine"
+        elif action == "start":
+            try:
+                message = self.openProfilingWindow(parseProfilers(argument) if argument.strip() else None)
+            except ValueError as e: message = f"Server: {e}"
+        elif action == "stop":
+            message = self.closeProfilingWindow()
+        else:
+            message = "Server: No profiling window is open" if self.profilingWindow is None else f"Server: Profiling with {', '.join(self.profilingWindow.profilers)}"
+        self.queueFrame(conn, self.encodeFrame(conn, "Server", message, "Server-Profile"))
+
+    def openProfilingWindow(self, profilers: Optional[List[str]] = None) -> str:
+        if self.profilingWindow is not None: return "Server: A profiling window is already open"
+        self.profilingWindow = profilingWindow(profilers or self.profilers, self.profileDirectory, self.profileSampleInterval)
+        self.profilingWindow.open()
+        self.logDebug("Server", "Profiling-Started", ",".join(self.profilingWindow.profilers))
+        return f"Server: Profiling with {', '.join(self.profilingWindow.profilers)}"
+
+    def closeProfilingWindow(self) -> str:
+        if self.profilingWindow is None: return "Server: No profiling window is open"
+        window, self.profilingWindow = self.profilingWindow, None
+        paths = window.close(self.describeState())
+        self.logDebug("Server", "Profiling-Stopped", ",".join(paths))
+        return "Server: Profiling stopped, written to " + ", ".join(paths)
+
+    def describeState(self) -> str:
+        ## The annotation of a profiling window's files: the sizes of the structures that grow with load, and the metrics
+        ## NOTE: Those that are also gauges are only listed once, with the metrics, when metrics are enabled
+        conns = self.connections.filenoToConnection.values()
+        sizes = {"connections": len(self.connections.filenoToConnection), "sessions": len(self.connections.userToConnection),
+                 "rooms": len(self.rooms), "rooms.chat.length": sum(len(room) for room in self.rooms.values()),
+                 "rooms.chat.bytes": sum(room.chatBytes for room in self.rooms.values()),
+                 "receive.buffered.bytes": sum(len(conn.decoder.buffer) for conn in conns),
+                 "outbound.bytes": sum(conn.outboundBytes for conn in conns), "mailboxes.queued": len(self.mailboxes),
+                 "timers.pending": len(self.timers), "reads.pending": len(self.pendingReads)}
+        if self.metrics is None: return "".join(f"{name} {value}\n" for name, value in sizes.items())
+        gauges = self.metrics.gauges
+        return "".join(f"{name} {value}\n" for name, value in sizes.items() if name not in gauges) + self.metrics.render()
 
     def __serviceUserMessage(self, **kwargs) -> None:
-        self.logMessage(kwargs["user"], "User-Message", kwargs["message"])
+        ## Messages are sent to the room named by the Room header, or to the default room if there is none
+        conn = kwargs["conn"]
+        try:
+            room = self.getMemberRoom(conn.user, kwargs["headers"])
+        except ValueError as e:
+            return self.sendReply(conn, f"Server: {e}")
+        self.logMessage(conn.user, "User-Message", kwargs["message"], room=room)
 
-    def logMessage(self, user: str, description: str, message: str, visibility: str = "public") -> None:
-        self.chat.logUserMessage(user, message, visibility)       
+    def logMessage(self, user: str, description: str, message: str, visibility: str = "public", room: Optional[chatObject] = None) -> None:
+        (self.chat if room is None else room).logUserMessage(user, message, visibility)       
 
     def logDebug(self, user: str = "Server", eventType: str = "Default", description: str = "Default",) -> None:
-        logging.debug(f"{datetime.now()}\t{self.HOST}\t{self.PORT}\t{user}\t{eventType}\t{description}")
-        
-    def logEvent(self, user: str, eventType: str, description: str) -> None:
-        if user not in self.reservedNames:
-            hostname, port = self.connections.userToConnection[user].sock.getpeername()
+        self.eventLog.log(self.HOST, self.PORT, user, eventType, description)
+
+
+    def logEvent(self, user: str, eventType: str, description: str, conn: Optional[clientConnection] = None) -> None:
+        if conn is not None:
+            hostname, port = conn.peername
+        elif user not in self.reservedNames:
+            hostname, port = self.connections.userToConnection[user].peername
         else:
             hostname, port = self.HOST, self.PORT
-        logging.info(f"{datetime.now()}\t{hostname}\t{port}\t{user}\t{eventType}\t{description}")
+        self.eventLog.log(hostname, port, user, eventType, description)
 
     def __serviceUserCreation(self, **kwargs) -> None:
         user, conn = kwargs["user"], kwargs["conn"]
-        if user not in self.registeredUsers and user not in self.reservedNames:
-            self.createSession(user, conn)
+        if USERNAME_PATTERN.fullmatch(user) and user not in self.connections.userToConnection and user not in self.reservedNames:
+            headers = kwargs["headers"]
+            self.createSession(user, conn, negotiateProtocol(headers), self.negotiateCompression(headers), parseResume(headers))
         else:
             self.rejectSessionCreation(user, conn)
 
+    def __servicePing(self, **kwargs) -> None:
+        self.queueFrame(kwargs["conn"], self.encodeFrame(kwargs["conn"], "Server", "", "Pong"))
+
+    def __servicePong(self, **kwargs) -> None:
+        ## The activity was already recorded when the frame was received
+        pass
+
+    def negotiateCompression(self, headers: Dict[str, str]) -> Optional[str]:
+        return None if self.compression is None else negotiateCompression(headers)
+
     def exit(self) -> None:
         self.eventLoopFlag = False
     
@@ -262,14 +1334,114 @@ class messengingServer:
     def sig_handler(self, signum, frame) -> None:
         self.exit()
 
-    def parseArguments(self) -> None:
-        parser = argparse.ArgumentParser(description="A Multi-Client Instant Messaging Service")
-        parser.add_argument("port", type=int)
-        return parser.parse_args()
+    def metrics_handler(self, signum, frame) -> None:
+        if self.metrics is not None: self.metrics.dump(self.metricsFile)
+
+    def profile_handler(self, signum, frame) -> None:
+        ## Opens a profiling window, or closes the one that is open
+        if self.profilingWindow is None: self.openProfilingWindow()
+        else: self.closeProfilingWindow()
+
+    def parseArguments(self) -> argparse.Namespace:
+        return parseArguments()
+
+def isLoopbackAddress(hostname: str) -> bool:
+    return hostname.startswith("127.") or hostname in ("::1", "localhost")
+
+def createListeningSocket(HOST: str, PORT: int, backlog: int = socket.SOMAXCONN, sendBufferSize: Optional[int] = None,
+                          receiveBufferSize: Optional[int] = None) -> socket.socket:
+    serverSocket = socket.socket(socket.AF_INET6 if ":" in HOST else socket.AF_INET, socket.SOCK_STREAM)
+    ## A restarted server can bind while its old connections are in TIME_WAIT (on Windows this would allow another
+    ## process to bind the same port, so it is only set on POSIX)
+    if os.name == "posix": serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    ## The buffer sizes are set before listen(), as the accepted sockets inherit them (and their receive windows are scaled to them)
+    if sendBufferSize: serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sendBufferSize)
+    if receiveBufferSize: serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receiveBufferSize)
+    serverSocket.bind((HOST, PORT))
+    serverSocket.listen(backlog)
+    serverSocket.setblocking(False)
+    return serverSocket
+
+def defaultMaxConnections() -> int:
+    ## Connections are admitted up to a margin below the file descriptor limit, which leaves room for the log and history
+    ## files, so accept() does not start failing with EMFILE
+    try:
+        import resource
+        limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    except (ImportError, ValueError, OSError): return 0
+    return 0 if limit == resource.RLIM_INFINITY else max(1, limit - 64)
+
+def parseArguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="A Multi-Client Instant Messaging Service")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--host", default="127.0.0.1", help="The address that the server listens on")
+    parser.add_argument("--backlog", type=int, default=socket.SOMAXCONN, help="The length of the queue of connections waiting to be accepted")
+    parser.add_argument("--accept-batch", type=int, default=256, help="The most connections accepted each time the listening socket is ready")
+    parser.add_argument("--max-connections", type=int, default=None,
+                        help="Connections beyond this are rejected (0 is unlimited, and the default is just below the file descriptor limit)")
+    parser.add_argument("--send-buffer", type=int, default=None, help="The SO_SNDBUF size of each connection in bytes")
+    parser.add_argument("--receive-buffer", type=int, default=None, help="The SO_RCVBUF size of each connection in bytes")
+    parser.add_argument("--no-tcp-nodelay", action="store_true", help="Leave Nagle's algorithm enabled on the connections")
+    parser.add_argument("--chat-capacity", type=int, default=4096, help="The maximum number of chat actions retained in memory")
+    parser.add_argument("--chat-max-bytes", type=int, default=None, help="The maximum size of the chat messages retained in memory")
+    parser.add_argument("--history-dir", default=None, help="Persist the chat history to segment files in this directory")
+    parser.add_argument("--history-segment-bytes", type=int, default=64 * 1048576, help="The size at which a history segment is rolled over")
+    parser.add_argument("--history-segment-seconds", type=float, default=3600.0, help="The age at which a history segment is rolled over (0 only rolls by size)")
+    parser.add_argument("--history-retention-bytes", type=int, default=None, help="Retire the oldest history segments beyond this total size")
+    parser.add_argument("--history-retention-seconds", type=float, default=None, help="Retire history segments older than this")
+    parser.add_argument("--history-sync-interval", type=float, default=0.0, help="The minimum seconds between fsyncs of the history (0 syncs every batch)")
+    parser.add_argument("--history-index-window", type=int, default=None, help="The number of recent chat actions indexed in memory (defaults to --chat-capacity)")
+    parser.add_argument("--history-scan-limit", type=int, default=20000, help="The most archived chat actions that a query scans beyond the index window")
+    parser.add_argument("--engine", choices=["selectors", "asyncio"], default="selectors", help="The event loop that the server runs on")
+    parser.add_argument("--uvloop", action="store_true", help="Run the asyncio engine on uvloop, if it is installed")
+    parser.add_argument("--metrics", action="store_true", help="Collect runtime metrics, which are served to local Server-Stats requests")
+    parser.add_argument("--metrics-file", default="server-stats.txt", help="The file that the metrics are appended to on SIGUSR1")
+    parser.add_argument("--log-format", choices=LOG_FORMATS, default="jsonl", help="The format of the records written to server.log")
+    parser.add_argument("--log-queue-size", type=int, default=65536, help="The maximum number of log records queued before records are dropped")
+    parser.add_argument("--compression", choices=COMPRESSION_METHODS + ("none",), default="deflate", help="The compression offered to clients for the frames sent to them")
+    parser.add_argument("--compression-threshold", type=int, default=256, help="Frames smaller than this many bytes are sent uncompressed")
+    parser.add_argument("--compression-level", type=int, choices=range(1, 10), default=6, metavar="1-9", help="The deflate level, where 1 is the fastest")
+    parser.add_argument("--outbound-high-watermark", type=int, default=1048576, help="The bytes queued to a client before the slow consumer policy is applied")
+    parser.add_argument("--outbound-low-watermark", type=int, default=262144, help="The bytes that the drop-oldest policy drops the queue down to (and, with --workers, that the bus waits for a worker's queue to drain to)")
+    parser.add_argument("--slow-consumer-policy", choices=SLOW_CONSUMER_POLICIES, default="coalesce",
+                        help="Replace a slow client's queued updates with a summary, drop its oldest updates, or disconnect it")
+    parser.add_argument("--flush-interval", type=float, default=0.0,
+                        help="The minimum seconds between writes to each client, which batches more frames into each syscall at the cost of latency")
+    parser.add_argument("--resume-limit", type=int, default=1000, help="The most missed messages per room sent to a reconnecting client")
+    parser.add_argument("--handshake-timeout", type=float, default=10.0, help="The seconds a connection has to register a user (0 never times out)")
+    parser.add_argument("--heartbeat-interval", type=float, default=30.0, help="The seconds of silence from a client before it is sent a Ping (0 never pings)")
+    parser.add_argument("--idle-timeout", type=float, default=90.0, help="The seconds of silence from a client before it is disconnected (0 never disconnects)")
+    parser.add_argument("--message-rate", type=float, default=50.0, help="The messages per second that each client may send on average (0 is unlimited)")
+    parser.add_argument("--message-burst", type=float, default=100.0, help="The messages that each client may send at once")
+    parser.add_argument("--byte-rate", type=float, default=1048576.0, help="The bytes per second that each client may send on average (0 is unlimited)")
+    parser.add_argument("--byte-burst", type=float, default=4194304.0, help="The bytes that each client may send at once")
+    parser.add_argument("--max-frames-per-pass", type=int, default=32,
+                        help="The most frames serviced per client per pass of the event loop, so clients are served in turn (0 is unlimited)")
+    parser.add_argument("--profilers", default="cprofile,memory",
+                        help="The profilers of a profiling window opened with SIGUSR2, from cprofile, sampling and memory")
+    parser.add_argument("--profile-dir", default=".", help="The directory that the files of profiling windows are written to")
+    parser.add_argument("--profile-sample-interval", type=float, default=0.005, help="The seconds between the samples of the sampling profiler")
+    parser.add_argument("--handoff-socket", default=None,
+                        help="Listen on this Unix socket for a new server process to take over the listening socket and every session")
+    parser.add_argument("--takeover", default=None, metavar="HANDOFF_SOCKET",
+                        help="Take over the listening socket and sessions of the server listening on this handoff socket, rather than binding the port")
+    parser.add_argument("--workers", type=int, default=1, help="The number of worker processes that share the listening socket")
+    args = parser.parse_args()
+    if (args.handoff_socket or args.takeover) and (args.engine != "selectors" or args.workers > 1 or not hasattr(socket, "AF_UNIX")):
+        parser.error("--handoff-socket and --takeover are only supported by the selectors engine with a single worker, on POSIX")
+    return args
 
 def main():
-    ms = messengingServer()
-    ms.run()
+    args = parseArguments()
+    if args.workers > 1:
+        from cluster import clusterServer
+        return clusterServer().run(args)
+    if args.engine == "asyncio":
+        from asyncServer import asyncMessengingServer
+        ms = asyncMessengingServer()
+    else:
+        ms = messengingServer()
+    ms.run(args)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,84 @@
+from typing import Callable, List, Optional, Set
+
+##A hashed timer wheel, which holds the deadlines of every connection (handshakes, heartbeats and idle timeouts)
+##--> Time is divided into ticks of resolution seconds, and a timer due during tick t is kept in slot t % len(slots)
+##--> Scheduling and cancelling a timer are O(1), and advancing the wheel only visits the slots of the ticks that have
+##    fully elapsed, where any timers due in a later rotation of the wheel are left in place
+##NOTE: Timers fire up to one tick late, which is ample for timeouts measured in seconds, and in exchange a tick's slot is
+##      visited once per rotation however often the event loop wakes up
+
+class timer:
+    __slots__ = ("deadline", "callback", "args", "slot")
+
+    def __init__(self, deadline: float, callback: Callable, args: tuple, slot: int) -> None:
+        self.deadline: float = deadline
+        self.callback: Callable = callback
+        self.args: tuple = args
+        self.slot: int = slot
+
+
+class timerWheel:
+    def __init__(self, now: float, resolution: float = 0.25, slots: int = 1024) -> None:
+        self.resolution: float = resolution
+        self.slots: List[Set[timer]] = [set() for _ in range(slots)]
+        self.tick: int = int(now / resolution) ## The earliest tick whose slot has not been visited yet
+        self.count: int = 0
+        self.emptyUntil: int = self.tick ## The slots of the ticks from self.tick up to this tick are known to be empty
+
+    def __len__(self) -> int:
+        return self.count
+
+    def schedule(self, deadline: float, callback: Callable, *args) -> timer:
+        ## A deadline that has already passed fires once the current tick has elapsed
+        tick, size = int(deadline / self.resolution), len(self.slots)
+        if tick < self.tick: tick = self.tick
+        entry = timer(deadline, callback, args, tick % size)
+        self.slots[entry.slot].add(entry)
+        ## A timer in a later rotation occupies the slot of a tick within this rotation
+        tick = self.tick + (tick - self.tick) % size
+        if tick < self.emptyUntil: self.emptyUntil = tick
+        self.count += 1
+        return entry
+
+    def cancel(self, entry: Optional[timer]) -> None:
+        if entry is None: return None
+        slot = self.slots[entry.slot]
+        if entry in slot:
+            slot.remove(entry)
+            self.count -= 1
+
+    def advance(self, now: float) -> int:
+        ## Fires the timers that are due in the ticks that have elapsed, and returns the number fired
+        current = int(now / self.resolution)
+        if current <= self.tick or self.count == 0:
+            self.tick = max(self.tick, current)
+            return 0
+        due = []
+        ## However long the wheel was idle for, each slot is visited at most once
+        for tick in range(self.tick, min(current, self.tick + len(self.slots))):
+            slot = self.slots[tick % len(self.slots)]
+            if not slot: continue
+            expired = [entry for entry in slot if entry.deadline <= now]
+            for entry in expired: slot.remove(entry)
+            due.extend(expired)
+        self.tick = current
+        self.count -= len(due)
+        ## Callbacks run once the wheel is consistent, as they usually schedule the connection's next timer
+        for entry in due: entry.callback(*entry.args)
+        return len(due)
+
+    def nextDeadline(self) -> Optional[float]:
+        ## Returns when the earliest occupied slot will be visited, which may be early if its timers are due in a later
+        ## rotation, or None if there are no timers
+        ## The scan resumes from where the last one found an occupied slot, so it is not repeated on every pass of the loop
+        if self.count == 0: return None
+        slots = self.slots
+        for tick in range(max(self.tick, self.emptyUntil), self.tick + len(slots)):
+            if slots[tick % len(slots)]:
+                self.emptyUntil = tick
+                return (tick + 1) * self.resolution
+        return None
+
+    def visitTime(self, deadline: float) -> float:
+        ## Returns when the slot of a timer with this deadline will next be visited
+        return (max(int(deadline / self.resolution), self.tick) + 1) * self.resolution
@@ -0,0 +1,591 @@
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from message import clientConnection, request
+from server import messengingServer
+from asyncServer import asyncMessengingServer
+from chatClient import chatClient
+
+##These tests run a real server on loopback in a background thread, and speak to it over sockets
+##NOTE: The same tests are run against every server engine
+
+
+class serverIntegrationTests:
+    engine = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = cls.engine()
+        cls.server.enableMetrics()
+        cls.server._setup(0)
+        cls.address = cls.server.serverSocket.getsockname()
+        cls.thread = threading.Thread(target=cls.server._executeEventLoop, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.exit()
+        cls.thread.join(5.0)
+
+    def setUp(self):
+        self.clients = []
+        self.req = request()
+
+    def tearDown(self):
+        for client in self.clients: client.close()
+
+    def connect(self):
+        client = clientConnection(socket.create_connection(self.address))
+        client.sock.setblocking(True)
+        client.sock.settimeout(2.0)
+        self.clients.append(client)
+        return client
+
+    def register(self, user, protocol=1, compression=None):
+        client = self.connect()
+        headers = {"Protocol": str(protocol)}
+        if compression is not None: headers["Compression"] = compression
+        client.sendRequest(user=user, messageType="User-Creation", headers=headers)
+        message = client.receiveRequest()
+        client.setProtocol(int(message["Headers"].get("Protocol", 1)))
+        if "Compression" in message["Headers"]: client.setDecompression()
+        return client, message
+
+    def receiveUntil(self, client, body):
+        while True:
+            message = client.receiveRequest()
+            self.assertIsNotNone(message)
+            if message["Body"] == body: return message
+
+    def receiveCommandReply(self, client, command):
+        while True:
+            message = client.receiveRequest()
+            self.assertIsNotNone(message)
+            if message["Headers"].get("Command") == command: return message
+
+
+    def test_registration(self):
+        client, message = self.register("integration-alice")
+        self.assertEqual(message["Headers"]["Message-Type"], "User-Creation")
+        self.receiveUntil(client, "Server: integration-alice has just joined the server!")
+
+    def test_duplicateUsernameRejected(self):
+        self.register("integration-bob")
+        client, message = self.register("integration-bob")
+        self.assertEqual(message["Headers"]["Message-Type"], "Session-Rejection")
+        self.assertIsNone(client.receiveRequest())
+
+    def test_reservedUsernameRejected(self):
+        client, message = self.register("Server")
+        self.assertEqual(message["Headers"]["Message-Type"], "Session-Rejection")
+
+    def test_invalidUsernameRejected(self):
+        ##Names are limited to those that can be routed in a header, and the rejection does not echo them in one
+        for user in ("integration bad", "integration-" + "x" * 32, "integration:colon", "integration-é"):
+            client, message = self.register(user)
+            self.assertEqual(message["Headers"]["Message-Type"], "Session-Rejection")
+            self.assertEqual(message["Headers"]["User"], "Server")
+            self.assertIsNone(client.receiveRequest())
+
+    def test_broadcast(self):
+        sender, _ = self.register("integration-carol")
+        receiver, _ = self.register("integration-dave")
+        self.receiveUntil(sender, "Server: integration-dave has just joined the server!")
+        sender.sendRequest(user="integration-carol", message="Hello\r\n\r\nDave")
+        message = self.receiveUntil(receiver, "integration-carol: Hello\r\n\r\nDave")
+        self.assertEqual(message["Headers"]["Message-Type"], "Chat-Update")
+
+    def test_pipelinedMessages(self):
+        ##Frames that arrive in a single segment are all delivered, in order
+        sender, _ = self.register("integration-erin")
+        receiver, _ = self.register("integration-frank")
+        self.receiveUntil(sender, "Server: integration-frank has just joined the server!")
+        sender.sock.sendall(b"".join(self.req.createRawRequest("integration-erin", str(i), "User-Message", "Text") for i in range(50)))
+        for i in range(50):
+            self.receiveUntil(receiver, f"integration-erin: {i}")
+
+    def test_rateLimit(self):
+        ##Only a flooding client's burst is delivered, while it is served a few frames at a time, and it is told once that
+        ##the rest were dropped
+        self.server.messageRate, self.server.messageBurst, self.server.maxFramesPerPass = 0.1, 5, 2
+        try:
+            sender, _ = self.register("integration-yves")
+            receiver, _ = self.register("integration-zara")
+            self.receiveUntil(sender, "Server: integration-zara has just joined the server!")
+            sender.sock.sendall(b"".join(self.req.createRawRequest("integration-yves", f"Flood {i}", "User-Message", "Text") for i in range(20)))
+            while True:
+                message = sender.receiveRequest()
+                if message["Headers"]["Message-Type"] == "Throttle": break
+            self.assertIn("Retry-After", message["Headers"])
+            for i in range(5): self.receiveUntil(receiver, f"integration-yves: Flood {i}")
+            other, _ = self.register("integration-abel")
+            other.sendRequest(user="integration-abel", message="After the flood")
+            while True:
+                body = receiver.receiveRequest()["Body"]
+                self.assertNotIn("Flood", body)
+                if body == "integration-abel: After the flood": break
+        finally:
+            self.server.messageRate, self.server.messageBurst, self.server.maxFramesPerPass = 50.0, 100.0, 32
+
+    def test_connectionLimit(self):
+        ##Connections beyond the limit are sent a rejection and closed, without being registered
+        self.register("integration-abby")
+        maxConnections, self.server.maxConnections = self.server.maxConnections, 1
+        try:
+            client = self.connect()
+            message = client.receiveRequest()
+            self.assertEqual(message["Headers"]["Message-Type"], "Session-Rejection")
+            self.assertIsNone(client.receiveRequest())
+            self.assertGreater(self.server.connectionsRejected.value, 0)
+        finally:
+            self.server.maxConnections = maxConnections
+
+    def test_protocolNegotiation(self):
+        ##Clients using either protocol can talk to each other
+        binary, message = self.register("integration-judy", protocol=2)
+        self.assertEqual(message["Headers"]["Protocol"], "2")
+        text, message = self.register("integration-ken")
+        self.assertNotIn("Protocol", message["Headers"])
+        self.receiveUntil(binary, "Server: integration-ken has just joined the server!")
+        binary.sendRequest(user="integration-judy", message="Hello \u00e9\r\n")
+        self.receiveUntil(text, "integration-judy: Hello \u00e9\r\n")
+        text.sendRequest(user="integration-ken", message="Hello \u4e16")
+        message = self.receiveUntil(binary, "integration-ken: Hello \u4e16")
+        self.assertEqual(message["Headers"]["Message-Type"], "Chat-Update")
+
+    def test_compression(self):
+        compressed, message = self.register("integration-tina", protocol=2, compression="deflate")
+        self.assertEqual(message["Headers"]["Compression"], "deflate")
+        plain, message = self.register("integration-umar")
+        self.assertNotIn("Compression", message["Headers"])
+        self.receiveUntil(compressed, "Server: integration-umar has just joined the server!")
+        ##Both small (raw) and large (deflated) frames are received
+        for text in ("Short", "Long and repetitive " * 200, "Short again"):
+            plain.sendRequest(user="integration-umar", message=text)
+            self.receiveUntil(compressed, f"integration-umar: {text}")
+
+    def test_slowConsumer(self):
+        ##A client that stops reading is bounded by the slow consumer policy, while the other clients are unaffected
+        self.server.outboundHighWatermark, self.server.outboundLowWatermark = 262144, 65536
+        self.server.messageRate = self.server.byteRate = 0 ## The sender floods on purpose
+        try:
+            sock = socket.socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            sock.connect(self.address)
+            frozen = clientConnection(sock)
+            frozen.sock.setblocking(True)
+            frozen.sock.settimeout(5.0)
+            self.clients.append(frozen)
+            frozen.sendRequest(user="integration-vera", messageType="User-Creation")
+            sender, _ = self.register("integration-walt")
+            receiver, _ = self.register("integration-xena")
+            padding = "x" * 16384
+            ##The healthy client reads while the messages are sent, so that only the frozen client falls behind
+            received = []
+            reader = threading.Thread(target=lambda: received.append(self.receiveUntil(receiver, f"integration-walt: 599 {padding}")))
+            reader.start()
+            for i in range(600):
+                sender.sendRequest(user="integration-walt", message=f"{i} {padding}")
+            reader.join(10.0)
+            self.assertEqual(len(received), 1)
+            self.assertGreater(self.server.framesCoalesced.value, 0)
+            ##Once the frozen client reads again, it is told how many updates it missed
+            while "updates were skipped" not in frozen.receiveRequest()["Body"]: pass
+        finally:
+            self.server.outboundHighWatermark, self.server.outboundLowWatermark = 1048576, 262144
+            self.server.messageRate, self.server.byteRate = 50.0, 1048576.0
+
+    def test_serverStats(self):
+        client, _ = self.register("integration-leo")
+        client.sendRequest(user="integration-leo", messageType="Server-Stats")
+        while True:
+            message = client.receiveRequest()
+            if message["Headers"]["Message-Type"] == "Server-Stats": break
+        stats = dict(line.split(" ") for line in message["Body"].splitlines())
+        self.assertGreater(int(stats["frames.received"]), 0)
+        self.assertGreater(int(stats["bytes.in"]), 0)
+        self.assertGreaterEqual(int(stats["sessions"]), 1)
+        self.assertIn("handler.User-Creation.seconds.count", stats)
+
+    def test_profilingWindow(self):
+        client, _ = self.register("integration-lena")
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.server.profileDirectory = directory.name
+        client.sendRequest(user="integration-lena", message="start cprofile sampling memory", messageType="Server-Profile")
+        self.assertEqual(self.receiveUntil(client, "Server: Profiling with cprofile, sampling, memory")["Headers"]["Message-Type"], "Server-Profile")
+        client.sendRequest(user="integration-lena", message="Profiled")
+        client.sendRequest(user="integration-lena", message="stop", messageType="Server-Profile")
+        while True:
+            message = client.receiveRequest()
+            if message["Headers"]["Message-Type"] == "Server-Profile": break
+        paths = message["Body"].split("written to ", 1)[1].split(", ")
+        self.assertEqual(len(paths), 4)
+        ##Each file is annotated with the sizes of the server's structures as the window closed
+        with open(next(path for path in paths if path.endswith("-cprofile.txt"))) as file:
+            report = file.read()
+        self.assertIn("# sessions ", report)
+        self.assertIn("serviceFrames", report)
+        self.assertIsNone(self.server.profilingWindow)
+
+    def test_userCommands(self):
+        sender, _ = self.register("integration-mia")
+        sender.sock.sendall(b"".join(self.req.createRawRequest("integration-mia", f"Needle {i}", "User-Message", "Text") for i in range(45)))
+        ##The sender's own query is answered once its messages have all been logged
+        sender.sendRequest(user="integration-mia", message="/history 1", messageType="User-Command")
+        self.assertTrue(self.receiveCommandReply(sender, "/history")["Body"].endswith("integration-mia: Needle 44"))
+        client, _ = self.register("integration-nick")
+        client.sendRequest(user="integration-nick", message="/from integration-mia 45", messageType="User-Command")
+        ##The results are split into pages of bounded Chat-Update frames
+        pages = []
+        while len(pages) < 3:
+            message = client.receiveRequest()
+            if message["Headers"].get("Command") == "/from": pages.append(message)
+        self.assertEqual([page["Headers"]["Page"] for page in pages], ["1/3", "2/3", "3/3"])
+        lines = "\n".join(page["Body"] for page in pages).split("\n")
+        self.assertEqual(len(lines), 45)
+        self.assertTrue(lines[0].endswith("integration-mia: Needle 0"))
+
+        client.sendRequest(user="integration-nick", message="/search needle 44", messageType="User-Command")
+        self.assertTrue(self.receiveCommandReply(client, "/search")["Body"].endswith("integration-mia: Needle 44"))
+        client.sendRequest(user="integration-nick", message="/unknown", messageType="User-Command")
+        self.assertIn("Unknown command /unknown", self.receiveCommandReply(client, "unknown")["Body"])
+        ##The client's text is never echoed in a header, where a line break would end the headers
+        client.sendRequest(user="integration-nick", message="/bad\r\nRoom:elsewhere\r\n\r\n x", messageType="User-Command")
+        message = self.receiveCommandReply(client, "unknown")
+        self.assertNotIn("Room", message["Headers"])
+        self.assertIn("Unknown command /bad\r\nRoom:elsewhere", message["Body"])
+
+    def test_rooms(self):
+        alice, _ = self.register("integration-olga")
+        bob, _ = self.register("integration-pete")
+        alice.sendRequest(user="integration-olga", message="/join integration-room", messageType="User-Command")
+        self.receiveUntil(alice, "Server: integration-olga has joined integration-room")
+        ##Non-members can not send messages to a room
+        bob.sendRequest(user="integration-pete", message="Intruding", headers={"Room": "integration-room"})
+        self.receiveUntil(bob, "Server: You are not in the room integration-room")
+        bob.sendRequest(user="integration-pete", message="/join integration-room", messageType="User-Command")
+        self.receiveUntil(alice, "Server: integration-pete has joined integration-room")
+        bob.sendRequest(user="integration-pete", message="Hello room", headers={"Room": "integration-room"})
+        message = self.receiveUntil(alice, "integration-pete: Hello room")
+        self.assertEqual(message["Headers"]["Room"], "integration-room")
+        alice.sendRequest(user="integration-olga", message="/rooms", messageType="User-Command")
+        self.assertIn("integration-room (2 members) *", self.receiveCommandReply(alice, "/rooms")["Body"])
+
+    def test_directMessages(self):
+        alice, _ = self.register("integration-quinn")
+        bob, _ = self.register("integration-rita")
+        alice.sendRequest(user="integration-quinn", message="/msg integration-rita Just for you", messageType="User-Command")
+        message = self.receiveUntil(bob, "integration-quinn: Just for you")
+        self.assertEqual(message["Headers"]["Direct"], "integration-quinn")
+        self.assertEqual(self.receiveCommandReply(alice, "/msg")["Body"], "Server: Sent to integration-rita")
+        ##Messages to offline users are replayed when they log in
+        alice.sendRequest(user="integration-quinn", message="/msg integration-sam While you were out", messageType="User-Command")
+        self.receiveCommandReply(alice, "/msg")
+        sam, _ = self.register("integration-sam")
+        self.assertIn("Sent", self.receiveUntil(sam, "integration-quinn: While you were out")["Headers"])
+
+    def test_headlessClients(self):
+        ##Many bots share one event loop, and every other bot receives the messages sent to their room
+        async def runBots():
+            bots = [chatClient(f"integration-bot{i}") for i in range(50)]
+            await asyncio.gather(*(bot.connect(*self.address) for bot in bots))
+            try:
+                async def receiveUntil(bot, predicate):
+                    async for update in bot:
+                        if predicate(update): return update
+                await asyncio.gather(*(bot.command("/join integration-bots") for bot in bots))
+                await asyncio.wait_for(asyncio.gather(*(receiveUntil(bot, lambda update, bot=bot: update["Body"] == f"Server: {bot.user} has joined integration-bots") for bot in bots)), 10.0)
+                await bots[0].send("Hello bots")
+                updates = await asyncio.wait_for(asyncio.gather(*(receiveUntil(bot, lambda update: update["Body"] == "integration-bot0: Hello bots") for bot in bots[1:])), 10.0)
+                self.assertTrue(all(update["Headers"]["Room"] == "integration-bots" for update in updates))
+                with self.assertRaises(ConnectionError):
+                    await chatClient("integration-bot0").connect(*self.address)
+            finally:
+                await asyncio.gather(*(bot.close() for bot in bots))
+        asyncio.run(runBots())
+
+    def test_resumeAfterReconnect(self):
+        ##A client that drops is sent only the messages that it missed once it reconnects
+        async def runResume():
+            alice, bob = chatClient("integration-resume-alice"), chatClient("integration-resume-bob")
+            await alice.connect(*self.address)
+            await bob.connect(*self.address)
+            try:
+                async def receiveUntil(client, body):
+                    async for update in client:
+                        if update["Body"] == body: return update
+                await asyncio.wait_for(receiveUntil(alice, "Server: integration-resume-bob has just joined the server!"), 5.0)
+                alice.writer.transport.abort()
+                await asyncio.wait_for(receiveUntil(bob, "Server: integration-resume-alice has just left the server!"), 5.0)
+                for i in range(3): await bob.send(f"Missed {i}")
+                await asyncio.sleep(0.1)
+                await alice.connect(*self.address)
+                updates = [(await asyncio.wait_for(alice.receive(), 5.0))["Body"] for _ in range(4)]
+                self.assertEqual(updates, ["Server: integration-resume-alice has just left the server!"] + [f"integration-resume-bob: Missed {i}" for i in range(3)])
+            finally:
+                await asyncio.gather(alice.close(), bob.close())
+        asyncio.run(runResume())
+
+    def test_idleTimeout(self):
+        ##Clients that answer the heartbeats stay connected, and clients that stay silent are disconnected
+        self.server.heartbeatInterval, self.server.idleTimeout, self.server.handshakeTimeout = 0.2, 0.6, 0.5
+        try:
+            async def runClients():
+                alive = chatClient("integration-alive")
+                await alive.connect(*self.address)
+                silent, _ = await asyncio.get_running_loop().run_in_executor(None, self.register, "integration-silent")
+                async def receiveUntil(client, body):
+                    async for update in client:
+                        if update["Body"] == body: return update
+                try:
+                    await asyncio.wait_for(receiveUntil(alive, "Server: integration-silent has just left the server!"), 5.0)
+                    self.assertNotIn("integration-silent", self.server.connections.userToConnection)
+                    self.assertIn("integration-alive", self.server.connections.userToConnection)
+                finally:
+                    await alive.close()
+            asyncio.run(runClients())
+            ##Connections that never register are closed once the handshake deadline passes
+            client = self.connect()
+            client.sock.settimeout(5.0)
+            self.assertIsNone(client.receiveRequest())
+        finally:
+            self.server.heartbeatInterval, self.server.idleTimeout, self.server.handshakeTimeout = 30.0, 90.0, 10.0
+
+    def test_disconnectAnnounced(self):
+        leaver, _ = self.register("integration-grace")
+        observer, _ = self.register("integration-heidi")
+        leaver.close()
+        self.receiveUntil(observer, "Server: integration-grace has just left the server!")
+        ##The username is released once the session has been closed
+        _, message = self.register("integration-grace")
+        self.assertEqual(message["Headers"]["Message-Type"], "User-Creation")
+
+    def test_firstMessageMustBeUserCreation(self):
+        client = self.connect()
+        client.sendRequest(user="integration-ivan", message="Hello")
+        self.assertIsNone(client.receiveRequest())
+
+
+class testSelectorsEngine(serverIntegrationTests, unittest.TestCase):
+    engine = messengingServer
+
+
+class testAsyncioEngine(serverIntegrationTests, unittest.TestCase):
+    engine = asyncMessengingServer
+
+    def test_pipelinedMessagesBeforeConnectionLost(self):
+        ##Frames left buffered after maxFramesPerPass are still serviced when the transport is lost behind them
+        sender, _ = self.register("integration-gina")
+        receiver, _ = self.register("integration-hank")
+        self.receiveUntil(sender, "Server: integration-hank has just joined the server!")
+        conn = self.server.connections.userToConnection["integration-gina"]
+        frames = b"".join(self.req.createRawRequest("integration-gina", str(i), "User-Message", "Text") for i in range(80))
+        def feedThenAbort():
+            ##The transport's connection_lost() runs while the last frames are still waiting for their pass
+            conn.transport.get_protocol().data_received(frames)
+            conn.transport.abort()
+        self.server.loop.call_soon_threadsafe(feedThenAbort)
+        for i in range(80):
+            self.receiveUntil(receiver, f"integration-gina: {i}")
+        self.receiveUntil(receiver, "Server: integration-gina has just left the server!")
+
+
+@unittest.skipUnless(hasattr(os, "fork"), "Multi-process mode requires os.fork()")
+class testClusterMode(unittest.TestCase):
+    ##The cluster is started as a separate process, as it forks its workers
+    @classmethod
+    def setUpClass(cls):
+        probe = socket.socket()
+        probe.bind(("127.0.0.1", 0))
+        cls.address = probe.getsockname()
+        probe.close()
+        serverPath = os.path.join(os.path.dirname(__file__), "..", "src", "server.py")
+        cls.logDirectory = tempfile.TemporaryDirectory()
+        cls.process = subprocess.Popen([sys.executable, serverPath, str(cls.address[1]), "--workers", "3"], cwd=cls.logDirectory.name, stdout=subprocess.DEVNULL)
+        for _ in range(100):
+            try:
+                socket.create_connection(cls.address).close()
+                break
+            except ConnectionRefusedError: time.sleep(0.05)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.process.send_signal(signal.SIGINT)
+        cls.process.wait(10)
+        cls.logDirectory.cleanup()
+
+    def setUp(self):
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients: client.close()
+
+    register = serverIntegrationTests.register
+    connect = serverIntegrationTests.connect
+    receiveUntil = serverIntegrationTests.receiveUntil
+
+    def test_usernamesAreGlobal(self):
+        ##Connections are spread across the workers, so at least one of these attempts lands on a different worker
+        _, message = self.register("cluster-alice")
+        self.assertEqual(message["Headers"]["Message-Type"], "User-Creation")
+        for _ in range(6):
+            _, message = self.register("cluster-alice")
+            self.assertEqual(message["Headers"]["Message-Type"], "Session-Rejection")
+
+    def test_pipelinedRegistration(self):
+        ##The frames sent behind a User-Creation are serviced once the bus has reserved the name
+        client = self.connect()
+        req = request()
+        client.sock.sendall(req.createRawRequest("cluster-pipelined", "", "User-Creation", "Text") +
+                            req.createRawRequest("cluster-pipelined", "/rooms", "User-Command", "Text"))
+        self.assertEqual(client.receiveRequest()["Headers"]["Message-Type"], "User-Creation")
+        while True:
+            message = client.receiveRequest()
+            self.assertIsNotNone(message)
+            if message["Headers"].get("Command") == "/rooms": break
+
+    def test_directMessagesAcrossWorkers(self):
+        ##The connections are spread across the workers, so the bus routes the messages between them
+        users = [f"cluster-dm{i}" for i in range(4)]
+        clients = [self.register(user)[0] for user in users]
+        for i, (user, client) in enumerate(zip(users, clients)):
+            client.sendRequest(user=user, message=f"/msg {users[(i + 1) % 4]} Hello from {user}", messageType="User-Command")
+        for i, client in enumerate(clients):
+            sender = users[(i - 1) % 4]
+            self.assertEqual(self.receiveUntil(client, f"{sender}: Hello from {sender}")["Headers"]["Direct"], sender)
+        clients[0].sendRequest(user=users[0], message="/msg cluster-dm-offline Later", messageType="User-Command")
+        time.sleep(0.2)
+        client, _ = self.register("cluster-dm-offline")
+        self.receiveUntil(client, f"{users[0]}: Later")
+
+    def test_globalOrder(self):
+        users = [f"cluster-user{i}" for i in range(6)]
+        clients = [self.register(user)[0] for user in users]
+        for client in clients: self.receiveUntil(client, "Server: cluster-user5 has just joined the server!")
+        for user, client in zip(users, clients):
+            client.sendRequest(user=user, message=f"Hello from {user}")
+
+        ##Every client sees every other client's message exactly once, and in the same order
+        orders = []
+        for user, client in zip(users, clients):
+            expected = {f"{other}: Hello from {other}" for other in users if other != user}
+            received = []
+            while len(received) < len(expected):
+                body = client.receiveRequest()["Body"]
+                if body in expected: received.append(body)
+            self.assertEqual(set(received), expected)
+            orders.append(received)
+        for order in orders:
+            for other in orders:
+                common = set(order) & set(other)
+                self.assertEqual([body for body in order if body in common], [body for body in other if body in common])
+
+    def test_signalsForwardedToWorkers(self):
+        ##The parent forwards SIGUSR2 to its workers, which each open a profiling window, and close it on the next one
+        self.register("cluster-before-profiling")
+        for _ in range(2):
+            self.process.send_signal(signal.SIGUSR2)
+            time.sleep(0.5)
+        for _ in range(100):
+            reports = [name for name in os.listdir(self.logDirectory.name) if name.endswith("-cprofile.txt")]
+            if len(reports) == 3: break
+            time.sleep(0.05)
+        self.assertEqual(len(reports), 3)
+        self.assertIsNone(self.process.poll())
+        _, message = self.register("cluster-after-profiling")
+        self.assertEqual(message["Headers"]["Message-Type"], "User-Creation")
+
+
+@unittest.skipUnless(hasattr(socket, "send_fds"), "Handoff requires SCM_RIGHTS on a Unix socket")
+class testHandoff(unittest.TestCase):
+    ##The servers are started as separate processes, as the old one exits once it has handed over
+    def setUp(self):
+        self.clients = []
+        self.logDirectory = tempfile.TemporaryDirectory()
+        self.handoffPath = os.path.join(self.logDirectory.name, "handoff.sock")
+        probe = socket.socket()
+        probe.bind(("127.0.0.1", 0))
+        self.address = probe.getsockname()
+        probe.close()
+        self.processes = [self.startServer()]
+        for _ in range(100):
+            try:
+                socket.create_connection(self.address).close()
+                break
+            except ConnectionRefusedError: time.sleep(0.05)
+
+    def tearDown(self):
+        for client in self.clients: client.close()
+        for process in self.processes:
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+                process.wait(10)
+        self.logDirectory.cleanup()
+
+    def startServer(self, *args):
+        serverPath = os.path.join(os.path.dirname(__file__), "..", "src", "server.py")
+        return subprocess.Popen([sys.executable, serverPath, str(self.address[1]), "--handoff-socket", self.handoffPath, *args],
+                                cwd=self.logDirectory.name, stdout=subprocess.DEVNULL)
+
+    def takeOver(self):
+        old = self.processes[-1]
+        self.processes.append(self.startServer("--takeover", self.handoffPath))
+        ##The old server stops once the new one has acknowledged every session
+        self.assertEqual(old.wait(10), 0)
+        self.assertIsNone(self.processes[-1].poll())
+
+    register = serverIntegrationTests.register
+    connect = serverIntegrationTests.connect
+    receiveUntil = serverIntegrationTests.receiveUntil
+    receiveCommandReply = serverIntegrationTests.receiveCommandReply
+
+    def test_sessionsSurviveHandoff(self):
+        alice, _ = self.register("handoff-alice", protocol=2, compression="deflate")
+        bob, _ = self.register("handoff-bob")
+        self.receiveUntil(alice, "Server: handoff-bob has just joined the server!")
+        alice.sendRequest(user="handoff-alice", message="/join games", messageType="User-Command")
+        self.receiveUntil(alice, "Server: handoff-alice has joined games")
+        bob.sendRequest(user="handoff-bob", message="/join games", messageType="User-Command")
+        bob.sendRequest(user="handoff-bob", message="/msg handoff-carol See you later", messageType="User-Command")
+        before = self.receiveUntil(alice, "Server: handoff-bob has joined games")
+        ##Large enough to be deflated, so the client's inflater carries on across the two servers' deflate streams
+        longMessage = "Before the handoff " * 20
+        bob.sendRequest(user="handoff-bob", message=longMessage, headers={"Room": "games"})
+        self.receiveUntil(alice, f"handoff-bob: {longMessage}")
+        ##A partial frame is still buffered by the old server when it hands over, and is completed with the new one
+        bob.sock.sendall(b"User:handoff-bob\r\nMessage-Type:User-Message\r\nContent-Type:Text\r\nRoom:")
+        time.sleep(0.2)
+        self.takeOver()
+        bob.sock.sendall(b"games\r\nContent-Length:5\r\nAfter\r\n\r\n")
+        after = self.receiveUntil(alice, "handoff-bob: After")
+        self.assertGreater(int(after["Headers"]["Sequence"]), int(before["Headers"]["Sequence"]))
+        longMessage = "After the handoff " * 20
+        bob.sendRequest(user="handoff-bob", message=longMessage, headers={"Room": "games"})
+        self.receiveUntil(alice, f"handoff-bob: {longMessage}")
+
+        ##The new server holds the usernames, rooms and mailboxes, and accepts new connections on the same port
+        _, message = self.register("handoff-alice")
+        self.assertEqual(message["Headers"]["Message-Type"], "Session-Rejection")
+        carol, _ = self.register("handoff-carol")
+        self.receiveUntil(carol, "handoff-bob: See you later")
+        carol.sendRequest(user="handoff-carol", message="/rooms", messageType="User-Command")
+        self.assertIn("games (2 members)", self.receiveCommandReply(carol, "/rooms")["Body"])
+
+        ##The new server can hand over in turn
+        self.takeOver()
+        alice.sendRequest(user="handoff-alice", message="Twice")
+        self.receiveUntil(bob, "handoff-alice: Twice")
+
+
+if __name__ == "__main__":
+    unittest.main()
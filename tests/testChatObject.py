@@ -1,6 +1,7 @@
+import os
 import unittest
 import sys
-sys.path.insert(0, "..\\src")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
 
 from src.server import chatObject
 
@@ -11,22 +12,82 @@ class testChatObject(unittest.TestCase):
 
 
     def test_logUserMessage(self):
-        self.setUp()
-        
+        ca = self.chatObject.logUserMessage("user5423", "Hello")
+        self.assertEqual((ca.sequence, ca.user, ca.message, ca.visibility), (0, "user5423", "Hello", "public"))
+        self.assertEqual(self.chatObject.getChat(0), ca)
+
+        ## Sequence numbers increase monotonically
+        ca = self.chatObject.logUserMessage("user5423", "World")
+        self.assertEqual(ca.sequence, 1)
+        self.assertEqual(len(self.chatObject), 2)
+
 
     def test_registerUser(self):
         USER = "user5423"
         USER2 = "admin"
         ##Testing register of user
         self.chatObject.registerUser(USER)
-        
+
         expectedOutput = [f"{USER} has just joined the server!"]
-        self.assertEqual(self.chatObject.chat, expectedOutput)
+        self.assertEqual([chat.message for chat in self.chatObject.getChatsSince(0)[1]], expectedOutput)
+        self.assertEqual(self.chatObject.userPointers[USER], 0)
+
+        ##Testing that a second user only sees the chat from when it joined
+        self.chatObject.registerUser(USER2)
+        self.assertEqual(self.chatObject.userPointers[USER2], 1)
+        self.assertEqual([chat.message for chat in self.chatObject.getNewChats(USER2)], [f"{USER2} has just joined the server!"])
+        self.assertEqual(len(self.chatObject.getNewChats(USER)), 2)
+        self.assertIsNone(self.chatObject.getNewChats(USER))
+
+
+    def test_getNewChats(self):
+        self.chatObject.registerUser("a")
+        self.chatObject.registerUser("b")
+        self.chatObject.getNewChats("a")
+        ##Users do not receive their own messages, nor private ones
+        self.chatObject.logUserMessage("a", "mine")
+        self.chatObject.logUserMessage("b", "private", "private")
+        self.chatObject.logUserMessage("b", "theirs")
+        self.assertEqual([chat.message for chat in self.chatObject.getNewChats("a")], ["theirs"])
+
+
+    def test_evictionByCount(self):
+        self.chatObject = chatObject(capacity=4)
+        for i in range(10):
+            self.chatObject.logUserMessage("user", str(i))
+        self.assertEqual(len(self.chatObject), 4)
+        self.assertEqual(self.chatObject.firstSequence, 6)
+        self.assertIsNone(self.chatObject.getChat(5))
+        self.assertEqual([chat.message for chat in self.chatObject.getChatsSince(0)[1]], ["6", "7", "8", "9"])
+
+
+    def test_evictionByBytes(self):
+        message = "x" * 100
+        self.chatObject = chatObject(capacity=100, maxBytes=3 * sys.getsizeof(message))
+        for _ in range(10):
+            self.chatObject.logUserMessage("user", message)
+        self.assertEqual(len(self.chatObject), 3)
+        self.assertLessEqual(self.chatObject.chatBytes, self.chatObject.maxBytes)
+
+        ##The most recent message is always retained
+        self.chatObject.logUserMessage("user", "y" * 1000)
+        self.assertEqual(len(self.chatObject), 1)
+
+
+    def test_gapSignal(self):
+        self.chatObject = chatObject(capacity=4)
+        self.chatObject.registerUser("reader")
+        for i in range(10):
+            self.chatObject.logUserMessage("writer", str(i))
+
+        gap, chats = self.chatObject.getChatsSince(self.chatObject.userPointers["reader"])
+        self.assertEqual(gap, 7)
+        chats = self.chatObject.getNewChats("reader")
+        self.assertEqual(chats[0].visibility, "gap")
+        self.assertEqual(chats[0].user, "Server")
+        self.assertEqual([chat.message for chat in chats[1:]], ["6", "7", "8", "9"])
+        self.assertEqual(self.chatObject.userPointers["reader"], self.chatObject.nextSequence)
 
-        expectedOutput = [f""]
-        self.assertEqual()
-        ...
 
-    ##We want to test registerUser
-    ##--> Registering a already registered User
-    ##--> Registering a user properly
\ No newline at end of file
+if __name__ == "__main__":
+    unittest.main()
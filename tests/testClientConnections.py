@@ -0,0 +1,51 @@
+import os
+import socket
+import unittest
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from src.message import clientConnection
+
+
+class testClientConnection(unittest.TestCase):
+    def setUp(self):
+        self.local, self.remote = socket.socketpair()
+        self.conn = clientConnection(self.local)
+
+    def tearDown(self):
+        self.local.close()
+        self.remote.close()
+
+    def receiveAll(self, size):
+        self.remote.settimeout(1.0)
+        data = b""
+        while len(data) < size:
+            data += self.remote.recv(size - len(data))
+        return data
+
+
+    def test_queueFrame(self):
+        self.assertTrue(self.conn.queueFrame(b"first"))
+        self.assertFalse(self.conn.queueFrame(b"second"))
+        self.assertTrue(self.conn.flushFrames())
+        self.assertEqual(self.receiveAll(11), b"firstsecond")
+        self.assertTrue(self.conn.queueFrame(b"third"))
+
+
+    def test_flushFramesSlowReader(self):
+        ##Queue more than the socket buffers can hold, so that the sends are partial
+        frames = [bytes([i]) * 100000 for i in range(20)]
+        for frame in frames: self.conn.queueFrame(frame)
+        expected = b"".join(frames)
+
+        received = b""
+        while not self.conn.flushFrames():
+            received += self.remote.recv(65536)
+        received += self.receiveAll(len(expected) - len(received))
+
+        ##No bytes are lost or duplicated
+        self.assertEqual(received, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
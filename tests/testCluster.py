@@ -0,0 +1,103 @@
+import os
+import selectors
+import socket
+import unittest
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from src.cluster import messageBus, busConnection
+from directMessages import DirectMessage
+from message import request
+
+
+class testMessageBus(unittest.TestCase):
+    def setUp(self):
+        self.bus = messageBus(highWatermark=4096, lowWatermark=1024)
+        self.workers = []
+        for _ in range(2):
+            busEnd, workerEnd = socket.socketpair()
+            self.bus.addWorker(busEnd)
+            self.workers.append(busConnection(workerEnd))
+
+    def tearDown(self):
+        for conn in list(self.bus.workers): self.bus.removeWorker(conn)
+        for worker in self.workers: worker.close()
+        self.bus.selector.close()
+
+    def serviceBus(self):
+        for selectorKey, bitmask in self.bus.selector.select(timeout=0.1):
+            if bitmask & selectors.EVENT_READ: self.bus.serviceWorker(selectorKey.data)
+            if bitmask & selectors.EVENT_WRITE and selectorKey.data in self.bus.workers: self.bus.flushWorker(selectorKey.data)
+
+    def readEvents(self, conn):
+        key = self.bus.selector.get_map().get(conn.sock)
+        return 0 if key is None else key.events & selectors.EVENT_READ
+
+
+    def test_reservation(self):
+        self.workers[0].reserve("alice")
+        self.workers[1].reserve("alice")
+        for _ in range(2): self.serviceBus()
+        for worker in self.workers: worker.sock.settimeout(2.0)
+        self.assertEqual(self.workers[0].receiveRequest()["Body"], "Accepted")
+        self.assertEqual(self.workers[1].receiveRequest()["Body"], "Rejected")
+
+    def test_invalidFrameDropsWorker(self):
+        ##A worker whose frame the bus can not service is dropped, along with its reservations, and the bus carries on
+        self.workers[0].reserve("alice")
+        self.serviceBus()
+        self.workers[0].send(request().createRawRequest("alice", "", "Bus-Unknown", "Text"))
+        self.serviceBus()
+        self.assertEqual(len(self.bus.workers), 1)
+        self.assertNotIn("alice", self.bus.users)
+        self.workers[1].reserve("alice")
+        for _ in range(2): self.serviceBus()
+        self.workers[1].sock.settimeout(2.0)
+        self.assertEqual(self.workers[1].receiveRequest()["Body"], "Accepted")
+
+    def test_invalidNamesNotRouted(self):
+        ##Names that could not have registered are neither reserved nor routed, as they are carried in the bus' headers
+        with self.assertRaises(ValueError): self.workers[0].sendDirect(DirectMessage(0.0, "alice", "bob\r\nRoom:x", "Hello"))
+        self.workers[0].send(request().createRawRequest("alice", "Hello", "Bus-Direct", "Text", {"Recipient": "bob smith", "Timestamp": "0.0"}))
+        self.serviceBus()
+        self.assertEqual(len(self.bus.mailboxes), 0)
+        self.assertEqual(len(self.bus.workers), 1)
+        self.workers[1].reserve("carol dave")
+        for _ in range(2): self.serviceBus()
+        self.workers[1].sock.settimeout(2.0)
+        self.assertEqual(self.workers[1].receiveRequest()["Body"], "Rejected")
+
+    def test_congestedWorkerPausesReads(self):
+        ##A worker that is not reading from the bus pauses the bus' reads from every worker, so its queue stays bounded
+        self.workers[0].sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        self.bus.workers[0].sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        for _ in range(200):
+            self.workers[1].publish("bob", "x" * 1000, "public", "lobby")
+            self.serviceBus()
+            if self.bus.congested: break
+        self.assertEqual(self.bus.congested, {self.bus.workers[0]})
+        self.assertFalse(any(self.readEvents(conn) for conn in self.bus.workers))
+        queued = self.bus.workers[0].outboundBytes
+        for _ in range(10):
+            self.workers[1].publish("bob", "x" * 1000, "public", "lobby")
+            self.serviceBus()
+        self.assertEqual(self.bus.workers[0].outboundBytes, queued)
+
+        ##Reads resume once the worker has drained its queue to the low watermark
+        while self.bus.congested:
+            for _ in self.workers[0].receiveRequests(): pass
+            self.serviceBus()
+        self.assertTrue(all(self.readEvents(conn) for conn in self.bus.workers))
+
+    def test_blockedWorkerQueuesFrames(self):
+        ##A worker's writes never block, and the frames the socket did not accept are queued until it is writable
+        blocked = []
+        self.workers[0].onBlocked = lambda: blocked.append(True)
+        self.workers[0].sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        for _ in range(200): self.workers[0].publish("alice", "x" * 1000, "public", "lobby")
+        self.assertEqual(blocked, [True])
+        self.assertGreater(len(self.workers[0].outbound) + len(self.workers[0].sending), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,33 @@
+import os
+import unittest
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from src.directMessages import mailboxes, DirectMessage
+
+
+class testDirectMessages(unittest.TestCase):
+    def test_mailboxCapacity(self):
+        boxes = mailboxes(capacity=3)
+        for i in range(5): boxes.deliver(DirectMessage(float(i), "alice", "bob", f"Message {i}"))
+        ##The oldest messages are dropped first, and the drops are reported when the mailbox is collected
+        dms, dropped = boxes.collect("bob")
+        self.assertEqual([dm.message for dm in dms], ["Message 2", "Message 3", "Message 4"])
+        self.assertEqual(dropped, 2)
+        self.assertEqual(boxes.collect("bob"), ([], 0))
+
+
+    def test_leastRecentMailboxDropped(self):
+        boxes = mailboxes(maxMailboxes=2)
+        boxes.deliver(DirectMessage(0.0, "alice", "bob", "First"))
+        boxes.deliver(DirectMessage(1.0, "alice", "carol", "Second"))
+        boxes.deliver(DirectMessage(2.0, "alice", "bob", "Third"))
+        boxes.deliver(DirectMessage(3.0, "alice", "dave", "Fourth"))
+        self.assertEqual(len(boxes), 3)
+        self.assertEqual(boxes.droppedMailboxes, 1)
+        self.assertEqual(boxes.collect("carol"), ([], 0))
+        self.assertEqual([dm.message for dm in boxes.collect("bob")[0]], ["First", "Third"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from src.eventLog import eventLog, readBinaryLog
+
+
+class testEventLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "server.log")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+    def test_jsonl(self):
+        log = eventLog(self.path)
+        log.start()
+        log.log("127.0.0.1", 5000, "alice", "Session-Creation", "Success")
+        log.log("127.0.0.1", 5001, None, "Connection-Accepted", "Success é")
+        log.close()
+        with open(self.path, encoding="utf-8") as file:
+            records = [json.loads(line) for line in file]
+        self.assertEqual([record["event"] for record in records], ["Session-Creation", "Connection-Accepted"])
+        self.assertEqual(records[1]["description"], "Success é")
+        self.assertIsNone(records[1]["user"])
+        self.assertAlmostEqual(records[0]["time"], time.time(), delta=5.0)
+
+
+    def test_binary(self):
+        log = eventLog(self.path, "binary")
+        log.start()
+        for i in range(1000):
+            log.log("127.0.0.1", i, f"user{i}", "User-Message", "x" * i)
+        log.close()
+        records = list(readBinaryLog(self.path))
+        self.assertEqual(len(records), 1000)
+        self.assertEqual(records[999]["port"], "999")
+        self.assertEqual(records[999]["description"], "x" * 999)
+
+
+    def test_batchedWrites(self):
+        ##Filling a batch wakes the writer up before the flush interval has elapsed
+        log = eventLog(self.path, batchSize=100, flushInterval=60.0)
+        log.start()
+        for i in range(100):
+            log.log("127.0.0.1", 5000, "alice", "User-Message", str(i))
+        for _ in range(100):
+            if log.written == 100: break
+            time.sleep(0.01)
+        self.assertEqual(log.written, 100)
+        self.assertEqual(log.batches, 1)
+        log.close()
+
+
+    def test_boundedQueue(self):
+        ##Records are dropped once the queue is full, and the drops are recorded once the writer catches up
+        log = eventLog(self.path, maxQueue=10)
+        for i in range(25):
+            log.log("127.0.0.1", 5000, "alice", "User-Message", str(i))
+        self.assertEqual(len(log.records), 10)
+        self.assertEqual(log.dropped, 15)
+        log.start()
+        log.close()
+        with open(self.path, encoding="utf-8") as file:
+            records = [json.loads(line) for line in file]
+        self.assertEqual(len(records), 11)
+        self.assertEqual((records[-1]["event"], records[-1]["description"]), ("Log-Records-Dropped", "15"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+import json
+import os
+import socket
+import tempfile
+import threading
+import unittest
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from src.handoff import sendHandoff, receiveHandoff, HANDOFF_FD_BATCH, HANDOFF_ACK, HANDOFF_COMMIT
+from server import messengingServer
+from message import connections, frameCompressor, frameDecoder, inflatingDecoder, request
+from directMessages import DirectMessage
+
+
+@unittest.skipUnless(hasattr(socket, "send_fds"), "Handoff requires SCM_RIGHTS on a Unix socket")
+class testHandoff(unittest.TestCase):
+    def test_descriptorsSentInBatches(self):
+        sender, receiver = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        with tempfile.TemporaryFile() as file, sender, receiver:
+            fds = [os.dup(file.fileno()) for _ in range(2 * HANDOFF_FD_BATCH + 1)]
+            thread = threading.Thread(target=sendHandoff, args=(sender, {"padding": "x" * 300000}, fds))
+            thread.start()
+            state, received = receiveHandoff(receiver)
+            thread.join()
+            ##Every descriptor refers to the same open file, in this process
+            self.assertEqual(len(received), len(fds))
+            self.assertEqual(len(state["padding"]), 300000)
+            self.assertEqual({os.fstat(fd).st_ino for fd in received}, {os.fstat(file.fileno()).st_ino})
+            for fd in fds + received: os.close(fd)
+
+    def test_roomsAndMailboxesRestored(self):
+        old, new = messengingServer(), messengingServer()
+        old.connections, old.serverSocket = connections(), socket.socket()
+        self.addCleanup(old.serverSocket.close)
+        for user in ("alice", "bob"): old.joinRoom(user, old.chat)
+        old.joinRoom("bob", old.getRoom("games"), "bob has joined games")
+        old.chat.logUserMessage("alice", "Hello lobby")
+        old.getRoom("games").logUserMessage("bob", "Hello games")
+        old.broadcastNewChats()
+        old.chat.userPointers["alice"] = 2
+        old.mailboxes.deliver(DirectMessage(1.0, "alice", "carol", "Later"))
+
+        state, fds = old.exportState()
+        self.assertEqual(fds, [old.serverSocket.fileno()])
+        state = json.loads(json.dumps(state))
+        new.restoreRooms(state["rooms"])
+        new.mailboxes.restore(state["mailboxes"])
+
+        ##The chat, its sequence numbers and index, and every member's cursor carry on where they were
+        self.assertEqual(new.chat.getChat(2).message, "Hello lobby")
+        self.assertEqual(new.chat.nextSequence, old.chat.nextSequence)
+        self.assertEqual(new.chat.broadcastSequence, new.chat.nextSequence)
+        self.assertEqual(new.chat.userPointers, {"alice": 2, "bob": 1})
+        self.assertEqual(new.chat.index.search(["lobby"], 10), [2])
+        self.assertEqual(new.getRoom("games").getChat(1).message, "Hello games")
+        self.assertEqual(new.userRooms, {"alice": {"lobby"}, "bob": {"lobby", "games"}})
+        self.assertEqual(new.mailboxes.collect("carol"), ([DirectMessage(1.0, "alice", "carol", "Later")], 0))
+        self.assertFalse(new.updatedRooms)
+
+    def handOverTo(self, commit):
+        ##Plays the old server's side of a handoff of its listening socket, sending the commit only if commit is True
+        old = messengingServer()
+        old.connections, old.serverSocket = connections(), socket.create_server(("127.0.0.1", 0))
+        self.addCleanup(old.serverSocket.close)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        handoffSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(handoffSocket.close)
+        handoffSocket.bind(os.path.join(directory.name, "handoff.sock"))
+        handoffSocket.listen(1)
+        def serve():
+            peer, _ = handoffSocket.accept()
+            with peer:
+                sendHandoff(peer, *old.exportState())
+                if peer.recv(1) == HANDOFF_ACK and commit: peer.sendall(HANDOFF_COMMIT)
+        thread = threading.Thread(target=serve)
+        thread.start()
+        new = messengingServer()
+        new.connections, new.takeoverPath, new.handoffTimeout = connections(), handoffSocket.getsockname(), 2.0
+        taken = new.takeOver()
+        thread.join()
+        if taken: self.addCleanup(new.releaseConnections)
+        return old, new, taken
+
+    def test_takeoverWaitsForCommit(self):
+        old, new, taken = self.handOverTo(commit=True)
+        self.assertTrue(taken)
+        self.assertEqual(new.serverSocket.getsockname(), old.serverSocket.getsockname())
+
+    def test_uncommittedTakeoverReleasesSockets(self):
+        ##A new server whose acknowledgement the old one did not act on (such as when it came too late) must not serve,
+        ##and it closes its own copies of the sockets, which the old server still holds open
+        old, new, taken = self.handOverTo(commit=False)
+        self.assertFalse(taken)
+        self.assertEqual(new.serverSocket.fileno(), -1)
+        socket.create_connection(old.serverSocket.getsockname()).close()
+
+    def test_deflateStreamContinues(self):
+        ##A new compressor carries on the stream that the client is inflating, as every frame ended with Z_SYNC_FLUSH
+        frames = [request().createRawRequest("alice", f"Message {i} " * 40, "Chat-Update", "Text") for i in range(4)]
+        oldCompressor, newCompressor = frameCompressor(), frameCompressor()
+        stream = b"".join(chunk for frame in frames[:2] for chunk in oldCompressor.pack(frame))
+        stream += b"".join(chunk for frame in frames[2:] for chunk in newCompressor.pack(frame))
+        decoder = inflatingDecoder(frameDecoder())
+        decoder.feed(stream)
+        self.assertEqual([message["Body"] for message in decoder.frames()], [f"Message {i} " * 40 for i in range(4)])
+
+
+if __name__ == "__main__":
+    unittest.main()
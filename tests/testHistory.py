@@ -0,0 +1,180 @@
+import os
+import tempfile
+import unittest
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from history import chatHistory, durableChatObject
+
+
+class testHistory(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def createChat(self, capacity=16, indexWindow=None, **kwargs):
+        return durableChatObject(chatHistory(self.directory.name, **kwargs), capacity, indexWindow=indexWindow)
+
+    def segmentFiles(self):
+        return sorted(name for name in os.listdir(self.directory.name) if name.endswith(".segment"))
+
+
+    def test_readEvictedChats(self):
+        ##Chat actions that have been evicted from the ring buffer are read back from the history instead of being dropped
+        chat = self.createChat(capacity=4, indexInterval=3)
+        for i in range(10): chat.logUserMessage("alice", f"Message {i}")
+        chat.commit()
+        gap, chats = chat.getChatsSince(2)
+        self.assertEqual(gap, 0)
+        self.assertEqual([ca.message for ca in chats], [f"Message {i}" for i in range(2, 10)])
+        self.assertEqual([ca.sequence for ca in chat.history.read(5, 7)], [5, 6])
+        chat.close()
+
+
+    def test_recovery(self):
+        chat = self.createChat(capacity=4)
+        for i in range(10): chat.logUserMessage("alice", f"Message {i} é")
+        chat.commit()
+        chat.close()
+
+        ##The ring buffer is rebuilt from the tail of the history, and sequence numbers carry on from it
+        chat = self.createChat(capacity=4)
+        self.assertEqual((chat.firstSequence, chat.nextSequence), (6, 10))
+        self.assertEqual(chat.getChat(9).message, "Message 9 é")
+        self.assertEqual(chat.logUserMessage("bob", "Hello").sequence, 10)
+        chat.close()
+
+
+    def test_recoveredTimestamps(self):
+        ##The age of a recovered segment is that of its last chat action, whatever the mtime of its file
+        chat = self.createChat(segmentBytes=256)
+        for i in range(50):
+            chat.logUserMessage("alice", f"Message {i}")
+            chat.commit()
+        lastTimestamps = [segment.lastTimestamp for segment in chat.history.segments]
+        chat.close()
+        for name in self.segmentFiles(): os.utime(os.path.join(self.directory.name, name), (0, 0))
+
+        chat = self.createChat(segmentBytes=256, retentionSeconds=3600)
+        self.assertEqual([segment.lastTimestamp for segment in chat.history.segments], lastTimestamps)
+        chat.maintain()
+        self.assertEqual(len(chat.history.segments), len(lastTimestamps))
+        chat.close()
+
+
+    def test_tornRecordTruncated(self):
+        chat = self.createChat()
+        for i in range(5): chat.logUserMessage("alice", f"Message {i}")
+        chat.close()
+        path = os.path.join(self.directory.name, self.segmentFiles()[-1])
+        with open(path, "ab") as file: file.write(b"\x20\x01\x02")
+
+        chat = self.createChat()
+        self.assertEqual(chat.nextSequence, 5)
+        chat.logUserMessage("alice", "After the crash")
+        chat.close()
+        chat = self.createChat()
+        self.assertEqual([ca.message for ca in chat.getChatsSince(0)[1]][-2:], ["Message 4", "After the crash"])
+        chat.close()
+
+
+    def test_rollAndCompact(self):
+        chat = self.createChat(segmentBytes=256, retentionBytes=1024)
+        for i in range(200):
+            chat.logUserMessage("alice", f"Message {i}")
+            chat.commit()
+        self.assertGreater(len(self.segmentFiles()), 1)
+        self.assertLessEqual(sum(segment.size for segment in chat.history.segments[:-1]), 1024)
+        ##Chat actions retired from the history are reported as a gap
+        gap, chats = chat.getChatsSince(0)
+        self.assertEqual(gap, chat.history.firstSequence)
+        self.assertEqual(chats[0].sequence, chat.history.firstSequence)
+        self.assertEqual(chats[-1].message, "Message 199")
+        chat.close()
+
+
+    def test_maintainSyncsTail(self):
+        ##The appends left unsynced by the last commit are synced by maintain() once the interval has passed
+        chat = self.createChat(syncInterval=60)
+        chat.logUserMessage("alice", "Hello")
+        chat.commit()
+        self.assertTrue(chat.history.unsynced)
+        chat.maintain()
+        self.assertTrue(chat.history.unsynced)
+        chat.history.lastSync -= 60
+        chat.maintain()
+        self.assertFalse(chat.history.unsynced)
+        chat.close()
+
+
+    def test_rollByAge(self):
+        ##A quiet segment is rolled once it is older than segmentSeconds, so that it can then be retired by age
+        chat = self.createChat(segmentSeconds=60, retentionSeconds=60)
+        for i in range(5): chat.logUserMessage("alice", f"Message {i}")
+        chat.commit()
+        chat.history.segments[-1].indexTimestamps[0] -= 120
+        chat.maintain()
+        self.assertIsNone(chat.history.file)
+        chat.logUserMessage("alice", "Later")
+        chat.commit()
+        self.assertEqual(len(self.segmentFiles()), 2)
+        chat.history.segments[0].lastTimestamp -= 120
+        chat.maintain()
+        self.assertEqual(len(self.segmentFiles()), 1)
+        self.assertEqual(chat.getChatsSince(0)[1][-1].message, "Later")
+        chat.close()
+
+
+    def test_findSequence(self):
+        chat = self.createChat(indexInterval=4)
+        for i in range(20): chat.logUserMessage("alice", f"Message {i}")
+        chat.commit()
+        timestamp = chat.getChat(13).timestamp
+        self.assertLessEqual(chat.history.findSequence(timestamp), 13)
+        self.assertEqual(chat.history.findSequence(timestamp + 3600), 20)
+        chat.close()
+
+
+    def test_indexWindow(self):
+        ##Only the newest chat actions are indexed in memory, and queries carry on into the segment files
+        chat = self.createChat(indexWindow=32, indexInterval=8)
+        for i in range(10000):
+            chat.logUserMessage(f"user{i % 3}", f"Message {i} {'even' if i % 2 == 0 else 'odd'}")
+            if i == 20: chat.logUserMessage("user0", "Secret 20", "private")
+        chat.commit()
+        self.assertLess(len(chat.index.sequences), 5000)
+        self.assertEqual(chat.index.search(["17"], 10), [17])
+        self.assertEqual(chat.index.search(["20"], 10), [20])
+        self.assertEqual(chat.index.search(["even"], 3), [9995, 9997, 9999])
+        self.assertEqual([ca.message for ca in chat.getChatsBySequence(chat.index.search(["odd", "3"], 10))], ["Message 3 odd"])
+        self.assertEqual(chat.index.fromUser("user1", 3), [9992, 9995, 9998])
+        self.assertEqual(len(chat.index.history(100)), 100)
+        self.assertEqual(chat.index.history(100)[0], 9901)
+        self.assertEqual(chat.index.since(chat.getChatsBySequence([5])[0].timestamp, 3)[-1], 7)
+        chat.close()
+
+
+    def test_indexWindowRecovered(self):
+        chat = self.createChat(capacity=4)
+        for i in range(100): chat.logUserMessage("alice", f"Message {i}")
+        chat.close()
+
+        ##The index window is rebuilt from the history, and older chat actions are still found in the segment files
+        chat = self.createChat(capacity=4, indexWindow=50)
+        self.assertEqual(chat.index.floor, 50)
+        self.assertEqual(list(chat.index.sequences)[0], 50)
+        self.assertEqual(chat.index.search(["60"], 10), [60])
+        self.assertEqual(chat.index.search(["5"], 10), [5])
+        self.assertEqual(chat.index.history(3), [97, 98, 99])
+        self.assertIsNone(chat.index.scanCutoff)
+        ##A query scans a bounded number of archived chat actions, and notes where it stopped
+        chat.index.scanLimit = 20
+        self.assertEqual(chat.index.search(["5"], 10), [])
+        self.assertEqual(chat.index.scanCutoff, next(chat.history.read(29, 30)).timestamp)
+        chat.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
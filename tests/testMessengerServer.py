@@ -0,0 +1,446 @@
+import os
+import selectors
+import socket
+import time
+import unittest
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from src.server import messengingServer
+from message import clientConnection, request
+from rateLimit import tokenBucket
+
+
+class testMessengerServer(unittest.TestCase):
+    def setUp(self):
+        self.server = messengingServer()
+        self.server._setup(0)
+        self.peers = []
+
+    def tearDown(self):
+        for sock in self.peers: sock.close()
+        self.server.closeRemainingConnections()
+        self.server.serverSocket.close()
+        self.server.selector.close()
+        self.server.eventLog.close()
+
+    def createConnection(self):
+        remote = socket.create_connection(self.server.serverSocket.getsockname())
+        self.peers.append(remote)
+        self.server.serverSocket.setblocking(True)
+        local, _ = self.server.serverSocket.accept()
+        self.server.serverSocket.setblocking(False)
+        conn = clientConnection(local)
+        self.server.connections.registerConnection(conn)
+        self.server.selector.register(conn.sock, selectors.EVENT_READ, data=conn)
+        return conn
+
+    def createSession(self, user):
+        conn = self.createConnection()
+        self.server.createSession(user, conn)
+        return conn
+
+
+    def test_broadcastNewChats(self):
+        alice, bob, carol = self.createSession("alice"), self.createSession("bob"), self.createSession("carol")
+        for conn in (alice, bob, carol): conn.outbound.clear()
+        self.server.chat.broadcastSequence = self.server.chat.nextSequence
+
+        self.server.logMessage("alice", "User-Message", "Hello")
+        self.server.broadcastNewChats()
+
+        ##The sender does not receive its own message, and every other subscriber shares the same encoded frame
+        self.assertEqual(len(alice.outbound), 0)
+        self.assertEqual(len(bob.outbound), 1)
+        self.assertIs(bob.outbound[0], carol.outbound[0])
+        self.assertIn(b"alice: Hello", bob.outbound[0])
+        self.assertEqual(self.server.chat.userPointers["bob"], self.server.chat.nextSequence)
+
+
+    def test_broadcastOnlyAfterJoining(self):
+        alice = self.createSession("alice")
+        self.server.logMessage("alice", "User-Message", "Before")
+        bob = self.createSession("bob")
+        self.server.broadcastNewChats()
+
+        ##Chats logged before a user joined are not broadcast to that user
+        self.assertFalse(any(b"Before" in frame for frame in bob.outbound))
+        self.assertTrue(any(b"bob has just joined" in frame for frame in alice.outbound))
+
+
+    def test_privateChatsAreNotBroadcast(self):
+        alice, bob = self.createSession("alice"), self.createSession("bob")
+        self.server.broadcastNewChats()
+        bob.outbound.clear()
+        self.server.logMessage("alice", "User-Message", "Secret", "private")
+        self.server.broadcastNewChats()
+        self.assertEqual(len(bob.outbound), 0)
+
+
+    def test_roomsOnlyDeliverToMembers(self):
+        alice, bob, carol = self.createSession("alice"), self.createSession("bob"), self.createSession("carol")
+        self.server.commandJoin("alice", alice, self.server.chat, "games")
+        self.server.commandJoin("bob", bob, self.server.chat, "games")
+        self.server.broadcastNewChats()
+        for conn in (alice, bob, carol): conn.outbound.clear()
+
+        games = self.server.rooms["games"]
+        self.server.logMessage("alice", "User-Message", "Hello games", room=games)
+        self.server.broadcastNewChats()
+        self.assertEqual(len(bob.outbound), 1)
+        self.assertIn(b"Room:games", bob.outbound[0])
+        self.assertEqual(len(carol.outbound), 0)
+        ##Each room has its own log and cursors
+        self.assertEqual(games.userPointers["bob"], games.nextSequence)
+        self.assertEqual(self.server.chat.index.search(["games"], 10), [])
+
+
+    def test_spoofedRoomActions(self):
+        alice, mallory = self.createSession("alice"), self.createSession("mallory")
+        self.server.commandJoin("alice", alice, self.server.chat, "games")
+        self.server.broadcastNewChats()
+        start = self.server.chat.nextSequence
+        ##Frames that claim to be from another user can not post, join or leave rooms as them
+        self.serviceRead(mallory, ["Hello from alice"], user="alice")
+        self.serviceRead(mallory, ["/join secret", "/leave games"], "User-Command", user="alice")
+        self.assertEqual(self.server.chat.nextSequence, start)
+        self.assertNotIn("secret", self.server.rooms)
+        self.assertIn("alice", self.server.rooms["games"].userPointers)
+        ##The session's own frames act as the user it registered
+        self.serviceRead(mallory, ["Hello"])
+        self.serviceRead(mallory, ["/join secret"], "User-Command")
+        self.assertEqual(self.server.chat.getChat(start).user, "mallory")
+        self.assertEqual(set(self.server.rooms["secret"].userPointers), {"mallory"})
+
+
+    def test_leavingRemovesEmptyRooms(self):
+        alice = self.createSession("alice")
+        self.server.commandJoin("alice", alice, self.server.chat, "games")
+        with self.assertRaises(ValueError): self.server.commandJoin("alice", alice, self.server.chat, "games")
+        with self.assertRaises(ValueError): self.server.commandJoin("alice", alice, self.server.chat, "no spaces")
+        self.server.commandLeave("alice", alice, self.server.rooms["games"], "")
+        self.assertNotIn("games", self.server.rooms)
+        self.assertEqual(self.server.userRooms["alice"], {"lobby"})
+        with self.assertRaises(ValueError): self.server.commandLeave("alice", alice, self.server.chat, "lobby")
+
+        ##Closing a session leaves every room
+        self.server.commandJoin("alice", alice, self.server.chat, "games")
+        self.server.closeSession("alice", alice)
+        self.assertNotIn("games", self.server.rooms)
+        self.assertNotIn("alice", self.server.chat.userPointers)
+
+
+    def test_directMessages(self):
+        alice, bob, carol = self.createSession("alice"), self.createSession("bob"), self.createSession("carol")
+        self.server.broadcastNewChats()
+        for conn in (alice, bob, carol): conn.outbound.clear()
+
+        ##Direct messages are queued straight to the recipient, and never enter the room's log
+        nextSequence = self.server.chat.nextSequence
+        self.server.commandMessage("alice", alice, self.server.chat, "bob Hello bob")
+        self.server.broadcastNewChats()
+        self.assertEqual(len(bob.outbound), 1)
+        self.assertIn(b"Direct:alice", bob.outbound[0])
+        self.assertEqual(len(carol.outbound), 0)
+        self.assertEqual(self.server.chat.nextSequence, nextSequence)
+
+        ##Messages to offline users are held until they log in
+        self.server.commandMessage("alice", alice, self.server.chat, "dave Hello dave")
+        self.assertEqual(len(self.server.mailboxes), 1)
+        dave = self.createSession("dave")
+        self.assertTrue(any(b"alice: Hello dave" in frame and b"Sent:" in frame for frame in dave.outbound))
+        self.assertEqual(len(self.server.mailboxes), 0)
+        with self.assertRaises(ValueError): self.server.commandMessage("alice", alice, self.server.chat, "bob")
+        ##Recipients that could not have registered are rejected, rather than being held in a mailbox (or routed in a header)
+        with self.assertRaises(ValueError): self.server.commandMessage("alice", alice, self.server.chat, "bob\r\nRoom:x Hello")
+        with self.assertRaises(ValueError): self.server.commandMessage("alice", alice, self.server.chat, "b" * 33 + " Hello")
+        self.assertEqual(len(self.server.mailboxes), 0)
+
+
+    def test_spoofedDirectMessage(self):
+        alice, bob, mallory = self.createSession("alice"), self.createSession("bob"), self.createSession("mallory")
+        self.server.broadcastNewChats()
+        for conn in (alice, bob, mallory): conn.outbound.clear()
+        ##A frame that claims to be from another user is rejected, rather than sending the direct message as them
+        self.serviceRead(mallory, ["/msg bob Hello from alice"], "User-Command", user="alice")
+        self.assertEqual(len(bob.outbound), 0)
+        self.assertEqual(len(mallory.outbound), 1)
+        self.assertIn(b"registered as mallory", mallory.outbound[0])
+        ##The session's own frames are still sent as the user it registered
+        self.serviceRead(mallory, ["/msg bob Hello bob"], "User-Command")
+        self.assertEqual(len(bob.outbound), 1)
+        self.assertIn(b"Direct:mallory", bob.outbound[0])
+
+
+    def test_resumeFromSequence(self):
+        alice, bob = self.createSession("alice"), self.createSession("bob")
+        self.server.commandJoin("bob", bob, self.server.chat, "games")
+        self.server.broadcastNewChats()
+        lastSeen = self.server.chat.nextSequence - 1
+        lastSeenGames = self.server.rooms["games"].nextSequence - 1
+        self.server.closeSession("bob", bob)
+        self.server.commandJoin("alice", alice, self.server.chat, "games")
+        for i in range(3):
+            self.server.logMessage("alice", "User-Message", f"Missed {i}")
+        self.server.logMessage("alice", "User-Message", "Missed in games", room=self.server.rooms["games"])
+        self.server.broadcastNewChats()
+
+        ##Only the chat actions after the presented sequence numbers are sent, each carrying its own sequence number
+        bob = self.createConnection()
+        self.server.createSession("bob", bob, resume={None: lastSeen, "games": lastSeenGames})
+        frames = list(bob.outbound)
+        self.assertTrue(any(b"alice: Missed 0" in frame and f"Sequence:{lastSeen + 2}".encode() in frame for frame in frames))
+        self.assertTrue(any(b"alice: Missed in games" in frame and b"Room:games" in frame for frame in frames))
+        self.assertFalse(any(b"bob has just joined" in frame for frame in frames))
+        self.assertIn("games", self.server.userRooms["bob"])
+        ##Nothing is sent twice once the new chat is broadcast
+        bob.outbound.clear()
+        self.server.broadcastNewChats()
+        self.assertFalse(any(b"Missed" in frame for frame in bob.outbound))
+
+    def test_resumeReportsGap(self):
+        self.server.resumeLimit = 2
+        alice = self.createSession("alice")
+        for i in range(5):
+            self.server.logMessage("alice", "User-Message", f"Missed {i}")
+        self.server.broadcastNewChats()
+        bob = self.createConnection()
+        self.server.createSession("bob", bob, resume={None: 0})
+        frames = list(bob.outbound)[1:]
+        ##The chat actions beyond the resume limit are reported as a gap, rather than sent
+        self.assertEqual(len(frames), 3)
+        self.assertIn(b"Gap:3", frames[0])
+        self.assertIn(b"alice: Missed 3", frames[1])
+        self.assertIn(b"alice: Missed 4", frames[2])
+
+
+    def test_heartbeatAndIdleTimeout(self):
+        alice, bob = self.createSession("alice"), self.createSession("bob")
+        self.assertIsNotNone(bob.timer)
+        self.server.broadcastNewChats()
+        bob.outbound.clear()
+        ##A client that has been silent for the heartbeat interval is sent a Ping
+        bob.lastActivity -= self.server.heartbeatInterval
+        self.server.checkLiveness(bob)
+        self.assertIn(b"Message-Type:Ping", bob.outbound[-1])
+        self.assertIsNotNone(bob.timer)
+        ##and is disconnected if it stays silent until the idle timeout, which releases its name and cursor
+        bob.lastActivity -= self.server.idleTimeout
+        self.server.checkLiveness(bob)
+        self.assertNotIn("bob", self.server.connections.userToConnection)
+        self.assertNotIn("bob", self.server.chat.userPointers)
+        self.assertIsNone(bob.timer)
+        ##An active client is only checked again later
+        self.server.checkLiveness(alice)
+        self.assertIn("alice", self.server.connections.userToConnection)
+        self.assertEqual(len(self.server.timers), 1)
+
+    def test_handshakeTimeout(self):
+        conn = self.createConnection()
+        self.server.startHandshakeTimer(conn)
+        self.server.handshakeExpired(conn)
+        self.assertFalse(self.server.connections.isRegistered(conn))
+        ##A connection that registered in time is left alone, and its handshake timer is replaced
+        conn = self.createConnection()
+        self.server.startHandshakeTimer(conn)
+        handshakeTimer = conn.timer
+        self.server.createSession("alice", conn)
+        self.assertIsNot(conn.timer, handshakeTimer)
+        self.server.handshakeExpired(conn)
+        self.assertIn("alice", self.server.connections.userToConnection)
+
+
+    def test_acceptInBatches(self):
+        clients = [socket.create_connection(self.server.serverSocket.getsockname()) for _ in range(5)]
+        self.peers.extend(clients)
+        time.sleep(0.05)
+        self.server.acceptBatch, self.server.maxConnections = 2, 3
+        acceptConnections = self.server._messengingServer__acceptConnections
+        acceptConnections()
+        accepted = list(self.server.connections.filenoToConnection.values())
+        self.assertEqual(len(accepted), 2)
+        ##The peer's address is the one returned by accept()
+        self.assertLessEqual({conn.peername for conn in accepted}, {client.getsockname() for client in clients})
+        self.assertEqual(self.server.selector.get_key(accepted[0].sock).data, accepted[0])
+        ##Connections beyond the limit are sent a rejection and closed, without being registered
+        acceptConnections()
+        acceptConnections()
+        self.assertEqual(len(self.server.connections.filenoToConnection), 3)
+        rejected = [client for client in clients if client.getsockname() not in {conn.peername for conn in self.server.connections.filenoToConnection.values()}]
+        self.assertEqual(len(rejected), 2)
+        for client in rejected:
+            client.settimeout(1.0)
+            self.assertIn(b"Session-Rejection", client.recv(1024))
+            self.assertEqual(client.recv(1024), b"")
+
+    def serviceRead(self, conn, messages, messageType="User-Message", user=None):
+        ##Sends pipelined messages from the connection's client, and services the read event as the event loop would
+        peer = self.peers[[sock.getsockname() for sock in self.peers].index(conn.sock.getpeername())]
+        peer.sendall(b"".join(request().createRawRequest(user or conn.user, message, messageType, "Text") for message in messages))
+        time.sleep(0.05)
+        self.server.serviceEvents([(self.server.selector.get_key(conn.sock), selectors.EVENT_READ)])
+
+    def test_messageRateLimit(self):
+        self.server.messageRate, self.server.messageBurst = 1.0, 5
+        alice = self.createSession("alice")
+        alice.outbound.clear()
+        start = self.server.chat.nextSequence
+        self.serviceRead(alice, [f"Flood {i}" for i in range(10)])
+        ##Only the burst is admitted, and the client is told once that the rest were dropped
+        self.assertEqual(self.server.chat.nextSequence - start, 5)
+        throttles = [frame for frame in alice.outbound if b"Message-Type:Throttle" in frame]
+        self.assertEqual(len(throttles), 1)
+        self.assertIn(b"Retry-After:", throttles[0])
+
+    def test_maxFramesPerPass(self):
+        self.server.maxFramesPerPass = 3
+        alice = self.createSession("alice")
+        start = self.server.chat.nextSequence
+        self.serviceRead(alice, [f"Pipelined {i}" for i in range(7)])
+        self.assertEqual(self.server.chat.nextSequence - start, 3)
+        self.assertIn(alice, self.server.pendingReads)
+        self.assertEqual(self.server.selectTimeout(), 0)
+        ##The connection is not read from again until its buffered frames have been serviced, a few per pass of the loop
+        self.serviceRead(alice, ["Later"])
+        self.assertEqual(self.server.chat.nextSequence - start, 3)
+        self.server.servicePendingReads()
+        self.server.servicePendingReads()
+        self.assertEqual(self.server.chat.nextSequence - start, 7)
+        self.assertNotIn(alice, self.server.pendingReads)
+        self.server.serviceEvents([(self.server.selector.get_key(alice.sock), selectors.EVENT_READ)])
+        self.assertEqual(self.server.chat.nextSequence - start, 8)
+
+    def test_byteRateLimitPausesReads(self):
+        alice = self.createSession("alice")
+        alice.byteBucket = tokenBucket(1000.0, 100, time.monotonic())
+        start = self.server.chat.nextSequence
+        self.serviceRead(alice, ["x" * 500])
+        ##The frame is serviced, but the connection is not read from until its debt has been repaid
+        self.assertEqual(self.server.chat.nextSequence - start, 1)
+        self.assertTrue(alice.readPaused)
+        self.assertNotIn(alice.sock, self.server.selector.get_map())
+        self.assertIsNotNone(alice.resumeTimer)
+        self.server.resumeReading(alice)
+        self.assertFalse(alice.readPaused)
+        self.assertEqual(self.server.selector.get_key(alice.sock).events, selectors.EVENT_READ)
+
+
+    def floodConnection(self, user, conn, count=20):
+        ##Queues frames to a connection without flushing them, as if its client had stopped reading
+        self.server.outboundHighWatermark, self.server.outboundLowWatermark = 1000, 500
+        conn.writeInterest = True
+        for i in range(count):
+            self.server.logMessage(user, "User-Message", f"Message {i} " + "x" * 100)
+            self.server.broadcastNewChats()
+
+    def test_slowConsumerCoalesce(self):
+        alice, bob = self.createSession("alice"), self.createSession("bob")
+        self.server.broadcastNewChats()
+        bob.clearOutbound()
+        self.server.commandMessage("alice", alice, self.server.chat, "bob Before")
+        self.floodConnection("alice", bob)
+        ##The queued broadcasts are skipped until the client catches up, and then replaced by a summary
+        self.assertTrue(bob.congested)
+        self.assertGreater(bob.skippedFrames, 0)
+        ##Direct messages are never skipped, whether they were queued before or during the congestion
+        self.server.commandMessage("alice", alice, self.server.chat, "bob During")
+        self.assertEqual(len(bob.outbound), 2)
+        self.assertIn(b"alice: Before", bob.outbound[0])
+        self.assertIn(b"alice: During", bob.outbound[1])
+        self.assertEqual(bob.outboundBytes, sum(len(frame) for frame in bob.outbound))
+        self.server.flushConnection("bob", bob)
+        self.assertFalse(bob.congested)
+        self.assertEqual(len(bob.outbound), 1)
+        self.assertIn(b"updates were skipped", bob.outbound[0])
+
+
+    def test_slowConsumerDropOldest(self):
+        self.server.slowConsumerPolicy = "drop-oldest"
+        alice, bob = self.createSession("alice"), self.createSession("bob")
+        self.server.broadcastNewChats()
+        self.floodConnection("alice", bob)
+        self.assertLessEqual(bob.outboundBytes, 1000)
+        self.assertEqual(bob.outboundBytes, sum(len(frame) for frame in bob.outbound))
+        self.assertIn(b"Message 19", bob.outbound[-1])
+        self.assertFalse(any(b"Message 0 " in frame for frame in bob.outbound))
+
+
+    def test_slowConsumerDisconnect(self):
+        self.server.slowConsumerPolicy = "disconnect"
+        alice, bob = self.createSession("alice"), self.createSession("bob")
+        self.server.broadcastNewChats()
+        self.floodConnection("alice", bob)
+        self.assertIn(bob, self.server.slowConsumers)
+        self.server.disconnectSlowConsumers()
+        self.assertNotIn("bob", self.server.connections.userToConnection)
+        self.assertNotIn("bob", self.server.chat.userPointers)
+        ##The other sessions are unaffected
+        self.assertIn("alice", self.server.connections.userToConnection)
+        self.peers[1].settimeout(1.0)
+        received = b""
+        while b"Session-Termination" not in received: received += self.peers[1].recv(65536)
+
+
+    def test_writeInterestOnlyWhileQueued(self):
+        alice = self.createSession("alice")
+        ##Queued frames are flushed at the end of the pass of the event loop, without waiting for the socket to be writable
+        self.assertIn(alice, self.server.pendingFlush)
+        self.assertEqual(self.server.selector.get_key(alice.sock).events, selectors.EVENT_READ)
+        self.server.flushPending()
+        self.assertEqual(len(alice.outbound) + len(alice.sending), 0)
+
+        ##The connection is only registered for writing while the socket will not accept its queued frames
+        self.server.outboundHighWatermark = 1 << 30
+        for _ in range(200): self.server.queueFrame(alice, b"x" * 65536)
+        self.server.flushPending()
+        self.assertTrue(self.server.selector.get_key(alice.sock).events & selectors.EVENT_WRITE)
+        self.peers[0].setblocking(False)
+        while alice.writeInterest:
+            try:
+                while self.peers[0].recv(1048576): pass
+            except BlockingIOError: pass
+            self.server.flushConnection("alice", alice)
+        self.assertEqual(self.server.selector.get_key(alice.sock).events, selectors.EVENT_READ)
+
+
+    def test_scatterGatherFlush(self):
+        self.server.enableMetrics()
+        alice = self.createSession("alice")
+        alice.bytesOutCounter, alice.sendCallsCounter = self.server.bytesOut, self.server.sendCalls
+        self.server.flushPending()
+        for i in range(100): self.server.queueFrame(alice, f"Frame {i}\n".encode())
+        self.server.flushPending()
+        ##The frames are sent in order, with a single syscall
+        self.assertEqual(self.server.sendCalls.value, 2)
+        self.peers[0].settimeout(1.0)
+        received = b""
+        while not received.endswith(b"Frame 99\n"): received += self.peers[0].recv(65536)
+        self.assertTrue(received.endswith(b"".join(f"Frame {i}\n".encode() for i in range(100))))
+
+
+    def test_outboundBytesGauge(self):
+        ##The gauge reports the bytes that a client which is not reading has yet to be sent, including a partially sent batch
+        self.server.enableMetrics()
+        alice, bob = self.createSession("alice"), self.createSession("bob")
+        alice.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        self.server.flushPending()
+        for i in range(1000): self.server.queueFrame(alice, b"x" * 1000)
+        self.server.flushPending()
+        snapshot = self.server.metrics.snapshot()
+        self.assertGreater(alice.unsentBytes(), alice.outboundBytes)
+        self.assertEqual(snapshot["outbound.bytes.max"], alice.unsentBytes())
+        self.assertEqual(snapshot["outbound.bytes.total"], alice.unsentBytes() + bob.unsentBytes())
+
+
+    def test_rejectSessionCreation(self):
+        self.createSession("alice")
+        duplicate = self.createConnection()
+        self.server.rejectSessionCreation("Server", duplicate)
+        self.assertTrue(duplicate.closing)
+        self.server.flushConnection(None, duplicate)
+        self.assertFalse(self.server.connections.isRegistered(duplicate))
+        self.assertIn(b"Session-Rejection", self.peers[-1].recv(1024))
+
+
+if __name__ == "__main__":
+    unittest.main()
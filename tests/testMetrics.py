@@ -0,0 +1,55 @@
+import os
+import tempfile
+import unittest
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from src.metrics import metricsRegistry, histogram
+
+
+class testMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = metricsRegistry()
+
+
+    def test_counter(self):
+        self.registry.counter("frames").inc()
+        self.registry.counter("frames").inc(4)
+        self.assertEqual(self.registry.snapshot()["frames"], 5)
+
+
+    def test_histogram(self):
+        metric = histogram()
+        for value in range(1, 1001):
+            metric.record(value / 1000)
+        self.assertEqual(metric.count, 1000)
+        self.assertAlmostEqual(metric.percentile(50), 0.5, delta=0.01)
+        self.assertAlmostEqual(metric.percentile(99), 0.99, delta=0.02)
+        self.assertEqual(metric.percentile(100), 1.0)
+        self.assertIsNone(histogram().percentile(50))
+
+
+    def test_gauge(self):
+        queue = [1, 2, 3]
+        self.registry.gauge("queue.length", lambda: len(queue))
+        self.registry.gauge("broken", lambda: 1 / 0)
+        queue.append(4)
+        snapshot = self.registry.snapshot()
+        self.assertEqual(snapshot["queue.length"], 4)
+        self.assertIsNone(snapshot["broken"])
+
+
+    def test_renderAndDump(self):
+        self.registry.counter("bytes.in").inc(10)
+        self.registry.histogram("handler.seconds").record(0.5)
+        self.assertIn("bytes.in 10\n", self.registry.render())
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "stats.txt")
+            self.registry.dump(path)
+            self.registry.dump(path)
+            with open(path) as file:
+                self.assertEqual(file.read().count("handler.seconds.count 1\n"), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import tempfile
+import time
+import tracemalloc
+import unittest
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from src.profiling import profilingWindow, parseProfilers
+
+retained = []
+
+def busyLoopForProfiling(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        retained.append(bytearray(1024))
+
+
+class testProfiling(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.addCleanup(retained.clear)
+
+    def test_parseProfilers(self):
+        self.assertEqual(parseProfilers("cprofile, memory"), ["cprofile", "memory"])
+        self.assertEqual(parseProfilers("sampling"), ["sampling"])
+        with self.assertRaises(ValueError): parseProfilers("perf")
+
+    def test_window(self):
+        window = profilingWindow(["cprofile", "sampling", "memory"], self.directory.name, sampleInterval=0.001)
+        window.open()
+        busyLoopForProfiling(0.2)
+        paths = window.close("connections 3")
+        ##Every profiler writes its own file, each starting with the annotation
+        self.assertEqual(len(paths), 4)
+        self.assertFalse(tracemalloc.is_tracing())
+        reports = {}
+        for path in paths:
+            self.assertTrue(os.path.exists(path))
+            if path.endswith(".prof"): continue
+            with open(path) as file: reports[path.rsplit("-", 1)[1]] = file.read()
+            self.assertIn("# connections 3\n", reports[path.rsplit("-", 1)[1]])
+        self.assertIn("busyLoopForProfiling", reports["cprofile.txt"])
+        ##The samples are the event loop thread's stacks, outermost frame first, with a count
+        samples = [line for line in reports["samples.folded"].splitlines() if not line.startswith("#")]
+        self.assertTrue(any("busyLoopForProfiling" in line.rsplit(";", 1)[-1] for line in samples))
+        self.assertTrue(all(line.rsplit(" ", 1)[1].isdigit() for line in samples))
+        ##The bytearrays still retained are reported as growth at the line that allocated them
+        growth = [line for line in reports["memory.txt"].splitlines() if not line.startswith("#")]
+        self.assertIn("testProfiling.py", growth[0])
+
+    def test_inactiveWindowInstallsNothing(self):
+        window = profilingWindow(["cprofile", "sampling", "memory"], self.directory.name)
+        self.assertIsNone(sys.getprofile())
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertIsNone(window.sampler)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+import os
+import unittest
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from src.rateLimit import tokenBucket, createBucket
+
+
+class testRateLimit(unittest.TestCase):
+    def setUp(self):
+        self.bucket = tokenBucket(10.0, 5, 0.0)
+
+    def test_burstThenRate(self):
+        ##A full bucket admits a burst, and then admits the rate
+        self.assertEqual(sum(self.bucket.consume(0.0) for _ in range(8)), 5)
+        self.assertTrue(self.bucket.limited)
+        self.assertAlmostEqual(self.bucket.retryAfter(), 0.1)
+        self.assertFalse(self.bucket.consume(0.05))
+        self.assertTrue(self.bucket.consume(0.1))
+        self.assertFalse(self.bucket.limited)
+
+    def test_refillIsCapped(self):
+        self.bucket.consume(0.0, 5)
+        self.assertEqual(sum(self.bucket.consume(100.0) for _ in range(8)), 5)
+
+    def test_chargeGoesIntoDebt(self):
+        ##A charge is always taken, and returns how long the bucket takes to repay it
+        self.assertEqual(self.bucket.charge(0.0, 3), 0.0)
+        self.assertAlmostEqual(self.bucket.charge(0.0, 12), 1.0)
+        self.assertFalse(self.bucket.consume(0.5))
+        self.assertTrue(self.bucket.consume(1.1))
+
+    def test_zeroRateIsUnlimited(self):
+        self.assertIsNone(createBucket(0, 10, 0.0))
+        self.assertIsNotNone(createBucket(1, 10, 0.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,11 @@
+import os
+import socket
 import unittest
 import sys
-sys.path.insert(0, "..\\")
-from src.message import request, response
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from src.message import request, response, frameDecoder, binaryRequest, binaryFrameDecoder, encodeVarint, decodeVarint, negotiateProtocol
+from src.message import formatResume, parseResume
+from src.message import frameCompressor, inflatingDecoder, negotiateCompression
 
 
 class testRequest(unittest.TestCase):
@@ -13,50 +17,50 @@ class testRequest(unittest.TestCase):
         print("\n")
         ## Test when message is 0 sized length
         print("Test when request message is 0 sized length")
-        self.req.setStringRequest("")
-        expectedOutput = b"Message-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:0\r\n\r\n\r\n"
+        self.req.setStringRequest("user5423", "")
+        expectedOutput = b"User:user5423\r\nMessage-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:0\r\n\r\n\r\n"
         self.assertEqual(self.req.rawRequest, expectedOutput)
 
 
         ## Test when the request obect contains a non-zero length message
         print("Test when request message is non-zero sized length")
         self.setUp()
-        self.req.setStringRequest("New Request Object")
-        expectedOutput = b"Message-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:18\r\nNew Request Object\r\n\r\n"
+        self.req.setStringRequest("user5423", "New Request Object")
+        expectedOutput = b"User:user5423\r\nMessage-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:18\r\nNew Request Object\r\n\r\n"
         self.assertEqual(self.req.rawRequest, expectedOutput)
 
 
         ## Test when the request object is reused
         print("Test when request object is reused")
-        self.req.setStringRequest("Reused")
-        expectedOutput = b"Message-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:6\r\nReused\r\n\r\n"
+        self.req.setStringRequest("user5423", "Reused")
+        expectedOutput = b"User:user5423\r\nMessage-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:6\r\nReused\r\n\r\n"
         self.assertEqual(self.req.rawRequest, expectedOutput)
 
 
         ## Test when the request contains characters that are \r\n
         print("Test whether request message escapes newline correctly")
-        self.req.setStringRequest("\n")
-        expectedOutput = b"Message-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:3\r\n\\n\r\n\r\n"
+        self.req.setStringRequest("user5423", "\n")
+        expectedOutput = b"User:user5423\r\nMessage-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:2\r\n\\n\r\n\r\n"
         self.assertEqual(self.req.rawRequest, expectedOutput)
 
 
         print("Test whether request message escapes carriage return correctly")
-        self.req.setStringRequest("\r")
-        expectedOutput = b"Message-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:3\r\n\\r\r\n\r\n"
+        self.req.setStringRequest("user5423", "\r")
+        expectedOutput = b"User:user5423\r\nMessage-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:2\r\n\\r\r\n\r\n"
         self.assertEqual(self.req.rawRequest, expectedOutput)
 
 
         ## Test when the request contains characters that are \r\n
         print("Test whether request message escapes line terminator correctly")
-        self.req.setStringRequest("\r\n")
-        expectedOutput = b"Message-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:6\r\n\\r\\n\r\n\r\n"
+        self.req.setStringRequest("user5423", "\r\n")
+        expectedOutput = b"User:user5423\r\nMessage-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:4\r\n\\r\\n\r\n\r\n"
         self.assertEqual(self.req.rawRequest, expectedOutput)
 
 
         ## Test when the request contains characters that are \r\n\r\n
         print("Test whether request message escapes terminator sequence correctly")
-        self.req.setStringRequest("\r\n\r\n")
-        expectedOutput = b"Message-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:12\r\n\\r\\n\\r\\n\r\n\r\n"
+        self.req.setStringRequest("user5423", "\r\n\r\n")
+        expectedOutput = b"User:user5423\r\nMessage-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:8\r\n\\r\\n\\r\\n\r\n\r\n"
         self.assertEqual(self.req.rawRequest, expectedOutput)
 
         print("\n\n")
@@ -70,53 +74,231 @@ class testResponse(unittest.TestCase):
         print("\n")
         ##Test when message is 0 sized length
         print("Test when request message is 0 sized length")
-        inputBytes = b"Message-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:0\r\n\r\n\r\n"
+        inputBytes = b"User:user5423\r\nMessage-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:0\r\n\r\n\r\n"
         expectedOutput = ""
         self.resp.setRawRequest(inputBytes)
-        self.assertEqual(expectedOutput, self.resp.stringRequest["body"])
+        self.assertEqual(expectedOutput, self.resp.stringRequest["Body"])
 
         print("Test when response message is non-zero sized length")
         self.setUp()
-        inputBytes = b"Message-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:18\r\nNew Request Object\r\n\r\n"
+        inputBytes = b"User:user5423\r\nMessage-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:18\r\nNew Request Object\r\n\r\n"
         expectedOutput = "New Request Object"
         self.resp.setRawRequest(inputBytes)
-        self.assertEqual(expectedOutput, self.resp.stringRequest["body"])
+        self.assertEqual(expectedOutput, self.resp.stringRequest["Body"])
 
 
         print("Test when response object is reused")
-        inputBytes = b"Message-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:18\r\nReused\r\n\r\n"
+        inputBytes = b"User:user5423\r\nMessage-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:6\r\nReused\r\n\r\n"
         expectedOutput = "Reused"
         self.resp.setRawRequest(inputBytes)
-        self.assertEqual(expectedOutput, self.resp.stringRequest["body"])
+        self.assertEqual(expectedOutput, self.resp.stringRequest["Body"])
 
 
         print("Test whether request message escapes newline correctly")
-        inputBytes = b"Message-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:3\r\n\\n\r\n\r\n"
+        inputBytes = b"User:user5423\r\nMessage-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:2\r\n\\n\r\n\r\n"
         expectedOutput = "\n"
         self.resp.setRawRequest(inputBytes)
-        self.assertEqual(expectedOutput, self.resp.stringRequest["body"])
+        self.assertEqual(expectedOutput, self.resp.stringRequest["Body"])
 
 
         print("Test whether request message escapes carriage return correctly")
-        inputBytes = b"Message-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:3\r\n\\r\r\n\r\n"
+        inputBytes = b"User:user5423\r\nMessage-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:2\r\n\\r\r\n\r\n"
         expectedOutput = "\r"
         self.resp.setRawRequest(inputBytes)
-        self.assertEqual(expectedOutput, self.resp.stringRequest["body"])
+        self.assertEqual(expectedOutput, self.resp.stringRequest["Body"])
 
 
         print("Test whether request message escapes line terminator correctly")
-        inputBytes = b"Message-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:6\r\n\\r\\n\r\n\r\n"
+        inputBytes = b"User:user5423\r\nMessage-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:4\r\n\\r\\n\r\n\r\n"
         expectedOutput = "\r\n"
         self.resp.setRawRequest(inputBytes)
-        self.assertEqual(expectedOutput, self.resp.stringRequest["body"])
+        self.assertEqual(expectedOutput, self.resp.stringRequest["Body"])
 
 
         print("Test whether request message escapes terminator sequence correctly")
-        inputBytes = b"Message-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:12\r\n\\r\\n\\r\\n\r\n\r\n"
+        inputBytes = b"User:user5423\r\nMessage-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:8\r\n\\r\\n\\r\\n\r\n\r\n"
         expectedOutput = "\r\n\r\n"
         self.resp.setRawRequest(inputBytes)
-        self.assertEqual(expectedOutput, self.resp.stringRequest["body"])
+        self.assertEqual(expectedOutput, self.resp.stringRequest["Body"])
 
 
+class testFrameDecoder(unittest.TestCase):
+    def setUp(self):
+        self.decoder = frameDecoder()
+        self.req = request()
 
-unittest.main()
\ No newline at end of file
+    def test_pipelinedFrames(self):
+        ##Several frames that arrive in a single receive are all decoded
+        frames = [self.req.createRawRequest("user5423", f"Message {i}", "User-Message", "Text") for i in range(3)]
+        self.decoder.feed(b"".join(frames))
+        self.assertEqual([frame["Body"] for frame in self.decoder.frames()], ["Message 0", "Message 1", "Message 2"])
+        self.assertEqual(list(self.decoder.frames()), [])
+
+    def test_partialFrames(self):
+        ##A frame that is split across receives is decoded once it is complete, even when split inside the headers
+        frame = self.req.createRawRequest("user5423", "Split\r\n\r\nMessage", "User-Message", "Text")
+        for i in range(len(frame) - 1):
+            self.decoder.feed(frame[i:i + 1])
+            self.assertEqual(list(self.decoder.frames()), [])
+        self.decoder.feed(frame[-1:] + frame[:10])
+        decoded = list(self.decoder.frames())
+        self.assertEqual(len(decoded), 1)
+        self.assertEqual(decoded[0]["Body"], "Split\r\n\r\nMessage")
+        self.assertEqual(decoded[0]["Headers"]["User"], "user5423")
+        self.assertEqual(bytes(self.decoder.buffer[self.decoder.offset:]), frame[:10])
+
+    def test_largeFrame(self):
+        message = "x" * 1000000
+        frame = self.req.createRawRequest("user5423", message, "User-Message", "Text")
+        for i in range(0, len(frame), 65536):
+            self.decoder.feed(frame[i:i + 65536])
+        self.assertEqual([frame["Body"] for frame in self.decoder.frames()], [message])
+
+    def test_headerValuesContainingColons(self):
+        self.decoder.feed(self.req.createRawRequest("user:5423", "Message", "User-Message", "Text"))
+        self.assertEqual(next(self.decoder.frames())["Headers"]["User"], "user:5423")
+
+    def test_malformedFrame(self):
+        self.decoder.feed(b"User:user5423\r\nContent-Length:2\r\nabcdef\r\n\r\n")
+        with self.assertRaises(ValueError):
+            list(self.decoder.frames())
+
+    def test_legacyContentLength(self):
+        ##Clients from before the Content-Length was the escaped body's length sent the length of the body's repr()
+        def legacyFrame(message):
+            body = message.encode("unicode-escape").decode("utf-8")
+            return f"User:user5423\r\nMessage-Type:User-Message\r\nContent-Type:Text\r\nContent-Length:{len(repr(body)) - 2}\r\n{body}\r\n\r\n".encode("utf-8")
+        messages = ["caf\u00e9", "C:\\path", "it's \"q\""]
+        stream = b"".join(legacyFrame(message) for message in messages) + self.req.createRawRequest("user5423", "After", "User-Message", "Text")
+        self.decoder.feed(stream)
+        self.assertEqual([frame["Body"] for frame in self.decoder.frames()], messages + ["After"])
+        ##And when they arrive a byte at a time
+        decoder, bodies = frameDecoder(), []
+        for i in range(len(stream)):
+            decoder.feed(stream[i:i + 1])
+            bodies.extend(frame["Body"] for frame in decoder.frames())
+        self.assertEqual(bodies, messages + ["After"])
+
+    def test_bodySizeLimit(self):
+        decoder = frameDecoder(maxBodySize=1000)
+        decoder.feed(b"User:user5423\r\nContent-Length:1001\r\n")
+        with self.assertRaises(ValueError):
+            list(decoder.frames())
+        ##A body that runs past its Content-Length without a terminator is not buffered any further
+        decoder = frameDecoder(maxBodySize=1000)
+        decoder.feed(b"User:user5423\r\nContent-Length:10\r\n" + b"x" * 10)
+        self.assertEqual(list(decoder.frames()), [])
+        decoder.feed(b"x" * 4)
+        with self.assertRaises(ValueError):
+            list(decoder.frames())
+
+    def test_receiveFrom(self):
+        local, remote = socket.socketpair()
+        remote.sendall(self.req.createRawRequest("user5423", "Message", "User-Message", "Text"))
+        remote.close()
+        self.assertGreater(self.decoder.receiveFrom(local), 0)
+        self.assertEqual(next(self.decoder.frames())["Body"], "Message")
+        self.assertEqual(self.decoder.receiveFrom(local), 0)
+        local.close()
+
+
+class testBinaryProtocol(unittest.TestCase):
+    def setUp(self):
+        self.req = binaryRequest()
+        self.decoder = binaryFrameDecoder()
+
+    def roundTrip(self, *args, **kwargs):
+        self.decoder.feed(self.req.createRawRequest(*args, **kwargs))
+        frames = list(self.decoder.frames())
+        self.assertEqual(len(frames), 1)
+        return frames[0]
+
+    def test_varint(self):
+        for value in (0, 1, 127, 128, 300, 16383, 16384, 2 ** 40):
+            encoded = encodeVarint(value)
+            self.assertEqual(decodeVarint(bytearray(encoded), 0), (value, len(encoded)))
+        self.assertEqual(decodeVarint(bytearray(encodeVarint(300)[:1]), 0)[0], None)
+
+    def test_compactFrame(self):
+        ##A small message costs 4 bytes of framing, and the body is sent unescaped
+        frame = self.req.createRawRequest("user5423", "Hello\r\n", "User-Message")
+        self.assertEqual(frame, b"\x02\x08\x00\x07user5423Hello\r\n")
+
+    def test_roundTrip(self):
+        frame = self.roundTrip("user5423", "Hello \u00e9\u4e16\r\n\r\n", "Chat-Update")
+        self.assertEqual(frame["Body"], "Hello \u00e9\u4e16\r\n\r\n")
+        self.assertEqual(frame["Headers"]["User"], "user5423")
+        self.assertEqual(frame["Headers"]["Message-Type"], "Chat-Update")
+
+    def test_additionalHeaders(self):
+        frame = self.roundTrip("user:5423", "", "Server-Defined-Type", headers={"Protocol": "2"})
+        self.assertEqual(frame["Headers"]["Message-Type"], "Server-Defined-Type")
+        self.assertEqual(frame["Headers"]["Protocol"], "2")
+        self.assertEqual(frame["Headers"]["User"], "user:5423")
+
+    def test_partialAndPipelinedFrames(self):
+        stream = b"".join(self.req.createRawRequest("user5423", "x" * size, "User-Message") for size in (0, 10, 200, 70000))
+        bodies = []
+        for i in range(0, len(stream), 7):
+            self.decoder.feed(stream[i:i + 7])
+            bodies.extend(frame["Body"] for frame in self.decoder.frames())
+        self.assertEqual(bodies, ["x" * size for size in (0, 10, 200, 70000)])
+
+    def test_bodySizeLimit(self):
+        decoder = binaryFrameDecoder(maxBodySize=1000)
+        decoder.feed(self.req.createRawRequest("user5423", "x" * 1001, "User-Message")[:10])
+        with self.assertRaises(ValueError):
+            list(decoder.frames())
+
+    def test_negotiateProtocol(self):
+        self.assertEqual(negotiateProtocol({}), 1)
+        self.assertEqual(negotiateProtocol({"Protocol": "2"}), 2)
+        self.assertEqual(negotiateProtocol({"Protocol": "9"}), 2)
+        self.assertEqual(negotiateProtocol({"Protocol": "invalid"}), 1)
+
+    def test_resumeHeader(self):
+        sequences = {None: 41, "games": 7}
+        self.assertEqual(formatResume(sequences), "41,games=7")
+        self.assertEqual(parseResume({"Resume": formatResume(sequences)}), sequences)
+        self.assertEqual(parseResume({}), {})
+        self.assertEqual(parseResume({"Resume": "x,games=y,chess=3"}), {"chess": 3})
+
+
+
+class testCompression(unittest.TestCase):
+    def setUp(self):
+        self.req = binaryRequest()
+        self.compressor = frameCompressor(threshold=64)
+
+    def test_roundTrip(self):
+        messages = ["Hi", "Hello " * 100, "x" * 70000, "Hello " * 100, "\u00e9\u4e16" * 50]
+        stream = b"".join(chunk for message in messages for chunk in self.compressor.pack(self.req.createRawRequest("Server", message, "Chat-Update")))
+        ##Envelopes may be split or pipelined, and the deflate context is shared across frames
+        decoder, bodies = inflatingDecoder(binaryFrameDecoder()), []
+        for i in range(0, len(stream), 5):
+            decoder.feed(stream[i:i + 5])
+            bodies.extend(frame["Body"] for frame in decoder.frames())
+        self.assertEqual(bodies, messages)
+        self.assertLess(self.compressor.outputBytes * 10, self.compressor.inputBytes)
+
+    def test_smallFramesAreShared(self):
+        frame = self.req.createRawRequest("Server", "Hi", "Chat-Update")
+        chunks = self.compressor.pack(frame)
+        self.assertIs(chunks[1], frame)
+        self.assertIsNone(self.compressor.deflater)
+
+    def test_bytesAfterNegotiation(self):
+        ##Bytes received after the negotiating frame are already enveloped
+        inner = binaryFrameDecoder()
+        inner.feed(self.req.createRawRequest("Server", "Registered", "User-Creation") + b"".join(self.compressor.pack(self.req.createRawRequest("Server", "y" * 500, "Chat-Update"))))
+        self.assertEqual(inner.decodeFrame()["Body"], "Registered")
+        self.assertEqual(inflatingDecoder(inner).decodeFrame()["Body"], "y" * 500)
+
+    def test_negotiateCompression(self):
+        self.assertIsNone(negotiateCompression({}))
+        self.assertIsNone(negotiateCompression({"Compression": "brotli"}))
+        self.assertEqual(negotiateCompression({"Compression": "brotli, deflate"}), "deflate")
+
+
+if __name__ == "__main__":
+    unittest.main()
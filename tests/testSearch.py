@@ -0,0 +1,65 @@
+import os
+import unittest
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from src.server import chatObject
+from src.search import parseTime
+
+
+class testSearch(unittest.TestCase):
+    def setUp(self):
+        self.chat = chatObject(capacity=1000)
+        for i in range(300):
+            self.chat.logUserMessage(f"user{i % 3}", f"Message {i} {'even' if i % 2 == 0 else 'odd'}")
+
+
+    def test_search(self):
+        index = self.chat.index
+        self.assertEqual(index.search(["even"], 3), [294, 296, 298])
+        ##Every term must match, and the newest matches are returned in order
+        self.assertEqual(index.search(["message", "odd"], 2), [297, 299])
+        self.assertEqual(index.search(["17"], 10), [17])
+        self.assertEqual(index.search(["even", "missing"], 10), [])
+
+
+    def test_fromUserAndHistory(self):
+        index = self.chat.index
+        self.assertEqual(index.fromUser("user1", 3), [292, 295, 298])
+        self.assertEqual(index.fromUser("nobody", 3), [])
+        self.assertEqual(index.history(2), [298, 299])
+        ##Private chat actions are not indexed
+        self.chat.logUserMessage("user0", "Secret even", "private")
+        self.assertEqual(index.history(1), [299])
+
+
+    def test_since(self):
+        timestamp = self.chat.getChat(250).timestamp
+        sequences = self.chat.index.since(timestamp, 500)
+        self.assertLessEqual(sequences[0], 250)
+        self.assertEqual(sequences[-1], 299)
+        self.assertEqual(self.chat.index.since(timestamp + 3600, 10), [])
+
+
+    def test_evictedChatsRetired(self):
+        chat = chatObject(capacity=10)
+        for i in range(10000): chat.logUserMessage("alice", f"Message {i}")
+        self.assertEqual(chat.index.search(["message"], 100), list(range(9990, 10000)))
+        self.assertEqual(chat.index.search(["5"], 10), [])
+        ##Retired postings are compacted away, rather than accumulating
+        self.assertLess(len(chat.index.sequences), 5000)
+        self.assertEqual([ca.message for ca in chat.getChatsBySequence(chat.index.fromUser("alice", 2))], ["Message 9998", "Message 9999"])
+
+
+    def test_parseTime(self):
+        now = 1700000000.0
+        self.assertEqual(parseTime("10m", now), now - 600)
+        self.assertEqual(parseTime("2h", now), now - 7200)
+        self.assertEqual(parseTime("1699999000", now), 1699999000.0)
+        self.assertIsInstance(parseTime("2024-01-31T14:30", now), float)
+        self.assertLessEqual(parseTime("00:00", now), now)
+        with self.assertRaises(ValueError): parseTime("yesterday", now)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import unittest
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from src.timerWheel import timerWheel
+
+
+class testTimerWheel(unittest.TestCase):
+    def setUp(self):
+        self.wheel = timerWheel(0.0, resolution=1.0, slots=8)
+        self.fired = []
+
+    def test_firesOnceTheTickHasElapsed(self):
+        self.wheel.schedule(2.5, self.fired.append, "a")
+        self.wheel.schedule(1.2, self.fired.append, "b")
+        self.assertEqual(self.wheel.nextDeadline(), 2.0)
+        self.assertEqual(self.wheel.advance(1.9), 0)
+        ##Timers fire up to one tick late, and in the order of their ticks
+        self.assertEqual(self.wheel.advance(3.0), 2)
+        self.assertEqual(self.fired, ["b", "a"])
+        self.assertEqual(len(self.wheel), 0)
+        self.assertIsNone(self.wheel.nextDeadline())
+
+    def test_cancel(self):
+        entry = self.wheel.schedule(1.0, self.fired.append, "a")
+        self.wheel.cancel(entry)
+        self.wheel.cancel(entry)
+        self.wheel.cancel(None)
+        self.assertEqual(len(self.wheel), 0)
+        self.wheel.advance(5.0)
+        self.assertEqual(self.fired, [])
+
+    def test_laterRotations(self):
+        ##A timer more than a rotation away shares a slot with nearer timers, but is only fired once it is due
+        self.wheel.schedule(3.5, self.fired.append, "near")
+        self.wheel.schedule(11.5, self.fired.append, "far")
+        self.wheel.advance(4.0)
+        self.assertEqual(self.fired, ["near"])
+        self.assertEqual(self.wheel.nextDeadline(), 12.0)
+        self.wheel.advance(12.0)
+        self.assertEqual(self.fired, ["near", "far"])
+
+    def test_idleWheel(self):
+        ##However long the wheel was not advanced for, every overdue timer fires, and a past deadline fires on the next tick
+        for deadline in (0.5, 3.5, 7.5):
+            self.wheel.schedule(deadline, self.fired.append, deadline)
+        self.wheel.advance(100.0)
+        self.assertEqual(self.fired, [0.5, 3.5, 7.5])
+        self.wheel.schedule(50.0, self.fired.append, "late")
+        self.assertEqual(self.wheel.nextDeadline(), 101.0)
+        self.wheel.advance(101.0)
+        self.assertEqual(self.fired[-1], "late")
+
+    def test_rescheduleFromCallback(self):
+        def rearm(count):
+            self.fired.append(count)
+            if count < 3: self.wheel.schedule(count + 1.5, rearm, count + 1)
+        self.wheel.schedule(0.5, rearm, 1)
+        for now in range(1, 6): self.wheel.advance(float(now))
+        self.assertEqual(self.fired, [1, 2, 3])
+
+
+if __name__ == "__main__":
+    unittest.main()